@@ -0,0 +1,145 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 17 2026
+# This file implements the annotated-result renderer shared by both frontends.
+# Fonts are loaded once per process and reused, word widths are measured once and
+# cached so line wrapping is linear in the text length, the image is drawn at a
+# bounded output size, and the result can be encoded as PNG, JPEG or WebP.
+
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont
+import metrics
+import io
+
+# Fonts tried in order; the first one available on this system is used
+FONT_CANDIDATES = (
+    "/Library/Fonts/Arial.ttf",  # macOS
+    "arial.ttf",  # Windows (found through the system font directory)
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",  # Debian/Ubuntu
+    "DejaVuSans.ttf",
+)
+# Output formats: name -> (PIL format, MIME type, file extension)
+FORMATS = {
+    "PNG": ("PNG", "image/png", "png"),
+    "JPEG": ("JPEG", "image/jpeg", "jpg"),
+    "WebP": ("WEBP", "image/webp", "webp"),
+}
+# Longest side of the rendered annotation
+MAX_OUTPUT_SIZE = 1024
+# Box colours of multi-region results, cycled through by label
+REGION_COLORS = ("red", "blue", "green", "orange", "purple", "cyan", "magenta")
+
+
+# Load a font once per process and size
+@lru_cache(maxsize=None)
+def get_font(size):
+    for candidate in FONT_CANDIDATES:
+        try:
+            return ImageFont.truetype(candidate, size)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:  # Pillow without a scalable default font
+        return ImageFont.load_default()
+
+
+# Width of a word in a font, measured once per (font, word)
+@lru_cache(maxsize=4096)
+def _text_width(font, text):
+    return font.getlength(text)
+
+
+# Break text into lines that fit `max_width`. Existing line breaks are kept and
+# every word is measured once, so the cost is linear in the text length.
+def wrap_text(text, font, max_width):
+    space = _text_width(font, " ")
+    lines = []
+    for paragraph in text.split("\n"):
+        line = []
+        width = 0.0
+        for word in paragraph.split():
+            word_width = _text_width(font, word)
+            extra = word_width if not line else space + word_width
+            if line and width + extra > max_width:
+                lines.append(" ".join(line))
+                line = [word]
+                width = word_width
+            else:
+                line.append(word)
+                width += extra
+        lines.append(" ".join(line))
+    return lines
+
+
+# Draw the classification text on a copy of the image, scaled down so that its
+# longest side is at most `max_size`
+def render_annotation(image, class_name, confidence, guidance, font_size=30,
+                      max_size=MAX_OUTPUT_SIZE, fill="red", margin=10):
+    annotated_image = image.convert("RGB") if image.mode != "RGB" else image.copy()
+    annotated_image.thumbnail((max_size, max_size), Image.BILINEAR)
+    draw = ImageDraw.Draw(annotated_image)
+    font = get_font(font_size)
+    text = (
+        f"Classification: {class_name}\n"
+        f"Confidence: {confidence:.2f}\n"
+        f"{guidance}"
+    )
+
+    ascent, descent = font.getmetrics()
+    line_height = ascent + descent + 5
+    y_text = margin
+    for line in wrap_text(text, font, annotated_image.width - 2 * margin):
+        draw.text((margin, y_text), line, font=font, fill=fill)
+        y_text += line_height
+    return annotated_image
+
+
+# Draw multi-region results (see multi_region.py) on a copy of the image: one
+# box per region with its label and confidence, scaled like render_annotation
+def draw_regions(image, regions, font_size=20, max_size=MAX_OUTPUT_SIZE, width=3):
+    with metrics.stage("annotate"):
+        annotated_image = image.convert("RGB") if image.mode != "RGB" else image.copy()
+        annotated_image.thumbnail((max_size, max_size), Image.BILINEAR)
+        scale = annotated_image.width / image.width
+        draw = ImageDraw.Draw(annotated_image)
+        font = get_font(font_size)
+        colors = {}
+        for region in regions:
+            color = colors.setdefault(region.class_name,
+                                      REGION_COLORS[len(colors) % len(REGION_COLORS)])
+            box = [round(value * scale) for value in region.box]
+            draw.rectangle(box, outline=color, width=width)
+            label = f"{region.class_name} {region.confidence:.2f}"
+            left, top, right, bottom = draw.textbbox((box[0] + width, box[1] + width), label,
+                                                     font=font)
+            draw.rectangle((left - 2, top - 2, right + 2, bottom + 2), fill=color)
+            draw.text((box[0] + width, box[1] + width), label, font=font, fill="white")
+        return annotated_image
+
+
+# Encode an image to bytes in one of FORMATS
+def encode_image(image, image_format="PNG", quality=90):
+    pil_format = FORMATS[image_format][0]
+    buffer = io.BytesIO()
+    if pil_format == "PNG":
+        image.save(buffer, format="PNG", compress_level=3)  # Faster, slightly larger
+    else:
+        image.save(buffer, format=pil_format, quality=quality)
+    return buffer.getvalue()
+
+
+# Render and encode an annotated result in one call
+def annotate_image(image, class_name, confidence, guidance, image_format="PNG",
+                   font_size=30, max_size=MAX_OUTPUT_SIZE):
+    with metrics.stage("annotate"):
+        annotated_image = render_annotation(image, class_name, confidence, guidance,
+                                            font_size, max_size)
+        return encode_image(annotated_image, image_format)
+
+
+# MIME type and file extension of an output format
+def format_info(image_format):
+    _, mime, extension = FORMATS[image_format]
+    return mime, extension
@@ -6,13 +6,60 @@
 # Users can upload waste images, select a language, and receive classification results and disposal suggestions.
 # The file also includes a user feedback submission feature and the ability to download 
 # annotated images with classification information.
+# Handlers are async: decoding and annotation run in a small CPU thread pool, model work
+# in an inference pool, so the event loop never blocks. Every route has its own
+# concurrency limit, and requests time out and are cancelled when the client leaves.
 
 import gradio as gr
-from model_inference import classify_image_with_trash_threshold, class_descriptions
-from PIL import Image, ImageDraw, ImageFont
-import datetime
+from model_inference import (
+    classify_image_async, class_descriptions, enable_batching, enable_corrections,
+    enable_result_cache, get_client, record_decision, submit_correction, trash_classes,
+    warm_up
+)
+from batch_scheduler import SchedulerOverloadedError
+from image_ingest import ImageRejectedError, ingest_image
+from annotation import FORMATS, annotate_image, draw_regions, format_info
+from multi_region import classify_regions
+from feedback_store import feedback_entry, get_feedback_store
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import asyncio
+import os
+import tempfile
+import time
+import torch
 import urllib.parse
 
+# Micro-batching settings: concurrent classify requests arriving within the
+# window are merged into one forward pass
+BATCH_WINDOW_MS = float(os.environ.get("WASTE_BATCH_WINDOW_MS", "10"))
+MAX_BATCH_SIZE = int(os.environ.get("WASTE_MAX_BATCH_SIZE", "8"))
+MAX_QUEUE_SIZE = int(os.environ.get("WASTE_MAX_QUEUE_SIZE", "64"))
+
+# Annotated downloads are written to one directory per process, removed when
+# the process exits; files are also deleted once they are this old (seconds)
+DOWNLOAD_TTL_S = float(os.environ.get("WASTE_DOWNLOAD_TTL_S", "600"))
+download_dir = tempfile.TemporaryDirectory(prefix="waste_sorting_downloads_")
+
+# Threads for decoding and annotation; model work gets MAX_BATCH_SIZE threads
+CPU_WORKERS = int(os.environ.get("WASTE_CPU_WORKERS", "2"))
+# PyTorch intra-op threads; by default the cores left over by the CPU workers
+TORCH_THREADS = int(os.environ.get(
+    "WASTE_TORCH_THREADS", str(max(1, (os.cpu_count() or 1) - CPU_WORKERS))
+))
+# Concurrent requests per route (classification uses MAX_BATCH_SIZE)
+REGIONS_CONCURRENCY = int(os.environ.get("WASTE_REGIONS_CONCURRENCY", "2"))
+DOWNLOAD_CONCURRENCY = int(os.environ.get("WASTE_DOWNLOAD_CONCURRENCY", str(CPU_WORKERS)))
+# Requests waiting in the Gradio queue before new ones are turned away
+GRADIO_QUEUE_SIZE = int(os.environ.get("WASTE_GRADIO_QUEUE_SIZE", "128"))
+# Seconds a request may take before it is cancelled
+REQUEST_TIMEOUT = float(os.environ.get("WASTE_REQUEST_TIMEOUT", "30"))
+# How often running requests check whether their client is still connected
+DISCONNECT_POLL_S = 0.25
+
+cpu_executor = ThreadPoolExecutor(CPU_WORKERS, thread_name_prefix="gradio-cpu")
+inference_executor = ThreadPoolExecutor(MAX_BATCH_SIZE, thread_name_prefix="gradio-inference")
+
 # Define color mapping for different waste categories
 category_colors = {
     "glass": "blue",
@@ -24,10 +71,77 @@ category_colors = {
     "cardboard": "blue"
 }
 
+# Run a blocking function in an executor thread, as part of the current request
+def run_in(executor, function, *args):
+    return asyncio.get_running_loop().run_in_executor(
+        executor, metrics.run_traced, metrics.current_trace(), function, *args
+    )
+
+# True once Gradio has marked this session's running jobs as abandoned (the
+# browser tab was closed or the connection dropped). Gradio already drops the
+# queued events of such sessions; this lets running handlers stop as well.
+# It reads the queue's internal job list, which has no public API, so Gradio is
+# pinned in requirements.txt; on other versions it simply reports False.
+def client_disconnected(request):
+    session_hash = getattr(request, "session_hash", None)
+    queue = getattr(iface, "_queue", None)
+    if session_hash is None or queue is None:
+        return False
+    return any(not getattr(event, "alive", True)
+               for events in list(getattr(queue, "active_jobs", ())) if events
+               for event in events if event.session_hash == session_hash)
+
+# Await a handler coroutine; cancel it after REQUEST_TIMEOUT seconds or when
+# the client disconnects. Cancellation stops the executor jobs and batched
+# forward passes the request has not started yet.
+async def guarded(coroutine, request):
+    task = asyncio.ensure_future(coroutine)
+    deadline = time.monotonic() + REQUEST_TIMEOUT
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            done, _ = await asyncio.wait({task}, timeout=max(0, min(DISCONNECT_POLL_S, remaining)))
+            if done:
+                return task.result()
+            if remaining <= 0:
+                raise gr.Error(f"The request took longer than {REQUEST_TIMEOUT:g} seconds "
+                               f"and was cancelled. Please try again.")
+            if client_disconnected(request):
+                raise gr.Error("The request was cancelled because the client disconnected.")
+    finally:
+        task.cancel()
+
+# Preprocessing of the upload input: the path of the file as received.
+# gr.Image.preprocess (Gradio 4.44) EXIF-rotates phone photos at full resolution
+# and, for type="filepath", re-encodes the result into its cache; ingest_image
+# does both at reduced size (JPEG draft decoding needs the original file).
+# Set on the instance: subclassing a Gradio component writes a .pyi stub.
+def upload_path(payload):
+    return None if payload is None else str(payload.path)
+
 # Function to classify waste and generate suggestions
-def waste_sorting(image, language):
-    # Classify the uploaded image
-    class_name, confidence = classify_image_with_trash_threshold(image)
+async def waste_sorting(image, language, threshold, request: gr.Request = None):
+    return await guarded(_waste_sorting(image, language, threshold), request)
+
+async def _waste_sorting(image, language, threshold):
+    # Decode at reduced resolution and classify the uploaded image
+    try:
+        with metrics.request("classify", sample_thread=False):
+            ingested = await run_in(cpu_executor, ingest_image, image)
+            result = await classify_image_async(ingested.model_image, inference_executor)
+            record_decision(result, threshold)
+    except (ImageRejectedError, SchedulerOverloadedError) as error:
+        raise gr.Error(str(error))
+    # Keep the result and a display-sized copy of the image in the session, so
+    # later changes only re-render and downloads never touch the full-size photo
+    return (result, ingested.display_image) + render_result(result, language, threshold)
+
+# Function to format a stored classification result; never calls the model
+def render_result(result, language, threshold):
+    if result is None:
+        # Nothing classified yet: leave the outputs unchanged
+        return (gr.update(),) * 5
+    class_name, confidence = result.decide(threshold)
     # Generate suggestions based on classification and language
     if language == "English":
         guidance = (f"Suggestion: Place {class_name} in the appropriate recycling bin. "
@@ -41,72 +155,107 @@ def waste_sorting(image, language):
         description = class_descriptions[language].get(
             class_name, "没有可用的描述。"
         )
+    # List the most probable classes so users can see the alternatives
+    top_predictions = "\n".join(
+        f"{name}: {probability:.2f}" for name, probability in result.top_k(3)
+    )
     # Set the color for the category and create styled HTML for display
     color = category_colors.get(class_name, "black")
     class_name_html = f"<div style='color: {color}; font-weight: bold;'>{class_name}</div>"
-    return class_name_html, guidance, confidence, description
+    return class_name_html, guidance, confidence, description, top_predictions
 
 # Function to create and save an annotated image
-def download_result(image, class_name, confidence, guidance):
+async def download_result(image, class_name, confidence, guidance, image_format="PNG",
+                          request: gr.Request = None):
+    if image is None:
+        raise gr.Error("Please classify an image first.")
     # Extract plain class name from styled HTML
     plain_class_name = class_name.split('>')[-2].split('<')[0].strip()
-    # Convert the input image to PIL format
-    annotated_image = Image.fromarray(image)
-    draw = ImageDraw.Draw(annotated_image)
+    with metrics.request("download", sample_thread=False):
+        return await guarded(run_in(cpu_executor, save_annotated_image, image,
+                                    plain_class_name, confidence, guidance, image_format),
+                             request)
+
+# Render the annotation on the display-sized image, encode it and save it to a
+# per-request file so concurrent users never overwrite each other's downloads
+def save_annotated_image(image, class_name, confidence, guidance, image_format):
+    data = annotate_image(image, class_name, confidence, guidance, image_format,
+                          font_size=40)
+    _, extension = format_info(image_format)
+    prune_downloads()
+    with tempfile.NamedTemporaryFile(prefix="classification_result_with_text_",
+                                     suffix=f".{extension}", dir=download_dir.name,
+                                     delete=False) as file:
+        file.write(data)
+    return file.name
 
-    # Prepare text for annotation
-    text = (f"Classification: {plain_class_name}\nConfidence: {confidence:.2f}\n"
-            f"{guidance}")
+# Delete downloads older than DOWNLOAD_TTL_S; Gradio copies each returned file
+# into its own cache when the response is sent, so only stale copies go
+def prune_downloads():
+    cutoff = time.time() - DOWNLOAD_TTL_S
+    with os.scandir(download_dir.name) as entries:
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass  # Pruned by a concurrent request
+
+# Function to classify every item in a cluttered image; works on the stored
+# display-sized image, so the upload is not decoded again
+async def detect_regions(image, threshold, request: gr.Request = None):
+    if image is None:
+        raise gr.Error("Please classify an image first.")
     try:
-        # Try to use Arial font; fallback to default if unavailable
-        font = ImageFont.truetype("/Library/Fonts/Arial.ttf", 40)
-    except IOError:
-        font = ImageFont.load_default()
-
-    # Break text into lines to fit within image width
-    max_width = annotated_image.width - 20
-    lines = []
-    line = ""
-    for word in text.split():
-        test_line = f"{line} {word}".strip()
-        if draw.textbbox((0, 0), test_line, font=font)[2] <= max_width:
-            line = test_line
-        else:
-            lines.append(line)
-            line = word
-    lines.append(line)
-
-    # Draw the lines of text on the image
-    y_text = 10
-    for line in lines:
-        draw.text((20, y_text), line, font=font, fill="red")
-        y_text += draw.textbbox((0, 0), line, font=font)[3] + 5
-
-    # Save the annotated image
-    output_path = "classification_result_with_text.png"
-    annotated_image.save(output_path)
-    return output_path
-
-# Function to handle feedback from users
-def submit_feedback(feedback_text):
-    # Record the current timestamp
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    feedback_entry = f"{timestamp} - Feedback: {feedback_text}\n"
-
-    # Save feedback to a text file
-    with open("user_feedback.txt", "a") as file:
-        file.write(feedback_entry)
+        with metrics.request("regions", sample_thread=False) as trace:
+            regions = await guarded(run_in(inference_executor, classify_regions, image,
+                                           threshold), request)
+            trace.annotate(regions=len(regions))
+            annotated = (await run_in(cpu_executor, draw_regions, image, regions)
+                         if regions else image)
+    except SchedulerOverloadedError as error:
+        raise gr.Error(str(error))
+    if not regions:
+        return image, "No item was classified confidently; try a lower threshold."
+    summary = "\n".join(
+        f"{region.class_name} ({region.confidence:.2f}) at {region.box}" for region in regions
+    )
+    return annotated, summary
+
+# Function to handle feedback from users; the log and correction index are
+# written off the event loop
+async def submit_feedback(feedback_text, corrected_label, result, threshold,
+                          request: gr.Request = None):
+    with metrics.request("feedback", sample_thread=False):
+        return await guarded(run_in(cpu_executor, _submit_feedback, feedback_text,
+                                    corrected_label, result, threshold), request)
+
+def _submit_feedback(feedback_text, corrected_label, result, threshold):
+    # Store the feedback with the classification it refers to
+    entry = feedback_entry(feedback_text, result, threshold, corrected_label,
+                           source="gradio")
+    if not get_feedback_store().submit(entry):
+        return "Please enter your feedback first (repeated submissions are ignored)."
+
+    # Remember the corrected label for this and very similar images
+    correction_note = ""
+    if corrected_label and result is not None:
+        try:
+            submit_correction(result, corrected_label)
+            correction_note = f" Similar images will now be classified as {corrected_label}."
+        except (RuntimeError, ValueError) as error:
+            correction_note = f" (The correction could not be applied: {error}.)"
 
     # Create a mailto link for sending feedback via email
     email = "wastesortingapp@gmail.com"
     subject = "User Feedback"
-    body = urllib.parse.quote(feedback_entry)
+    body = urllib.parse.quote(f"{entry['ts']} - Feedback: {entry['text']}\n")
     mailto_link = f"mailto:{email}?subject={subject}&body={body}"
 
     # Return a clickable HTML link for email feedback
     mailto_html = (f"<a href='{mailto_link}' target='_blank'>"
                    f"Click here to send feedback via email</a>")
-    return f"Thank you for your feedback! {mailto_html}"
+    return f"Thank you for your feedback!{correction_note} {mailto_html}"
 
 # Gradio interface setup
 with gr.Blocks() as iface:
@@ -137,8 +286,11 @@ with gr.Blocks() as iface:
     # Input section for image upload and language selection
     with gr.Row():
         with gr.Column(scale=1):
-            image_input = gr.Image(label="Upload Image")
+            image_input = gr.Image(label="Upload Image", type="filepath")
+            image_input.preprocess = upload_path
             language_radio = gr.Radio(["English", "Chinese"], label="Language", value="English")
+            threshold_slider = gr.Slider(minimum=0, maximum=1, step=0.05, value=0.7,
+                                         label="Confidence Threshold")
             waste_sort_button = gr.Button("Classify Waste")
 
         # Output section for results
@@ -148,32 +300,82 @@ with gr.Blocks() as iface:
             confidence_output = gr.Slider(minimum=0, maximum=1, step=0.01, 
                                            label="Confidence", interactive=False)
             description_output = gr.Textbox(label="Waste Description", interactive=False)
+            top_k_output = gr.Textbox(label="Top Predictions", interactive=False)
+            download_format = gr.Radio(list(FORMATS), label="Download Format", value="PNG")
             download_button = gr.Button("Download Result")
 
+    # Multi-item section for images that contain several pieces of waste
+    with gr.Row():
+        regions_button = gr.Button("Find Multiple Items")
+    with gr.Row():
+        regions_image = gr.Image(label="Detected Items", type="pil", interactive=False)
+        regions_output = gr.Textbox(label="Items", interactive=False)
+
     # Feedback section
     feedback_input = gr.Textbox(label="Feedback", 
                                 placeholder="Enter your feedback if classification is incorrect")
+    correction_input = gr.Dropdown(trash_classes, label="Correct Category (optional)")
     feedback_button = gr.Button("Submit Feedback")
     feedback_output = gr.HTML(label="Feedback Status")
 
+    # Last classification result and display image of this session
+    result_state = gr.State(None)
+    display_state = gr.State(None)
+    result_outputs = [class_name_output, guidance_output, confidence_output,
+                      description_output, top_k_output]
+
     # Link buttons to respective functions
     waste_sort_button.click(
         fn=waste_sorting,
-        inputs=[image_input, language_radio],
-        outputs=[class_name_output, guidance_output, confidence_output, description_output]
+        inputs=[image_input, language_radio, threshold_slider],
+        outputs=[result_state, display_state] + result_outputs,
+        # Let enough requests run at once for the scheduler to fill a batch
+        concurrency_limit=MAX_BATCH_SIZE
     )
 
+    # Language and threshold changes only re-render the stored result
+    for control in (language_radio, threshold_slider):
+        control.change(
+            fn=render_result,
+            inputs=[result_state, language_radio, threshold_slider],
+            outputs=result_outputs,
+            queue=False
+        )
+
     download_button.click(
         fn=download_result,
-        inputs=[image_input, class_name_output, confidence_output, guidance_output],
-        outputs=gr.File(label="Download Annotated Image")
+        inputs=[display_state, class_name_output, confidence_output, guidance_output,
+                download_format],
+        outputs=gr.File(label="Download Annotated Image"),
+        concurrency_limit=DOWNLOAD_CONCURRENCY
+    )
+
+    regions_button.click(
+        fn=detect_regions,
+        inputs=[display_state, threshold_slider],
+        outputs=[regions_image, regions_output],
+        concurrency_limit=REGIONS_CONCURRENCY
     )
 
     feedback_button.click(
         fn=submit_feedback,
-        inputs=feedback_input,
-        outputs=feedback_output
+        inputs=[feedback_input, correction_input, result_state, threshold_slider],
+        outputs=feedback_output,
+        concurrency_limit=CPU_WORKERS
     )
 
 # Launch the Gradio app
-iface.launch(share=True)
+if __name__ == "__main__":
+    # One intra-op thread pool for PyTorch, sized so that it does not compete
+    # with the decode and annotation threads
+    torch.set_num_threads(TORCH_THREADS)
+    # Load the model (or wait for the inference server) before accepting requests
+    warm_up()
+    if get_client() is None:
+        enable_batching(MAX_BATCH_SIZE, BATCH_WINDOW_MS, MAX_QUEUE_SIZE)
+    enable_result_cache()  # Repeated uploads skip the forward pass
+    enable_corrections()  # User-corrected labels override similar predictions
+    metrics.enable_metrics()  # Metrics endpoint, request logs and profiler, if configured
+    iface.queue(max_size=GRADIO_QUEUE_SIZE)  # Turn requests away once this many are waiting
+    iface.launch(share=True)
+
@@ -8,76 +8,31 @@
 # Additionally, users can submit feedback on the classification results, which can be saved locally or emailed.
 
 import streamlit as st
-from transformers import AutoImageProcessor, AutoModelForImageClassification
-from PIL import Image, ImageDraw, ImageFont
-import torch
-import io
-import datetime
+from model_inference import (
+    classify_image, class_descriptions, enable_corrections, enable_result_cache,
+    record_decision, submit_correction, trash_classes, warm_up
+)
+from image_ingest import ImageRejectedError, ingest_image
+from annotation import FORMATS, annotate_image, draw_regions, format_info
+from multi_region import classify_regions
+from feedback_store import feedback_entry, get_feedback_store
+import metrics
 import urllib.parse
 
-# Load model and image processor
-image_processor = AutoImageProcessor.from_pretrained(
-    "edwinpalegre/ee8225-group4-vit-trashnet-enhanced"
-)
-model = AutoModelForImageClassification.from_pretrained(
-    "edwinpalegre/ee8225-group4-vit-trashnet-enhanced"
-)
-# Classification labels and descriptions
-trash_classes = [
-    "biodegradable", "cardboard", "glass", "metal", "paper", "plastic", "trash"
-]
-class_descriptions = {
-    "English": {
-        "biodegradable": (
-            "Biodegradable waste such as food scraps and plant residues, "
-            "can decompose naturally in soil."
-        ),
-        "cardboard": (
-            "Cardboard waste like shipping boxes, can be recycled into new cardboard."
-        ),
-        "glass": (
-            "Glass waste can be placed in glass recycling bins for reuse."
-        ),
-        "metal": (
-            "Metal waste like cans and tins, can be recycled to create new metal products."
-        ),
-        "paper": (
-            "Paper waste, such as newspapers and office paper, "
-            "can be recycled into new paper products."
-        ),
-        "plastic": (
-            "Plastic waste should be disposed of in the plastic recycling bin, "
-            "if recyclable."
-        ),
-        "trash": (
-            "General waste that doesn't fit into other categories; "
-            "should be disposed of in regular waste bins."
-        )
-    },
-    "Chinese": {
-        "biodegradable": (
-            "可生物降解垃圾，如厨余和植物残渣，可以在土壤中自然分解。"
-        ),
-        "cardboard": (
-            "纸板废物，如快递盒，可以回收处理为新纸板。"
-        ),
-        "glass": (
-            "玻璃废物，可以放入玻璃回收箱，循环利用。"
-        ),
-        "metal": (
-            "金属废物如罐头，可以回收用来制造新金属产品。"
-        ),
-        "paper": (
-            "纸张废物，如报纸和办公用纸，可以回收成新纸制品。"
-        ),
-        "plastic": (
-            "塑料垃圾应放入塑料回收箱（如可回收）。"
-        ),
-        "trash": (
-            "不属于其他类别的一般废物，应放入普通垃圾箱。"
-        )
-    }
-}
+
+# Load the shared inference engine (or connect to the inference server set by
+# WASTE_INFERENCE_URL) once per process. Streamlit re-executes this script on
+# every interaction, so the cached engine keeps reruns and sessions from
+# reloading the model weights.
+@st.cache_resource(show_spinner="Loading classification model...")
+def load_engine():
+    enable_result_cache()  # Repeated uploads skip the forward pass
+    enable_corrections()  # User-corrected labels override similar predictions
+    metrics.enable_metrics()  # Metrics endpoint, request logs and profiler, if configured
+    return warm_up()
+
+
+load_engine()
 
 # Color mapping for categories
 category_colors = {
@@ -90,77 +45,6 @@ category_colors = {
     "cardboard": "blue"
 }
 
-# Preprocess the uploaded image for the model
-def preprocess_image(image):
-    if image.mode != "RGB":  # Ensure the image is in RGB format
-        image = image.convert("RGB")
-    # Convert image to model input
-    inputs = image_processor(images=image, return_tensors="pt")  
-    return inputs
-
-# Classify the image and handle low-confidence predictions
-def classify_image_with_trash_threshold(image, threshold=0.7):
-    inputs = preprocess_image(image)  # Preprocess the image
-    with torch.no_grad():  # Disable gradient calculations for inference
-        outputs = model(**inputs)  # Get model predictions
-        logits = outputs.logits
-        probabilities = torch.softmax(logits, dim=1)[0]  # Calculate probabilities
-        predicted_class = probabilities.argmax().item()  # Get the class with the highest probability
-        confidence = probabilities[predicted_class].item()  # Confidence of the prediction
-
-    # Assign "trash" if confidence is below the threshold
-    if confidence < threshold:
-        class_name = "trash"
-        confidence = threshold
-    else:
-        class_name = trash_classes[predicted_class]
-
-    return class_name, confidence
-
-# Annotate the image with classification results
-def annotate_image(image, class_name, confidence, guidance):
-    annotated_image = image.copy()  # Create a copy of the image
-    draw = ImageDraw.Draw(annotated_image)  # Initialize drawing context
-    text = (
-        f"Classification: {class_name}\n"
-        f"Confidence: {confidence:.2f}\n"
-        f"{guidance}"
-    )  # Annotation text
-
-    try:
-        # Load a font for the annotation text
-        font = ImageFont.truetype("/Library/Fonts/Arial.ttf", 30)
-    except IOError:
-        # Fallback to default font if Arial is unavailable
-        font = ImageFont.load_default()
-
-    # Break text into lines to fit within the image width
-    max_width = annotated_image.width - 20
-    lines = []
-    line = ""
-    for word in text.split():
-        test_line = f"{line} {word}".strip()
-        text_width = draw.textbbox((0, 0), test_line, font=font)[2]
-        if text_width <= max_width:
-            line = test_line
-        else:
-            lines.append(line)
-            line = word
-    lines.append(line)
-
-    # Draw each line of text on the image
-    y_text = 10
-    for line in lines:
-        draw.text((10, y_text), line, fill="red", font=font)  # Add red text to the image
-        y_text += draw.textbbox((0, 0), line, font=font)[3] + 5
-
-    # Save the annotated image in memory as a PNG
-    img_byte_arr = io.BytesIO()
-    annotated_image.save(img_byte_arr, format="PNG")
-    img_byte_arr = img_byte_arr.getvalue()
-
-    return img_byte_arr
-
 # CSS for styling the Streamlit app
 st.markdown(
     """
@@ -242,14 +126,31 @@ with col1:
     
 with col2:
     language = st.radio("Select language", ("English", "Chinese"))
+    threshold = st.slider("Confidence threshold", 0.0, 1.0, 0.7, 0.05)
 
 # Display the classification result
 if uploaded_image:
-    image = Image.open(uploaded_image)  # Open the uploaded image
+    # Classify only when a new file is uploaded. Reruns caused by the language,
+    # threshold or feedback widgets re-render the result stored in the session.
+    if st.session_state.get("image_id") != uploaded_image.file_id:
+        st.session_state.image_id = None
+        try:
+            with metrics.request("classify"):
+                # Decode at reduced resolution; only a display thumbnail is kept
+                ingested = ingest_image(uploaded_image)
+                result = classify_image(ingested.model_image)  # Perform classification
+                record_decision(result, threshold)
+        except ImageRejectedError as error:
+            st.error(str(error))
+            st.stop()
+        st.session_state.image = ingested.display_image
+        st.session_state.result = result
+        st.session_state.image_id = uploaded_image.file_id
+    image = st.session_state.image
+    result = st.session_state.result
     st.image(image, caption="Uploaded Image", use_column_width=True)  # Show the uploaded image
 
-    # Perform classification
-    class_name, confidence = classify_image_with_trash_threshold(image)
+    class_name, confidence = result.decide(threshold)
     description = class_descriptions[language].get(class_name, "No description available.")  # Get description
     color = category_colors.get(class_name, "black")  # Get category color
 
@@ -258,39 +159,83 @@ if uploaded_image:
                 f"<p>Confidence: {confidence:.2f}</p>"
                 f"<p>Description: {description}</p></div>", unsafe_allow_html=True)
 
+    # Show the most probable classes so users can see the alternatives
+    top_predictions = ", ".join(
+        f"{name} ({probability:.2f})" for name, probability in result.top_k(3)
+    )
+    st.caption(f"Top predictions: {top_predictions}")
+
     # Annotate the image and allow download
     guidance = (
         f"Suggestion: Place {class_name} in the appropriate recycling bin."
         if language == "English"
         else f"建议：将 {class_name} 放入对应的回收箱。"
     )
-    img_byte_arr = annotate_image(image, class_name, confidence, guidance)
+    image_format = st.radio("Download format", list(FORMATS), horizontal=True)
+    # The annotated image is only rendered when requested, and the bytes are
+    # kept until the result, language or format changes
+    download_key = (st.session_state.image_id, class_name, f"{confidence:.2f}",
+                    guidance, image_format)
+    if st.button("Prepare Annotated Image"):
+        with metrics.request("download"):
+            img_byte_arr = annotate_image(image, class_name, confidence, guidance, image_format)
+        st.session_state.download = (download_key, img_byte_arr)
+    download = st.session_state.get("download")
+    if download is not None and download[0] == download_key:
+        mime, extension = format_info(image_format)
+        st.download_button(
+            label="Download Annotated Image",
+            data=download[1],
+            file_name=f"classification_result.{extension}",
+            mime=mime
+        )
 
-    st.download_button(
-        label="Download Annotated Image",
-        data=img_byte_arr,
-        file_name="classification_result.png",
-        mime="image/png"
-    )
+    # Optionally classify every item in a cluttered image (one batched forward
+    # pass over crops of the stored display image)
+    if st.checkbox("Find multiple items in this image"):
+        regions_key = (st.session_state.image_id, threshold)
+        if st.session_state.get("regions", (None,))[0] != regions_key:
+            with metrics.request("regions") as trace:
+                regions = classify_regions(image, threshold)
+                trace.annotate(regions=len(regions))
+                annotated = draw_regions(image, regions) if regions else None
+            st.session_state.regions = (regions_key, regions, annotated)
+        _, regions, annotated = st.session_state.regions
+        if regions:
+            st.image(annotated, caption="Detected Items", use_column_width=True)
+            for region in regions:
+                st.write(f"{region.class_name} ({region.confidence:.2f})")
+        else:
+            st.info("No item was classified confidently; try a lower threshold.")
 
 # Feedback section
 st.markdown("<div class='feedback-box'><h4>Feedback</h4></div>", unsafe_allow_html=True)
 feedback = st.text_input("Provide feedback if classification was incorrect:")
+corrected_label = st.selectbox("Correct category (optional)", [""] + trash_classes)
 
 # Handle feedback submission
 if st.button("Submit Feedback"):
-    feedback_entry = (
-        f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - "
-        f"Feedback: {feedback}\n"
-    )
-    # Save feedback locally
-    with open("user_feedback.txt", "a") as file:
-        file.write(feedback_entry)
-    
+    # Store the feedback with the classification it refers to
+    result = st.session_state.get("result") if uploaded_image else None
+    entry = feedback_entry(feedback, result, threshold, corrected_label, source="streamlit")
+    with metrics.request("feedback"):
+        accepted = get_feedback_store().submit(entry)
+    if not accepted:
+        st.warning("Please enter your feedback first (repeated submissions are ignored).")
+        st.stop()
+
+    # Remember the corrected label for this and very similar images
+    if corrected_label and result is not None:
+        try:
+            submit_correction(result, corrected_label)
+            st.info(f"Similar images will now be classified as {corrected_label}.")
+        except (RuntimeError, ValueError) as error:
+            st.warning(f"The correction could not be applied: {error}")
+
     # Create a mailto link for feedback
     email = "wastesortingapp@gmail.com"
     subject = "Feedback"
-    body = urllib.parse.quote(feedback_entry)  # URL-encode feedback
+    body = urllib.parse.quote(f"{entry['ts']} - Feedback: {entry['text']}\n")  # URL-encode feedback
     mailto_link = f"mailto:{email}?subject={subject}&body={body}"
     
     # Show feedback success message and email link
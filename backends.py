@@ -0,0 +1,297 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 16 2026
+# This file implements the selectable CPU execution backends of the inference engine:
+#   eager   - float32 PyTorch module (reference)
+#   int8    - dynamically-quantized INT8 linear layers
+#   bf16    - bfloat16 autocast
+#   compile - torch.compile'd module
+#   onnx    - exported ONNX graph run with ONNX Runtime
+# Quantized weights and ONNX graphs are cached under a local artifact directory and
+# reused on the next start, keyed on a hash of the source weights and the installed
+# torch and transformers versions, so a changed checkpoint or an upgrade rebuilds
+# them. It also provides an agreement check that compares the labels and
+# probabilities of a backend against float32 eager on a folder of images.
+#
+# Example:
+#   python backends.py test_picture --backend int8 onnx
+
+from transformers import AutoConfig, AutoModelForImageClassification
+from transformers.utils import cached_file
+from PIL import Image
+import model_snapshot
+import argparse
+import hashlib
+import json
+import os
+import time
+import torch
+import transformers
+
+BACKENDS = ("eager", "int8", "bf16", "compile", "onnx")
+
+# Where quantized weights and ONNX graphs are cached
+ARTIFACT_DIR = os.environ.get(
+    "WASTE_ARTIFACT_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "waste_sorting_app"),
+)
+
+
+# Per-model artifact directory, e.g. ~/.cache/waste_sorting_app/<model-name>
+def artifact_dir(model_name, cache_dir=ARTIFACT_DIR):
+    slug = model_name.strip("/").replace("/", "--")
+    path = os.path.join(cache_dir, slug)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+# Local paths of a model's config and weight files, sorted. Hub ids resolve to
+# the files already downloaded into the Hugging Face cache.
+def source_files(model_name):
+    if os.path.isdir(model_name):
+        return sorted(
+            os.path.join(model_name, name) for name in os.listdir(model_name)
+            if name == "config.json" or name.endswith((".safetensors", ".bin", ".index.json"))
+        )
+    names = ["config.json", "model.safetensors", "pytorch_model.bin",
+             "model.safetensors.index.json", "pytorch_model.bin.index.json"]
+    paths = set()
+    while names:
+        path = cached_file(model_name, names.pop(), _raise_exceptions_for_missing_entries=False,
+                           _raise_exceptions_for_connection_errors=False)
+        if path is None or path in paths:
+            continue
+        paths.add(path)
+        if path.endswith(".index.json"):
+            with open(path, encoding="utf-8") as file:
+                names.extend(set(json.load(file)["weight_map"].values()))  # Shards
+    return sorted(paths)
+
+
+# SHA-256 of a model's config and weight files. The digest is remembered with
+# the files' sizes and modification times, so the files are only read again
+# when one of them changed.
+def weights_fingerprint(model_name, cache_dir=ARTIFACT_DIR):
+    files = source_files(model_name)
+    stats = [[os.path.basename(path), os.stat(path).st_size, os.stat(path).st_mtime_ns]
+             for path in files]
+    record_path = os.path.join(artifact_dir(model_name, cache_dir), "fingerprint.json")
+    try:
+        with open(record_path, encoding="utf-8") as file:
+            record = json.load(file)
+        if record["files"] == stats:
+            return record["sha256"]
+    except (OSError, ValueError, KeyError):
+        pass
+    digest = hashlib.sha256()
+    for path in files:
+        digest.update(os.path.basename(path).encode("utf-8"))
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+    record = {"files": stats, "sha256": digest.hexdigest()}
+    temp_path = f"{record_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(record, file)
+    os.replace(temp_path, record_path)
+    return record["sha256"]
+
+
+# Directory for artifacts built from the current weights with the installed
+# torch and transformers, e.g. <artifact dir>/<model-name>/<build key>. A
+# changed checkpoint or a library upgrade gets a new directory, so stale
+# quantized weights, ONNX graphs, cascades or calibrations are never loaded.
+def build_dir(model_name, cache_dir=ARTIFACT_DIR):
+    manifest = {
+        "weights_sha256": weights_fingerprint(model_name, cache_dir),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+    }
+    key = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(artifact_dir(model_name, cache_dir), key)
+    if not os.path.exists(os.path.join(path, "manifest.json")):
+        os.makedirs(path, exist_ok=True)
+        temp_path = os.path.join(path, f"manifest.json.{os.getpid()}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(dict(manifest, source=model_name), file, indent=2)
+        os.replace(temp_path, os.path.join(path, "manifest.json"))
+    return path
+
+
+# Load the model for `backend` and return (model, forward, report), where
+# forward(pixel_values) returns float32 logits and report describes the load.
+# Snapshot directories (see model_snapshot.py) are loaded memory-mapped.
+def load_backend(model_name, backend="eager", cache_dir=ARTIFACT_DIR):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}; choose one of {', '.join(BACKENDS)}")
+    start = time.perf_counter()
+    report = {"source": model_name, "backend": backend, "mmap": False}
+    if backend == "int8":
+        model = _load_int8(model_name, cache_dir)
+    elif model_snapshot.is_snapshot(model_name):
+        model, snapshot_report = model_snapshot.load_snapshot_model(model_name)
+        report.update(snapshot_report)
+    else:
+        model = AutoModelForImageClassification.from_pretrained(model_name)
+    model.eval()  # Inference only: disable dropout
+    model_loaded = time.perf_counter()
+    report["model_s"] = round(model_loaded - start, 4)
+
+    if backend == "onnx":
+        forward = _onnx_forward(model, model_name, cache_dir)
+    elif backend == "compile":
+        forward = _module_forward(torch.compile(model))
+    elif backend == "bf16":
+        forward = _module_forward(model, autocast_dtype=torch.bfloat16)
+    else:
+        forward = _module_forward(model)
+    report["backend_s"] = round(time.perf_counter() - model_loaded, 4)
+    return model, forward, report
+
+
+# Wrap a PyTorch module as forward(pixel_values) -> float32 logits
+def _module_forward(module, autocast_dtype=None):
+    def forward(pixel_values):
+        with torch.no_grad():
+            if autocast_dtype is None:
+                return module(pixel_values=pixel_values).logits
+            with torch.autocast(device_type="cpu", dtype=autocast_dtype):
+                return module(pixel_values=pixel_values).logits.float()
+
+    return forward
+
+
+# Quantize every nn.Linear to INT8 (weights) with dynamic activation scaling.
+# The quantized state dict is cached, so later starts build the model skeleton
+# from its config and never read the float32 weights. It holds only tensors,
+# so it is loaded with weights_only=True (no arbitrary unpickling).
+def _load_int8(model_name, cache_dir):
+    path = os.path.join(build_dir(model_name, cache_dir), "int8_state_dict.pt")
+    if os.path.exists(path):
+        config = AutoConfig.from_pretrained(model_name)
+        model = AutoModelForImageClassification.from_config(config)
+        torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+        model.load_state_dict(torch.load(path, weights_only=True))
+        return model
+
+    model = AutoModelForImageClassification.from_pretrained(model_name)
+    model.eval()
+    torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(model.state_dict(), temp_path)
+    os.replace(temp_path, path)
+    return model
+
+
+# Export the model to ONNX once (with a dynamic batch dimension) and run it
+# with ONNX Runtime
+def _onnx_forward(model, model_name, cache_dir):
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError(
+            "The onnx backend needs ONNX Runtime: pip install onnx onnxruntime"
+        ) from None
+
+    path = os.path.join(build_dir(model_name, cache_dir), "model.onnx")
+    if not os.path.exists(path):
+        size = model.config.image_size
+        dummy = torch.zeros(1, model.config.num_channels, size, size)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with torch.no_grad():
+            torch.onnx.export(
+                model, (dummy,), temp_path,
+                input_names=["pixel_values"],
+                output_names=["logits"],
+                dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}},
+                opset_version=17,
+                dynamo=False,
+            )
+        os.replace(temp_path, path)
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = torch.get_num_threads()
+    session = onnxruntime.InferenceSession(
+        path, options, providers=["CPUExecutionProvider"]
+    )
+
+    def forward(pixel_values):
+        (logits,) = session.run(["logits"], {"pixel_values": pixel_values.numpy()})
+        return torch.from_numpy(logits)
+
+    return forward
+
+
+# Load every image in a folder as RGB (sorted, non-recursive)
+def load_folder_images(folder):
+    images = []
+    for name in sorted(os.listdir(folder)):
+        if name.lower().endswith((".jpg", ".jpeg", ".png", ".bmp", ".webp")):
+            with Image.open(os.path.join(folder, name)) as image:
+                images.append(image.convert("RGB"))
+    if not images:
+        raise ValueError(f"No images found in {folder}")
+    return images
+
+
+# Compare an engine's predictions with a float32 eager reference engine:
+# label agreement (after the trash threshold), max probability drift and
+# mean forward latency of both
+def agreement_report(engine, reference, images, threshold=0.7):
+    import model_inference
+
+    pixel_values = engine.preprocess(images)
+    timings = {}
+    probabilities = {}
+    labels = {}
+    for name, candidate in (("reference", reference), ("candidate", engine)):
+        candidate.forward_logits(pixel_values[:1])  # Warm up
+        start = time.perf_counter()
+        logits = torch.cat([candidate.forward_logits(pixel_values[index:index + 1])
+                            for index in range(len(images))])
+        timings[name] = (time.perf_counter() - start) / len(images) * 1000
+        probabilities[name] = torch.softmax(logits.float(), dim=-1)
+        labels[name] = [class_name for class_name, _ in
+                        model_inference.apply_trash_threshold_batch(logits, threshold)]
+
+    agreements = [a == b for a, b in zip(labels["reference"], labels["candidate"])]
+    drift = (probabilities["candidate"] - probabilities["reference"]).abs()
+    return {
+        "backend": engine.backend,
+        "images": len(images),
+        "label_agreement": sum(agreements) / len(agreements),
+        "disagreements": [index for index, agree in enumerate(agreements) if not agree],
+        "max_probability_drift": round(drift.max().item(), 6),
+        "reference_ms_per_image": round(timings["reference"], 3),
+        "candidate_ms_per_image": round(timings["candidate"], 3),
+        "speedup": round(timings["reference"] / timings["candidate"], 3),
+    }
+
+
+def main(argv=None):
+    import model_inference
+
+    parser = argparse.ArgumentParser(
+        description="Check that accelerated backends agree with float32 eager."
+    )
+    parser.add_argument("folder", help="Folder of validation images")
+    parser.add_argument("--backend", nargs="+", default=["int8", "bf16", "onnx"],
+                        choices=BACKENDS)
+    parser.add_argument("--model", default=model_inference.MODEL_NAME)
+    parser.add_argument("--threshold", type=float, default=0.7)
+    args = parser.parse_args(argv)
+
+    images = load_folder_images(args.folder)
+    reference = model_inference.InferenceEngine(args.model, backend="eager", token_merging=0)
+    for backend in args.backend:
+        engine = model_inference.InferenceEngine(args.model, backend=backend)
+        print(json.dumps(agreement_report(engine, reference, images, args.threshold)))
+
+
+if __name__ == "__main__":
+    main()
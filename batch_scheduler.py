@@ -0,0 +1,149 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 16 2026
+# This file implements an in-process dynamic micro-batching scheduler.
+# Concurrent callers submit single items; a background thread collects them for
+# up to a short time window (or until the batch is full), runs one batched call,
+# and hands every caller back its own result through a Future.
+# The pending queue is bounded so that overload is reported instead of piling up.
+
+from concurrent.futures import Future
+import queue
+import threading
+import time
+
+_STOP = object()  # Sentinel that tells the worker thread to exit
+
+
+# Raised when the pending-request queue is full
+class SchedulerOverloadedError(RuntimeError):
+    pass
+
+
+# Raised for requests submitted after close(), or still queued when the worker
+# stopped; an overload error so frontends report it the same way
+class SchedulerClosedError(SchedulerOverloadedError):
+    pass
+
+
+# Collects concurrent requests into batches for a single batched function call.
+# `run_batch` receives a list of items and must return one result per item.
+class MicroBatchScheduler:
+    def __init__(self, run_batch, max_batch_size=8, window_ms=10, max_queue_size=64,
+                 name="micro-batcher"):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000.0
+        self.max_queue_size = max_queue_size
+        self.batches_run = 0
+        self.items_run = 0
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._closed = False
+        self._stop_queued = False
+        self._submit_lock = threading.Lock()  # Orders submit() against close()
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    # Number of requests waiting to be batched
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    # Average number of items per executed batch
+    @property
+    def mean_batch_size(self):
+        return self.items_run / self.batches_run if self.batches_run else 0.0
+
+    # Enqueue one item and return a Future for its result
+    def submit(self, item):
+        future = Future()
+        try:
+            with self._submit_lock:
+                if self._closed:
+                    raise SchedulerClosedError("The classifier is shutting down.")
+                self._queue.put_nowait((item, future))
+        except queue.Full:
+            raise SchedulerOverloadedError(
+                f"The classifier is overloaded ({self.max_queue_size} requests "
+                f"already waiting). Please try again in a moment."
+            ) from None
+        return future
+
+    # Submit one item and block until its result is ready
+    def __call__(self, item, timeout=None):
+        return self.submit(item).result(timeout=timeout)
+
+    # Stop the worker thread after the requests already queued have been served.
+    # Later submits raise SchedulerClosedError; if the worker exits with requests
+    # still queued (e.g. run_batch killed it), they fail with it too.
+    def close(self, timeout=None):
+        with self._submit_lock:
+            self._closed = True
+        if not self._stop_queued:
+            try:
+                self._queue.put(_STOP, timeout=timeout)  # Waits for room in a full queue
+                self._stop_queued = True
+            except queue.Full:
+                pass  # Retried by the next close()
+        self._thread.join(timeout)
+        if not self._thread.is_alive():
+            self._fail_pending()
+
+    # Fail every request left in the queue once the worker has exited
+    def _fail_pending(self):
+        while True:
+            try:
+                entry = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if entry is not _STOP and entry[1].set_running_or_notify_cancel():
+                entry[1].set_exception(
+                    SchedulerClosedError("The classifier shut down before this request ran.")
+                )
+
+    # Worker loop: wait for a first request, then fill the batch until the
+    # window closes or the batch is full
+    def _loop(self):
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+            batch = [first]
+            stop = False
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    entry = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if entry is _STOP:
+                    stop = True
+                    break
+                batch.append(entry)
+            self._run(batch)
+            if stop:
+                return
+
+    # Execute one batch and distribute results (or the error) to the callers
+    def _run(self, batch):
+        # Drop requests whose callers have already given up
+        batch = [(item, future) for item, future in batch
+                 if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            results = self.run_batch([item for item, _ in batch])
+        except BaseException as error:
+            for _, future in batch:
+                future.set_exception(error)
+            return
+        self.batches_run += 1
+        self.items_run += len(batch)
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
@@ -0,0 +1,264 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 16 2026
+# This file implements a reproducible latency/throughput benchmark for the classifier.
+# It measures cold start (import plus model load), single-image latency percentiles
+# broken down by stage (decode, preprocess, forward, softmax/threshold, annotation),
+# forward-pass throughput across batch sizes and torch thread counts, and peak RSS.
+# Results are written as JSON and can be compared against a stored baseline; the
+# script exits with status 1 when any metric regresses beyond the allowed threshold.
+#
+# Examples:
+#   python benchmark.py --tiny-model /tmp/tiny-vit --output bench.json
+#   python benchmark.py --output new.json --baseline bench.json --max-regression 0.10
+
+from annotation import annotate_image
+from image_ingest import ingest_image
+from PIL import Image
+import model_inference
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import torch
+
+IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_picture")
+
+
+# Percentile summary (in milliseconds) of a list of durations in seconds
+def summarize(durations):
+    values = sorted(duration * 1000 for duration in durations)
+    if not values:
+        return {}
+
+    def percentile(fraction):
+        return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+    return {
+        "p50_ms": round(percentile(0.50), 3),
+        "p90_ms": round(percentile(0.90), 3),
+        "p99_ms": round(percentile(0.99), 3),
+        "mean_ms": round(sum(values) / len(values), 3),
+    }
+
+
+# Peak resident set size of this process in megabytes
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+# Read the raw bytes of every benchmark image once, so decoding is measured
+# without disk I/O
+def load_image_bytes(image_dir):
+    images = []
+    for name in sorted(os.listdir(image_dir)):
+        if name.lower().endswith((".jpg", ".jpeg", ".png")):
+            with open(os.path.join(image_dir, name), "rb") as file:
+                images.append((name, file.read()))
+    if not images:
+        raise SystemExit(f"No .jpg/.jpeg/.png images found in {image_dir}")
+    return images
+
+
+# Time importing model_inference and loading the model in a fresh interpreter
+def measure_cold_start(model_name):
+    script = (
+        "import json, time\n"
+        "start = time.perf_counter()\n"
+        "import model_inference\n"
+        "imported = time.perf_counter()\n"
+        "model_inference.get_engine().load()\n"
+        "loaded = time.perf_counter()\n"
+        "print(json.dumps({'import_s': imported - start, 'load_s': loaded - imported}))\n"
+    )
+    environment = dict(os.environ, WASTE_MODEL_NAME=model_name)
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=environment,
+    )
+    total = time.perf_counter() - start
+    timings = json.loads(completed.stdout.strip().splitlines()[-1])
+    return {
+        "import_s": round(timings["import_s"], 4),
+        "load_s": round(timings["load_s"], 4),
+        "total_s": round(total, 4),
+    }
+
+
+# Run every image through the full single-image pipeline `iterations` times,
+# timing each stage separately
+def measure_latency(images, iterations, threshold):
+    engine = model_inference.get_engine()
+    stages = {name: [] for name in ("decode", "preprocess", "forward", "postprocess",
+                                    "annotate", "total")}
+    for iteration in range(iterations):
+        _, data = images[iteration % len(images)]
+        start = time.perf_counter()
+        ingested = ingest_image(data)  # Reduced-resolution decode, as in the apps
+        decoded = time.perf_counter()
+        pixel_values = engine.preprocess([ingested.model_image])
+        preprocessed = time.perf_counter()
+        logits = engine.forward_logits(pixel_values)
+        forwarded = time.perf_counter()
+        class_name, confidence = model_inference.apply_trash_threshold_batch(
+            logits, threshold
+        )[0]
+        postprocessed = time.perf_counter()
+        annotate_image(ingested.display_image, class_name, confidence,
+                       f"Suggestion: Place {class_name} in the appropriate recycling bin.")
+        annotated = time.perf_counter()
+
+        stages["decode"].append(decoded - start)
+        stages["preprocess"].append(preprocessed - decoded)
+        stages["forward"].append(forwarded - preprocessed)
+        stages["postprocess"].append(postprocessed - forwarded)
+        stages["annotate"].append(annotated - postprocessed)
+        stages["total"].append(annotated - start)
+    return {name: summarize(durations) for name, durations in stages.items() if durations}
+
+
+# Forward-pass throughput (images/s) for every thread count and batch size
+def measure_throughput(images, batch_sizes, thread_counts, seconds):
+    engine = model_inference.get_engine()
+    decoded = [Image.open(io.BytesIO(data)).convert("RGB") for _, data in images]
+    original_threads = torch.get_num_threads()
+    results = []
+    try:
+        for threads in thread_counts:
+            torch.set_num_threads(threads)
+            for batch_size in batch_sizes:
+                batch = [decoded[index % len(decoded)] for index in range(batch_size)]
+                pixel_values = engine.preprocess(batch)
+                engine.forward_logits(pixel_values)  # Warm up this shape
+                count = 0
+                start = time.perf_counter()
+                while time.perf_counter() - start < seconds:
+                    engine.forward_logits(pixel_values)
+                    count += batch_size
+                elapsed = time.perf_counter() - start
+                results.append({
+                    "threads": threads,
+                    "batch_size": batch_size,
+                    "images_per_s": round(count / elapsed, 2),
+                })
+    finally:
+        torch.set_num_threads(original_threads)
+    return results
+
+
+# Flatten a report into {metric: (value, higher_is_better)} for comparisons
+def comparable_metrics(report):
+    metrics = {"cold_start.total_s": (report["cold_start"]["total_s"], False)}
+    for stage, summary in report["latency"].items():
+        for key in ("p50_ms", "p99_ms"):
+            metrics[f"latency.{stage}.{key}"] = (summary[key], False)
+    for entry in report["throughput"]:
+        name = f"throughput.t{entry['threads']}.b{entry['batch_size']}"
+        metrics[name] = (entry["images_per_s"], True)
+    metrics["peak_rss_mb"] = (report["peak_rss_mb"], False)
+    return metrics
+
+
+# List metrics that got worse than the baseline by more than `max_regression`
+def find_regressions(report, baseline, max_regression):
+    current = comparable_metrics(report)
+    previous = comparable_metrics(baseline)
+    regressions = []
+    for name, (value, higher_is_better) in current.items():
+        if name not in previous:
+            continue
+        old_value = previous[name][0]
+        if not old_value:
+            continue
+        # Sub-millisecond jitter in fast stages is noise, not a regression
+        if name.startswith("latency.") and abs(value - old_value) < 1.0:
+            continue
+        change = (value - old_value) / old_value
+        if higher_is_better:
+            change = -change
+        if change > max_regression:
+            regressions.append(f"{name}: {old_value} -> {value} ({change:+.1%} worse)")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the waste classifier.")
+    parser.add_argument("--images", default=IMAGE_DIR, help="Folder of benchmark images")
+    parser.add_argument("--model", default=model_inference.MODEL_NAME,
+                        help="Model id or local model directory")
+    parser.add_argument("--tiny-model", metavar="DIR",
+                        help="Create (if needed) and benchmark a tiny random ViT in DIR")
+    parser.add_argument("--iterations", type=int, default=50,
+                        help="Single-image requests used for latency percentiles")
+    parser.add_argument("--batch-sizes", default="1,4,8,16")
+    parser.add_argument("--threads", default=f"1,{torch.get_num_threads()}")
+    parser.add_argument("--seconds", type=float, default=2.0,
+                        help="Measurement time per throughput configuration")
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="Earlier results file to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.10,
+                        help="Allowed relative slowdown before failing (0.10 = 10%%)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    model_name = args.model
+    if args.tiny_model:
+        if not os.path.exists(os.path.join(args.tiny_model, "config.json")):
+            model_inference.save_tiny_model(args.tiny_model)
+        model_name = args.tiny_model
+    torch.manual_seed(args.seed)
+
+    images = load_image_bytes(args.images)
+    cold_start = measure_cold_start(model_name)
+    model_inference.set_engine(model_inference.InferenceEngine(model_name)).warm_up()
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "model": model_name,
+            "images": len(images),
+        },
+        "cold_start": cold_start,
+        "latency": measure_latency(images, args.iterations, args.threshold),
+        "throughput": measure_throughput(
+            images,
+            [int(value) for value in args.batch_sizes.split(",")],
+            [int(value) for value in args.threads.split(",")],
+            args.seconds,
+        ),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+        regressions = find_regressions(report, baseline, args.max_regression)
+        if regressions:
+            print("Regressions beyond threshold:", file=sys.stderr)
+            for line in regressions:
+                print(f"  {line}", file=sys.stderr)
+            sys.exit(1)
+        print("No regressions beyond threshold.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 17 2026
+# This file implements probability calibration for the classifier's post-processing.
+# A temperature is fitted on a labelled folder (folder/<class>/<image>) so the softmax
+# confidences match how often the model is right, and a threshold is calibrated
+# per class: the lowest confidence at which predictions of that class reach the
+# target precision. Classes with too few examples keep the global threshold, and
+# a calibrated threshold only ever raises the global (slider) threshold.
+# Both are applied to whole batches of logits with a single softmax (see
+# postprocess_logits in model_inference.py), so enabling calibration adds no
+# forward passes.
+#
+# Example:
+#   python calibration.py calibrate labelled_pictures --target 0.9
+#   python calibration.py report labelled_pictures
+#   WASTE_CALIBRATION=1 streamlit run app_streamlit.py
+
+from classify_cli import iter_image_paths
+from image_ingest import ingest_image
+import backends
+import argparse
+import json
+import math
+import os
+import torch
+
+
+class Calibration:
+    def __init__(self, temperature=1.0, thresholds=None):
+        self.temperature = float(temperature)
+        # Per-class thresholds; NaN where the global threshold applies
+        self.thresholds = None if thresholds is None else torch.tensor(
+            [math.nan if value is None else value for value in thresholds], dtype=torch.float32
+        )
+
+    # Calibrated probabilities of a batch of logits (one softmax)
+    def probabilities(self, logits):
+        return torch.softmax(logits.float() / self.temperature, dim=-1)
+
+    # Threshold of every class: the larger of `threshold` and the calibrated
+    # one, so the user's threshold stays a floor
+    def class_thresholds(self, threshold, num_classes):
+        default = torch.full((num_classes,), float(threshold))
+        if self.thresholds is None:
+            return default
+        return torch.where(torch.isnan(self.thresholds), default,
+                           torch.maximum(default, self.thresholds))
+
+    def state(self):
+        return {
+            "temperature": self.temperature,
+            "thresholds": None if self.thresholds is None else [
+                None if math.isnan(value) else value for value in self.thresholds.tolist()
+            ],
+        }
+
+
+# Where the calibration of a model is stored: in the build directory of its
+# weights and library versions, named after the backend, token-merging ratio
+# and cascade that produced the logits it was fitted on
+def calibration_path(model_name, backend="eager", cascade=False, token_merging=0,
+                     cache_dir=backends.ARTIFACT_DIR):
+    name = f"calibration-{backend}"
+    if token_merging:
+        name += f"-merge{token_merging:g}"
+    if cascade:
+        name += "-cascade"
+    return os.path.join(backends.build_dir(model_name, cache_dir), f"{name}.json")
+
+
+# calibration_path() of the configuration an engine runs
+def engine_calibration_path(engine):
+    return calibration_path(engine.model_name, engine.backend, engine.cascade is not None,
+                            engine.token_merging, engine.artifact_dir)
+
+
+def save_calibration(calibration, path):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(calibration.state(), file, indent=2)
+    os.replace(temp_path, path)
+
+
+def load_calibration(path):
+    with open(path, encoding="utf-8") as file:
+        state = json.load(file)
+    return Calibration(state["temperature"], state.get("thresholds"))
+
+
+# Decode the images of a labelled folder (one subfolder per class, searched
+# recursively) at model resolution; returns (images, label indices)
+def load_labelled_images(folder, labels):
+    images = []
+    targets = []
+    for name in sorted(os.listdir(folder)):
+        if not os.path.isdir(os.path.join(folder, name)):
+            continue
+        if name not in labels:
+            raise ValueError(f"Unknown class folder {name!r}; expected one of {', '.join(labels)}")
+        for path in iter_image_paths([os.path.join(folder, name)]):
+            images.append(ingest_image(path).model_image)
+            targets.append(labels.index(name))
+    if not images:
+        raise ValueError(f"No labelled images found in {folder} (expected {folder}/<class>/...)")
+    return images, torch.tensor(targets)
+
+
+# Temperature that minimises the negative log-likelihood of the true labels
+# (fitted on log T, so it stays positive)
+def fit_temperature(logits, targets, steps=100):
+    log_temperature = torch.zeros(1, requires_grad=True)
+    optimizer = torch.optim.LBFGS([log_temperature], max_iter=steps,
+                                  line_search_fn="strong_wolfe")
+    logits = logits.float()
+
+    def closure():
+        optimizer.zero_grad()
+        loss = torch.nn.functional.cross_entropy(logits / log_temperature.exp(), targets)
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    return float(log_temperature.detach().exp())
+
+
+# Lowest per-class thresholds at which predictions of that class reach `target`
+# precision (the same search as the cascade's exit thresholds). Classes
+# predicted fewer than `min_examples` times get None (global threshold);
+# classes that never reach the target on `min_examples` predictions get 1.01
+# (always the "trash" fallback).
+def calibrate_class_thresholds(probabilities, targets, target=0.9, min_examples=5):
+    from cascade import calibrate_thresholds
+
+    thresholds = calibrate_thresholds(probabilities, targets, target, min_examples)
+    counts = torch.bincount(probabilities.argmax(dim=-1), minlength=probabilities.shape[1])
+    return [value if count >= min_examples else None
+            for value, count in zip(thresholds, counts.tolist())]
+
+
+# Expected calibration error: mean gap between confidence and accuracy over
+# equal-width confidence bins, weighted by the bin sizes
+def expected_calibration_error(probabilities, targets, bins=10):
+    confidences, predicted = probabilities.max(dim=-1)
+    correct = (predicted == targets).float()
+    bin_index = (confidences * bins).long().clamp(max=bins - 1)
+    gaps = torch.bincount(bin_index, weights=confidences - correct, minlength=bins).abs()
+    return float(gaps.sum() / len(targets))
+
+
+# Fit a calibration on logits and their true labels
+def calibrate(logits, targets, target=0.9, min_examples=5):
+    temperature = fit_temperature(logits, targets)
+    thresholds = calibrate_class_thresholds(Calibration(temperature).probabilities(logits),
+                                            targets, target, min_examples)
+    return Calibration(temperature, thresholds)
+
+
+# Calibration quality before and after, and the decisions it leads to
+def calibration_report(calibration, logits, targets, labels, threshold=0.7):
+    raw = torch.softmax(logits.float(), dim=-1)
+    calibrated = calibration.probabilities(logits)
+    confidences, predicted = calibrated.max(dim=-1)
+    fallback = confidences < calibration.class_thresholds(threshold, len(labels))[predicted]
+    accepted = ~fallback
+    return {
+        "images": len(targets),
+        "temperature": round(calibration.temperature, 4),
+        "accuracy": round(float((predicted == targets).float().mean()), 4),
+        "nll_before": round(float(torch.nn.functional.cross_entropy(logits.float(), targets)), 4),
+        "nll_after": round(float(torch.nn.functional.cross_entropy(
+            logits.float() / calibration.temperature, targets)), 4),
+        "ece_before": round(expected_calibration_error(raw, targets), 4),
+        "ece_after": round(expected_calibration_error(calibrated, targets), 4),
+        "fallback_rate": round(float(fallback.float().mean()), 4),
+        "accepted_precision": round(
+            float((predicted[accepted] == targets[accepted]).float().mean()), 4
+        ) if bool(accepted.any()) else None,
+        "thresholds": dict(zip(labels, [
+            round(value, 4) for value in
+            calibration.class_thresholds(threshold, len(labels)).tolist()
+        ])),
+    }
+
+
+def main(argv=None):
+    import model_inference
+
+    parser = argparse.ArgumentParser(description="Calibrate or evaluate classifier confidences.")
+    parser.add_argument("command", choices=["calibrate", "report"])
+    parser.add_argument("folder", help="Labelled images in FOLDER/<class>/")
+    parser.add_argument("--model", default=model_inference.MODEL_NAME)
+    parser.add_argument("--backend", default=model_inference.BACKEND)
+    parser.add_argument("--cascade", action="store_true",
+                        help="Calibrate the logits of the calibrated two-stage cascade")
+    parser.add_argument("--target", type=float, default=0.9,
+                        help="Precision each class must reach above its threshold")
+    parser.add_argument("--min-examples", type=int, default=5,
+                        help="Predictions of a class needed to calibrate its threshold")
+    parser.add_argument("--threshold", type=float, default=0.7,
+                        help="Global threshold; calibrated thresholds only raise it")
+    parser.add_argument("--output", help="Calibration file (default: in the artifact cache)")
+    args = parser.parse_args(argv)
+
+    engine = model_inference.set_engine(
+        model_inference.InferenceEngine(args.model, backend=args.backend)
+    )
+    if args.cascade:
+        model_inference.enable_cascade()
+    engine.warm_up()
+    path = args.output or engine_calibration_path(engine)
+    images, targets = load_labelled_images(args.folder, model_inference.trash_classes)
+    # predict_outputs, not predict_logits: only it routes through the cascade
+    num_classes = len(model_inference.trash_classes)
+    with torch.no_grad():
+        logits = torch.cat([engine.predict_outputs(images[start:start + 32])[:, :num_classes]
+                            for start in range(0, len(images), 32)])
+    if args.command == "calibrate":
+        calibration = calibrate(logits, targets, args.target, args.min_examples)
+        save_calibration(calibration, path)
+        print(f"Saved calibration to {path}")
+    else:
+        calibration = load_calibration(path)
+    print(json.dumps(calibration_report(calibration, logits, targets,
+                                        model_inference.trash_classes, args.threshold),
+                     indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 17 2026
+# This file implements the two-stage cascade mode of the ViT classifier.
+# Stage 1 runs only the first `exit_layer` encoder layers and a small linear head
+# (fitted to reproduce the full model's predictions) on the [CLS] token. When its
+# confidence clears the threshold of the predicted class the answer is returned;
+# otherwise the image escalates and the remaining layers continue from the stage-1
+# hidden states, so an escalated image costs one full forward pass plus the head.
+# Per-class thresholds are calibrated on a folder of images to reach a target
+# agreement with the full model, and routing statistics are kept per stage.
+#
+# Example:
+#   python cascade.py calibrate test_picture --exit-layer 6 --target 0.99
+#   python cascade.py report test_picture
+#   WASTE_CASCADE=1 streamlit run app_streamlit.py
+
+from classify_cli import iter_image_paths
+from image_ingest import ingest_image
+import backends
+import argparse
+import json
+import os
+import threading
+import time
+import torch
+import warnings
+
+# Fewest images the cascade is calibrated on (head fit plus calibration split)
+MIN_IMAGES = 20
+# Agreeing early answers a class needs before it may exit early
+MIN_EXAMPLES = 5
+
+
+# Run ViT encoder layers; a ViTLayer returns a tuple in older transformers
+# releases and a tensor in newer ones
+def run_layers(layers, hidden_states):
+    for layer in layers:
+        output = layer(hidden_states)
+        hidden_states = output[0] if isinstance(output, tuple) else output
+    return hidden_states
+
+
+class CascadeModel:
+    def __init__(self, model, exit_layer, head=None, thresholds=None):
+        vit = model.vit
+        layers = vit.encoder.layer
+        if not 0 < exit_layer < len(layers):
+            raise ValueError(f"exit_layer must be between 1 and {len(layers) - 1}")
+        self.model = model
+        self.exit_layer = exit_layer
+        self.num_classes = model.config.num_labels
+        self.head = head or torch.nn.Linear(model.config.hidden_size, self.num_classes)
+        self.head.eval()
+        # Never exit early until thresholds are calibrated
+        self.thresholds = torch.as_tensor(
+            thresholds if thresholds is not None else [1.01] * self.num_classes,
+            dtype=torch.float32,
+        )
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._stats = {"requests": 0, "early_exits": 0, "stage1_s": 0.0, "stage2_s": 0.0,
+                       "early_per_class": [0] * self.num_classes}
+
+    # Stage 1: hidden states after exit_layer and the early-head logits
+    def stage1(self, pixel_values):
+        vit = self.model.vit
+        hidden_states = vit.embeddings(pixel_values)
+        hidden_states = run_layers(vit.encoder.layer[:self.exit_layer], hidden_states)
+        early_logits = self.head(vit.layernorm(hidden_states[:, 0]))
+        return hidden_states, early_logits
+
+    # Stage 2: continue the remaining layers from stage-1 hidden states
+    def stage2(self, hidden_states):
+        vit = self.model.vit
+        hidden_states = run_layers(vit.encoder.layer[self.exit_layer:], hidden_states)
+        return self.model.classifier(vit.layernorm(hidden_states)[:, 0])
+
+    # Logits for a batch: early-head logits for rows that exit, full-model
+    # logits for the rest
+    def __call__(self, pixel_values):
+        with torch.no_grad():
+            start = time.perf_counter()
+            hidden_states, logits = self.stage1(pixel_values)
+            probabilities = torch.softmax(logits, dim=-1)
+            confidences, predicted = probabilities.max(dim=-1)
+            early = confidences >= self.thresholds[predicted]
+            middle = time.perf_counter()
+            escalate = (~early).nonzero(as_tuple=True)[0]
+            if len(escalate):
+                logits = logits.clone()
+                logits[escalate] = self.stage2(hidden_states[escalate])
+            end = time.perf_counter()
+        with self._lock:
+            self._stats["requests"] += len(pixel_values)
+            self._stats["early_exits"] += int(early.sum())
+            self._stats["stage1_s"] += middle - start
+            self._stats["stage2_s"] += end - middle
+            for index in predicted[early].tolist():
+                self._stats["early_per_class"][index] += 1
+        return logits
+
+    # Routing statistics: share of requests answered by each stage and the
+    # mean time spent in each stage per request
+    def stats(self, labels=None):
+        with self._lock:
+            stats = dict(self._stats)
+        requests = max(1, stats["requests"])
+        labels = labels or [str(index) for index in range(self.num_classes)]
+        return {
+            "exit_layer": self.exit_layer,
+            "requests": stats["requests"],
+            "early_exit_rate": round(stats["early_exits"] / requests, 4),
+            "escalation_rate": round(1 - stats["early_exits"] / requests, 4)
+            if stats["requests"] else 0.0,
+            "early_exits_per_class": dict(zip(labels, stats["early_per_class"])),
+            "stage1_ms_per_request": round(stats["stage1_s"] / requests * 1000, 3),
+            "stage2_ms_per_request": round(stats["stage2_s"] / requests * 1000, 3),
+        }
+
+    def state(self):
+        return {"exit_layer": self.exit_layer, "head": self.head.state_dict(),
+                "thresholds": self.thresholds.tolist()}
+
+
+# Where the calibrated cascade of a model is stored
+def cascade_path(model_name, cache_dir=backends.ARTIFACT_DIR):
+    return os.path.join(backends.build_dir(model_name, cache_dir), "cascade.pt")
+
+
+def save_cascade(cascade, path):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(cascade.state(), temp_path)
+    os.replace(temp_path, path)
+
+
+def load_cascade(model, path):
+    state = torch.load(path, weights_only=True)
+    cascade = CascadeModel(model, state["exit_layer"], thresholds=state["thresholds"])
+    cascade.head.load_state_dict(state["head"])
+    return cascade
+
+
+# Decode every image under a folder (recursively) at model resolution
+def load_images(folder):
+    images = [ingest_image(path).model_image for path in iter_image_paths([folder])]
+    if not images:
+        raise ValueError(f"No images found in {folder}")
+    return images
+
+
+# Stage-1 [CLS] features and full-model probabilities for preprocessed images
+def _features_and_teacher(cascade, pixel_values, batch_size=32):
+    vit = cascade.model.vit
+    features = []
+    teacher = []
+    with torch.no_grad():
+        for start in range(0, len(pixel_values), batch_size):
+            hidden_states, _ = cascade.stage1(pixel_values[start:start + batch_size])
+            features.append(vit.layernorm(hidden_states[:, 0]))
+            teacher.append(torch.softmax(cascade.stage2(hidden_states), dim=-1))
+    return torch.cat(features), torch.cat(teacher)
+
+
+# Fit the early head to the full model's probabilities (distillation with a
+# soft cross-entropy and a little weight decay)
+def fit_head(cascade, features, teacher, steps=200, weight_decay=1e-3):
+    head = torch.nn.Linear(features.shape[1], teacher.shape[1])
+    optimizer = torch.optim.LBFGS(head.parameters(), max_iter=steps, line_search_fn="strong_wolfe")
+
+    def closure():
+        optimizer.zero_grad()
+        log_probabilities = torch.log_softmax(head(features), dim=-1)
+        loss = -(teacher * log_probabilities).sum(dim=-1).mean()
+        loss = loss + weight_decay * head.weight.pow(2).sum()
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    head.eval()
+    cascade.head = head
+    return cascade
+
+
+# Lowest per-class thresholds at which early answers agree with the full model
+# on at least `target` of the images that would exit with that class. Classes
+# with fewer than `min_examples` such answers never exit early.
+def calibrate_thresholds(early_probabilities, teacher_labels, target=0.99,
+                         min_examples=MIN_EXAMPLES):
+    confidences, predicted = early_probabilities.max(dim=-1)
+    thresholds = []
+    for index in range(early_probabilities.shape[1]):
+        rows = (predicted == index).nonzero(as_tuple=True)[0]
+        order = rows[confidences[rows].argsort(descending=True)]
+        agree = (teacher_labels[order] == index).float()
+        # Agreement of the k most confident answers, for every k
+        agreement = agree.cumsum(0) / torch.arange(1, len(order) + 1)
+        passing = (agreement >= target).nonzero(as_tuple=True)[0]
+        if len(passing) == 0 or passing[-1] + 1 < min_examples:
+            thresholds.append(1.01)
+        else:
+            thresholds.append(float(confidences[order[passing[-1]]]))
+    return thresholds
+
+
+# Fit the head on part of the images and calibrate thresholds on the held-out
+# rest, so the thresholds are not judged on images the head was fitted to
+def calibrate(engine, images, exit_layer, target=0.99, holdout=0.3, seed=0,
+              min_examples=MIN_EXAMPLES):
+    if len(images) < MIN_IMAGES:
+        raise ValueError(f"Calibrating the cascade needs at least {MIN_IMAGES} images "
+                         f"(got {len(images)})")
+    if not 0 < holdout < 1:
+        raise ValueError("holdout must be between 0 and 1")
+    cascade = CascadeModel(engine.model, exit_layer)
+    pixel_values = engine.preprocess(images)
+    features, teacher = _features_and_teacher(cascade, pixel_values)
+    order = torch.randperm(len(images), generator=torch.Generator().manual_seed(seed))
+    split = min(int(len(images) * (1 - holdout)), len(images) - 1)
+    fit_rows = order[:split]
+    calibration_rows = order[split:]
+    if len(calibration_rows) < min_examples * cascade.num_classes:
+        warnings.warn(
+            f"Only {len(calibration_rows)} held-out images to calibrate {cascade.num_classes} "
+            f"classes; classes with fewer than {min_examples} agreeing answers will never "
+            f"exit early. Use a larger folder for a useful cascade."
+        )
+    fit_head(cascade, features[fit_rows], teacher[fit_rows])
+    with torch.no_grad():
+        early = torch.softmax(cascade.head(features[calibration_rows]), dim=-1)
+    cascade.thresholds = torch.tensor(calibrate_thresholds(
+        early, teacher[calibration_rows].argmax(dim=-1), target, min_examples
+    ))
+    return cascade
+
+
+# Routing, agreement with the full model and mean latency of both on images
+def cascade_report(engine, cascade, images, labels=None):
+    pixel_values = engine.preprocess(images)
+    full_logits = []
+    start = time.perf_counter()
+    for index in range(len(images)):
+        full_logits.append(engine.forward_logits(pixel_values[index:index + 1]))
+    full_seconds = time.perf_counter() - start
+    cascade.reset_stats()
+    cascade_logits = []
+    start = time.perf_counter()
+    for index in range(len(images)):
+        cascade_logits.append(cascade(pixel_values[index:index + 1]))
+    cascade_seconds = time.perf_counter() - start
+    full_labels = torch.cat(full_logits).argmax(dim=-1)
+    cascade_labels = torch.cat(cascade_logits).argmax(dim=-1)
+    return dict(
+        cascade.stats(labels),
+        images=len(images),
+        agreement_with_full=round(float((full_labels == cascade_labels).float().mean()), 4),
+        full_ms_per_image=round(full_seconds / len(images) * 1000, 3),
+        cascade_ms_per_image=round(cascade_seconds / len(images) * 1000, 3),
+        speedup=round(full_seconds / cascade_seconds, 3),
+        thresholds=dict(zip(labels or range(cascade.num_classes),
+                            [round(value, 4) for value in cascade.thresholds.tolist()])),
+    )
+
+
+def main(argv=None):
+    import model_inference
+
+    parser = argparse.ArgumentParser(description="Calibrate or evaluate the cascade mode.")
+    parser.add_argument("command", choices=["calibrate", "report"])
+    parser.add_argument("folder", help="Folder of images (searched recursively)")
+    parser.add_argument("--model", default=model_inference.MODEL_NAME)
+    parser.add_argument("--exit-layer", type=int, default=6)
+    parser.add_argument("--target", type=float, default=0.99,
+                        help="Agreement with the full model required for early answers")
+    parser.add_argument("--holdout", type=float, default=0.3,
+                        help="Share of the images held out to calibrate the thresholds")
+    parser.add_argument("--min-examples", type=int, default=MIN_EXAMPLES,
+                        help="Agreeing early answers a class needs to exit early")
+    parser.add_argument("--output", help="Cascade file (default: in the artifact cache)")
+    args = parser.parse_args(argv)
+
+    # The exit decisions are calibrated against the exact full model
+    engine = model_inference.InferenceEngine(args.model, backend="eager",
+                                             token_merging=0).warm_up()
+    path = args.output or cascade_path(args.model)
+    images = load_images(args.folder)
+    if args.command == "calibrate":
+        cascade = calibrate(engine, images, args.exit_layer, args.target, args.holdout,
+                            min_examples=args.min_examples)
+        save_cascade(cascade, path)
+        print(f"Saved cascade to {path}")
+    else:
+        cascade = load_cascade(engine.model, path)
+    print(json.dumps(cascade_report(engine, cascade, images, model_inference.trash_classes),
+                     indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 16 2026
+# This file implements a headless command-line tool for bulk waste classification.
+# It walks image directories (or reads a manifest of paths), decodes images in a
+# thread pool while the model runs batched forward passes, and streams one JSON line
+# per image to the output file as soon as its batch completes.
+# Images are processed in a fixed order with a bounded prefetch window, so memory
+# stays flat regardless of corpus size and an interrupted run can resume where the
+# output file stops.
+#
+# Example:
+#   python classify_cli.py test_picture --output results.jsonl
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from image_ingest import ingest_image
+import model_inference
+import argparse
+import json
+import os
+import sys
+import time
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp", ".tif", ".tiff")
+
+
+# Yield image paths from directories (walked in sorted order), single files and
+# manifest files containing one path per line
+def iter_image_paths(inputs, manifest=None):
+    for source in inputs:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()  # Deterministic order is what makes resuming possible
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(root, name)
+        else:
+            yield source
+    if manifest:
+        with open(manifest, encoding="utf-8") as file:
+            for line in file:
+                path = line.strip()
+                if path and not path.startswith("#"):
+                    yield path
+
+
+# Count the complete records already written and drop a partially written last
+# line left behind by a crash. Returns (count, path of the last record).
+def read_checkpoint(output_path):
+    if not os.path.exists(output_path):
+        return 0, None
+    count = 0
+    last_path = None
+    valid_size = 0
+    with open(output_path, "rb") as file:
+        for line in file:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                last_path = json.loads(line)["path"]
+            except (ValueError, KeyError):
+                break
+            count += 1
+            valid_size += len(line)
+    if valid_size != os.path.getsize(output_path):
+        with open(output_path, "r+b") as file:
+            file.truncate(valid_size)
+    return count, last_path
+
+
+# Skip the first `count` paths, checking that the input order still matches
+def skip_completed(paths, count, last_path):
+    path = None
+    for _ in range(count):
+        path = next(paths, None)
+        if path is None:
+            break
+    if count and path != last_path:
+        raise SystemExit(
+            f"Cannot resume: input #{count} is {path!r} but the output file ends with "
+            f"{last_path!r}. Use --no-resume to start over."
+        )
+    return paths
+
+
+# Decode one image at reduced resolution in a worker thread
+def decode_image(path):
+    start = time.perf_counter()
+    try:
+        image = ingest_image(path).model_image
+        return path, image, None, time.perf_counter() - start
+    except (OSError, ValueError) as error:
+        return path, None, f"{type(error).__name__}: {error}", time.perf_counter() - start
+
+
+# Decode images ahead of the model with a bounded number of in-flight images,
+# yielding batches of decoded results in input order
+def iter_decoded_batches(paths, batch_size, workers):
+    prefetch = batch_size * 2
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        batch = []
+        for path in paths:
+            pending.append(executor.submit(decode_image, path))
+            if len(pending) >= prefetch:
+                batch.append(pending.popleft().result())
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+        while pending:
+            batch.append(pending.popleft().result())
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+# Classify one batch of decoded images and build its output records. The batch
+# goes through the same path as the apps (inference server, cascade, calibration
+# and user corrections when enabled), so bulk results match what they return.
+def classify_batch(batch, threshold):
+    decoded = [(index, image) for index, (_, image, error, _) in enumerate(batch)
+               if error is None]
+    timings = {}
+    if decoded:
+        start = time.perf_counter()
+        outputs = model_inference.predict_outputs([image for _, image in decoded],
+                                                  batch_size=len(decoded))
+        timings["inference_ms"] = (time.perf_counter() - start) * 1000
+        # Decisions and calibrated probabilities from one softmax over the batch
+        postprocessed, decisions, _ = model_inference.decide_outputs(outputs, threshold)
+        probabilities = postprocessed.probabilities.tolist()
+        outcomes = {index: (decision, row) for (index, _), decision, row
+                    in zip(decoded, decisions, probabilities)}
+
+    records = []
+    for index, (path, _, error, decode_seconds) in enumerate(batch):
+        record = {"path": path}
+        if error is not None:
+            record["error"] = error
+        else:
+            (class_name, confidence), row = outcomes[index]
+            record["class"] = class_name
+            record["confidence"] = round(confidence, 6)
+            record["probabilities"] = {
+                name: round(probability, 6)
+                for name, probability in zip(model_inference.trash_classes, row)
+            }
+        record["timings"] = {
+            "decode_ms": round(decode_seconds * 1000, 3),
+            "batch_size": len(decoded),
+            **{name: round(value, 3) for name, value in timings.items()},
+        }
+        records.append(record)
+    return records
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Classify images in bulk and stream results to a JSONL file."
+    )
+    parser.add_argument("inputs", nargs="*", help="Image files or directories to classify")
+    parser.add_argument("--manifest", help="Text file with one image path per line")
+    parser.add_argument("--output", default="classification_results.jsonl",
+                        help="JSONL file to append results to")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4,
+                        help="Threads used to decode images")
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--model", help="Model id or local model directory")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Overwrite the output file instead of resuming from it")
+    args = parser.parse_args(argv)
+    if not args.inputs and not args.manifest:
+        parser.error("give at least one input path or --manifest")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.model:
+        model_inference.set_engine(model_inference.InferenceEngine(args.model))
+    # Same setup as the apps: server or local model, cascade and calibration
+    # from the environment, and user corrections
+    model_inference.warm_up()
+    model_inference.enable_corrections()
+
+    if args.no_resume and os.path.exists(args.output):
+        os.remove(args.output)
+    done, last_path = read_checkpoint(args.output)
+    paths = skip_completed(
+        iter_image_paths(args.inputs, args.manifest), done, last_path
+    )
+    if done:
+        print(f"Resuming after {done} completed images", file=sys.stderr)
+
+    processed = 0
+    start = time.perf_counter()
+    with open(args.output, "a", encoding="utf-8") as output:
+        for batch in iter_decoded_batches(paths, args.batch_size, args.workers):
+            for record in classify_batch(batch, args.threshold):
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()  # Every finished batch is durable progress
+            processed += len(batch)
+    elapsed = time.perf_counter() - start
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    print(f"Classified {processed} images in {elapsed:.1f}s ({rate:.1f} images/s)",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 17 2026
+# This file implements the correction index: a nearest-neighbour store of image
+# embeddings whose labels were corrected by users. When a new image is very close
+# to a corrected one, its corrected label overrides the model's answer, so feedback
+# affects future predictions without fine-tuning the ViT.
+#
+# Layout of an index directory (every file is append-only except during training):
+#   index.json   embedding size, label names and training generation
+#   vectors.f16  L2-normalized float16 embeddings, one row per entry (memory-mapped)
+#   entries.bin  label, inverted-list cell and image hash of each entry
+#   centroids.npy  cell centroids, written once the index is trained
+# Rows of vectors.f16 are matched to entries by position, so an append first cuts
+# off any tail a crash left between (or inside) the two writes.
+# Small indexes are searched exhaustively. Once TRAIN_SIZE entries exist, entries are
+# clustered into cells (spherical k-means) and a query only scans the rows of its
+# `probes` closest cells (about 800 rows at 100k entries, roughly 1 ms on one core).
+# Later appends are assigned to their closest cell without re-clustering;
+# `python correction_index.py train DIR` re-clusters everything if cells get unbalanced.
+#
+# Example:
+#   python correction_index.py stats corrections
+
+import argparse
+import json
+import numpy as np
+import os
+import threading
+import time
+import torch
+
+try:
+    import fcntl  # POSIX advisory locks; not available on Windows
+except ImportError:
+    fcntl = None
+
+CORRECTIONS_DIR = os.environ.get("WASTE_CORRECTIONS_DIR", "corrections")
+# Cosine similarity above which a corrected neighbour overrides the model
+MIN_SIMILARITY = float(os.environ.get("WASTE_CORRECTION_SIMILARITY", "0.95"))
+# Entries before the index is clustered, and number of cells
+TRAIN_SIZE = 1024
+NUM_CELLS = 256
+
+ENTRY_DTYPE = np.dtype([("label", "u1"), ("cell", "<i2"), ("key", "S20")])
+
+
+# Unit-length float32 rows
+def _normalize(embeddings):
+    embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+# Spherical k-means: centroids [cells, dim] of unit-length vectors
+def _train_centroids(vectors, cells, iterations=10, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    cells = min(cells, len(vectors))
+    centroids = vectors[torch.randperm(len(vectors), generator=generator)[:cells]].clone()
+    for _ in range(iterations):
+        assignments = (vectors @ centroids.T).argmax(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, vectors)
+        counts = torch.bincount(assignments, minlength=cells)
+        filled = counts > 0  # Empty cells keep their previous centroid
+        centroids[filled] = torch.nn.functional.normalize(sums[filled], dim=1)
+    return centroids
+
+
+class CorrectionIndex:
+    def __init__(self, directory=CORRECTIONS_DIR, labels=None, min_similarity=MIN_SIMILARITY,
+                 probes=2, train_size=TRAIN_SIZE, cells=NUM_CELLS):
+        self.directory = directory
+        self.min_similarity = min_similarity
+        self.probes = probes
+        self.train_size = train_size
+        self.num_cells = cells
+        os.makedirs(directory, exist_ok=True)
+        self._meta_path = os.path.join(directory, "index.json")
+        self._vectors_path = os.path.join(directory, "vectors.f16")
+        self._entries_path = os.path.join(directory, "entries.bin")
+        self._centroids_path = os.path.join(directory, "centroids.npy")
+        # Guards the mapped state; re-entrant because add() and train() refresh under it
+        self._lock = threading.RLock()
+        self._meta = self._read_meta() or {"dim": None, "labels": list(labels or []),
+                                           "generation": 0}
+        if labels is not None and self._meta["labels"] != list(labels):
+            raise ValueError(
+                f"{directory} was built for labels {self._meta['labels']}, not {list(labels)}"
+            )
+        self._reset()
+
+    def _read_meta(self):
+        try:
+            with open(self._meta_path, encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self):
+        temp_path = f"{self._meta_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(self._meta, file)
+        os.replace(temp_path, self._meta_path)
+
+    # Forget everything mapped so far; the next refresh maps the files again
+    def _reset(self):
+        self._count = 0
+        self._generation = self._meta["generation"]
+        self._vectors = None  # float16 tensor [count, dim] over the memory map
+        self._labels = np.empty(0, dtype=np.uint8)
+        self._centroids = None
+        self._cells = None  # cell -> int64 array of entry ids
+
+    # Pick up entries appended (or a re-training done) by any process. Only the
+    # new tail of the files is read, so appends never trigger a rebuild.
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+        return self
+
+    # refresh() body; caller holds the lock
+    def _refresh(self):
+        meta = self._read_meta()
+        if meta is None:
+            return
+        if meta["generation"] != self._generation:
+            self._meta = meta
+            self._reset()
+        self._meta["dim"] = meta["dim"]
+        if not os.path.exists(self._entries_path):
+            return
+        count = os.path.getsize(self._entries_path) // ENTRY_DTYPE.itemsize
+        if count <= self._count:
+            return
+        dim = self._meta["dim"]
+        count = min(count, os.path.getsize(self._vectors_path) // (2 * dim))
+        # Copy-on-write maps are writable views, so torch can wrap them without copying
+        vectors = np.memmap(self._vectors_path, np.float16, "c", shape=(count, dim))
+        entries = np.memmap(self._entries_path, ENTRY_DTYPE, "r", shape=(count,))
+        new_entries = np.array(entries[self._count:])
+        if self._generation > 0 and self._centroids is None:
+            self._centroids = torch.from_numpy(np.load(self._centroids_path))
+            self._cells = [np.empty(0, dtype=np.int64) for _ in range(len(self._centroids))]
+        if self._cells is not None:
+            ids = np.arange(self._count, count)
+            order = np.argsort(new_entries["cell"], kind="stable")
+            cells, starts = np.unique(new_entries["cell"][order], return_index=True)
+            for cell, group in zip(cells, np.split(ids[order], starts[1:])):
+                self._cells[cell] = np.concatenate([self._cells[cell], group])
+        self._labels = np.concatenate([self._labels, new_entries["label"]])
+        self._vectors = torch.from_numpy(vectors)
+        self._count = count
+
+    # Consistent view of the mapped state for searching outside the lock:
+    # (count, vectors, labels, centroids, cells). Every field is replaced, never
+    # mutated, by refresh(), so the copies stay valid while other threads append.
+    def _snapshot(self):
+        with self._lock:
+            self._refresh()
+            cells = None if self._cells is None else list(self._cells)
+            return self._count, self._vectors, self._labels, self._centroids, cells
+
+    def __len__(self):
+        return self._snapshot()[0]
+
+    @property
+    def labels(self):
+        return self._meta["labels"]
+
+    # Append corrected examples: embeddings [N, dim] (or one vector), label names
+    # and optional image hashes (hex strings from result_cache.image_key)
+    def add(self, embeddings, labels, image_keys=None):
+        vectors = _normalize(embeddings)
+        labels = [labels] if isinstance(labels, str) else list(labels)
+        image_keys = image_keys if image_keys is not None else [None] * len(labels)
+        if isinstance(image_keys, str):
+            image_keys = [image_keys]
+        unknown = set(labels) - set(self.labels)
+        if unknown:
+            raise ValueError(f"Unknown label(s) {sorted(unknown)}; use one of {self.labels}")
+        if len(labels) != len(vectors) or len(image_keys) != len(vectors):
+            raise ValueError("Need one label (and image key) per embedding")
+
+        with self._lock, open(self._entries_path, "ab") as entries_file:
+            if fcntl is not None:
+                fcntl.flock(entries_file.fileno(), fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                if self._meta["dim"] is None:
+                    self._meta["dim"] = vectors.shape[1]
+                    self._write_meta()
+                elif vectors.shape[1] != self._meta["dim"]:
+                    raise ValueError(
+                        f"Embedding size {vectors.shape[1]} does not match the index "
+                        f"({self._meta['dim']})"
+                    )
+                entries = np.zeros(len(vectors), dtype=ENTRY_DTYPE)
+                entries["label"] = [self.labels.index(label) for label in labels]
+                entries["key"] = [bytes.fromhex(key) if key else b"" for key in image_keys]
+                entries["cell"] = -1
+                if self._centroids is not None:
+                    entries["cell"] = (torch.from_numpy(vectors) @ self._centroids.T) \
+                        .argmax(dim=1).numpy()
+                self._truncate_torn_tail(entries_file)
+                # Vectors first: readers only count rows that have an entry
+                with open(self._vectors_path, "ab") as vectors_file:
+                    vectors_file.write(vectors.astype(np.float16).tobytes())
+                entries_file.write(entries.tobytes())
+                entries_file.flush()
+                self.refresh()
+                if self._centroids is None and self._count >= self.train_size:
+                    self._train()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(entries_file.fileno(), fcntl.LOCK_UN)
+        return self._count
+
+    # Cut vectors.f16 back to one row per complete entry, and entries.bin back to
+    # whole entries, so a crash between the two appends of add() cannot shift
+    # later rows onto the wrong entries; caller holds the lock and the flock.
+    # Readers never map past the complete entries, so they are unaffected.
+    def _truncate_torn_tail(self, entries_file):
+        count = os.path.getsize(self._entries_path) // ENTRY_DTYPE.itemsize
+        if os.path.getsize(self._entries_path) > count * ENTRY_DTYPE.itemsize:
+            entries_file.truncate(count * ENTRY_DTYPE.itemsize)
+        vector_bytes = count * self._meta["dim"] * 2
+        if os.path.exists(self._vectors_path) and \
+                os.path.getsize(self._vectors_path) > vector_bytes:
+            os.truncate(self._vectors_path, vector_bytes)
+
+    # (Re)cluster every entry into cells; caller holds the lock
+    def _train(self):
+        vectors = self._vectors.float()
+        centroids = _train_centroids(vectors, self.num_cells)
+        cells = np.concatenate([
+            (vectors[start:start + 8192] @ centroids.T).argmax(dim=1).numpy()
+            for start in range(0, len(vectors), 8192)
+        ])
+        np.save(self._centroids_path, centroids.numpy())
+        entries = np.memmap(self._entries_path, ENTRY_DTYPE, "r+", shape=(self._count,))
+        entries["cell"] = cells
+        entries.flush()
+        del entries
+        self._meta["generation"] += 1
+        self._write_meta()
+        self._reset()
+        self.refresh()
+
+    # Re-cluster the whole index (e.g. after it has grown a lot)
+    def train(self):
+        with self._lock, open(self._entries_path, "ab") as entries_file:
+            if fcntl is not None:
+                fcntl.flock(entries_file.fileno(), fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                if self._count:
+                    self._train()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(entries_file.fileno(), fcntl.LOCK_UN)
+        return self
+
+    # Cosine top-k for query embeddings [N, dim]: (similarities [N, k],
+    # entry ids [N, k]); missing neighbours have similarity -inf and id -1
+    def search(self, embeddings, k=5):
+        similarities, ids, _ = self._search(embeddings, k)
+        return similarities, ids
+
+    # search() plus the label array its entry ids index into
+    def _search(self, embeddings, k):
+        count, vectors, entry_labels, centroids, cells = self._snapshot()
+        queries = torch.from_numpy(_normalize(embeddings))
+        similarities = torch.full((len(queries), k), float("-inf"))
+        ids = torch.full((len(queries), k), -1, dtype=torch.int64)
+        if count == 0:
+            return similarities.numpy(), ids.numpy(), entry_labels
+        if cells is None:
+            # Exhaustive search over the (small) untrained index
+            scores = queries @ vectors.float().T
+            top = scores.topk(min(k, count), dim=1)
+            similarities[:, :top.values.shape[1]] = top.values
+            ids[:, :top.indices.shape[1]] = top.indices
+            return similarities.numpy(), ids.numpy(), entry_labels
+
+        probes = min(self.probes, len(cells))
+        nearest_cells = (queries @ centroids.T).topk(probes, dim=1).indices.numpy()
+        for row, row_cells in enumerate(nearest_cells):
+            candidates = np.concatenate([cells[cell] for cell in row_cells])
+            if len(candidates) == 0:
+                continue
+            candidates = torch.from_numpy(candidates)
+            scores = vectors.index_select(0, candidates).float() @ queries[row]
+            top = scores.topk(min(k, len(candidates)))
+            similarities[row, :len(top.values)] = top.values
+            ids[row, :len(top.indices)] = candidates[top.indices]
+        return similarities.numpy(), ids.numpy(), entry_labels
+
+    # Corrected label for each query, or None when no neighbour is at least
+    # `min_similarity` similar. Among close neighbours the label with the largest
+    # total similarity wins. Returns [(label, similarity) or None].
+    def lookup(self, embeddings, k=5):
+        similarities, ids, entry_labels = self._search(embeddings, k)
+        corrections = []
+        for row_similarities, row_ids in zip(similarities, ids):
+            close = row_similarities >= self.min_similarity
+            if not close.any():
+                corrections.append(None)
+                continue
+            votes = {}
+            for similarity, entry in zip(row_similarities[close], row_ids[close]):
+                label = self.labels[entry_labels[entry]]
+                votes[label] = votes.get(label, 0.0) + float(similarity)
+            label = max(votes, key=votes.get)
+            best = max(float(similarity) for similarity, entry in
+                       zip(row_similarities[close], row_ids[close])
+                       if self.labels[entry_labels[entry]] == label)
+            corrections.append((label, best))
+        return corrections
+
+    def stats(self):
+        count, _, entry_labels, _, cells = self._snapshot()
+        counts = np.bincount(entry_labels, minlength=len(self.labels))
+        report = {
+            "entries": count,
+            "dim": self._meta["dim"],
+            "trained": cells is not None,
+            "per_label": {label: int(count) for label, count in zip(self.labels, counts)},
+            "disk_mb": round(sum(
+                os.path.getsize(path) for path in (self._vectors_path, self._entries_path)
+                if os.path.exists(path)
+            ) / (1024 * 1024), 3),
+        }
+        if cells is not None:
+            sizes = [len(cell) for cell in cells]
+            report.update({"cells": len(sizes), "largest_cell": max(sizes),
+                           "probes": self.probes})
+        return report
+
+
+# Mean and 99th-percentile lookup time (ms) of one query embedding
+def time_lookups(index, queries, repeats=200):
+    index.lookup(queries[:1])
+    timings = []
+    for index_row in range(repeats):
+        query = queries[index_row % len(queries)][None]
+        start = time.perf_counter()
+        index.lookup(query)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {"mean_ms": round(sum(timings) / len(timings), 4),
+            "p99_ms": round(timings[int(len(timings) * 0.99) - 1], 4)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or maintain a correction index.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    stats_parser = subparsers.add_parser("stats", help="Entries per label and cell sizes")
+    stats_parser.add_argument("directory", nargs="?", default=CORRECTIONS_DIR)
+    train_parser = subparsers.add_parser("train", help="Re-cluster all entries")
+    train_parser.add_argument("directory", nargs="?", default=CORRECTIONS_DIR)
+    bench_parser = subparsers.add_parser(
+        "benchmark", help="Fill a scratch index with random vectors and time lookups"
+    )
+    bench_parser.add_argument("directory")
+    bench_parser.add_argument("--entries", type=int, default=100_000)
+    bench_parser.add_argument("--dim", type=int, default=768)
+    bench_parser.add_argument("--probes", type=int, default=2)
+    args = parser.parse_args(argv)
+
+    if args.command == "benchmark":
+        labels = [f"class_{index}" for index in range(7)]
+        index = CorrectionIndex(args.directory, labels, probes=args.probes)
+        generator = np.random.default_rng(0)
+        start = time.perf_counter()
+        for chunk_start in range(len(index), args.entries, 10_000):
+            size = min(10_000, args.entries - chunk_start)
+            index.add(generator.standard_normal((size, args.dim), dtype=np.float32),
+                      [labels[value] for value in generator.integers(0, 7, size)])
+        build_seconds = time.perf_counter() - start
+        queries = generator.standard_normal((256, args.dim), dtype=np.float32)
+        report = dict(index.stats(), build_s=round(build_seconds, 2),
+                      **time_lookups(index, queries))
+        print(json.dumps(report, indent=2))
+        return
+
+    index = CorrectionIndex(args.directory)
+    if args.command == "train":
+        index.train()
+    print(json.dumps(index.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
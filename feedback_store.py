@@ -0,0 +1,280 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 17 2026
+# This file implements the structured user-feedback store shared by both frontends.
+# Request threads only enqueue an entry; a background writer appends batches of JSON
+# lines under an exclusive file lock (safe across worker processes), fsyncs according
+# to the configured policy and rotates the file when it grows past a size limit.
+# Each entry records the image hash, predicted class and probabilities it refers to.
+# FeedbackIndex aggregates reports per class and keeps a sidecar index of what it has
+# already read, so repeated summaries only parse newly appended bytes.
+#
+# Example:
+#   python feedback_store.py summary user_feedback.jsonl
+
+from collections import Counter
+import metrics
+import argparse
+import atexit
+import datetime
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+try:
+    import fcntl  # POSIX advisory locks; not available on Windows
+except ImportError:
+    fcntl = None
+
+FEEDBACK_PATH = os.environ.get("WASTE_FEEDBACK_PATH", "user_feedback.jsonl")
+FSYNC_POLICIES = ("always", "batch", "never")
+_STOP = object()
+logger = logging.getLogger("waste_sorting.feedback")
+
+
+# Build a feedback entry for a classification result (or none)
+def feedback_entry(text, result=None, threshold=0.7, corrected_label=None, source=None):
+    text = (text or "").strip()  # Widgets may pass None for an empty field
+    if not text and corrected_label:
+        text = f"Correct category: {corrected_label}"
+    entry = {
+        "ts": datetime.datetime.now().isoformat(timespec="seconds"),
+        "text": text,
+    }
+    if result is not None:
+        predicted_class, confidence = result.decide(threshold)
+        entry.update({
+            "image_hash": result.image_key,
+            "predicted_class": predicted_class,
+            "confidence": round(float(confidence), 6),
+            "probabilities": [round(float(value), 6) for value in result.probabilities],
+        })
+    if corrected_label:
+        entry["corrected_label"] = corrected_label
+    if source:
+        entry["source"] = source
+    return entry
+
+
+# Append-only JSONL feedback log written by a background thread.
+# fsync: "always" writes and syncs every entry on its own, "batch" syncs once per
+# batch and "never" leaves flushing to the operating system.
+class FeedbackStore:
+    def __init__(self, path=FEEDBACK_PATH, batch_size=64, flush_interval=0.5,
+                 fsync="batch", max_bytes=64 * 1024 * 1024, dedupe_seconds=10.0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {', '.join(FSYNC_POLICIES)}")
+        self.path = path
+        self.batch_size = 1 if fsync == "always" else batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.dedupe_seconds = dedupe_seconds
+        self.written = 0
+        self.dropped_duplicates = 0
+        self._recent = {}  # (text, image_hash) -> time it was last accepted
+        self._recent_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name="feedback-writer",
+                                         daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # Queue an entry; returns False for empty text or a repeated submission
+    # (same text for the same image within `dedupe_seconds`)
+    def submit(self, entry):
+        text = (entry.get("text") or "").strip()
+        if not text:
+            return False
+        key = (text, entry.get("image_hash"))
+        now = time.monotonic()
+        with self._recent_lock:
+            if now - self._recent.get(key, float("-inf")) < self.dedupe_seconds:
+                self.dropped_duplicates += 1
+                return False
+            self._recent[key] = now
+            if len(self._recent) > 1024:  # Forget old submissions
+                self._recent = {k: t for k, t in self._recent.items()
+                                if now - t < self.dedupe_seconds}
+        self._queue.put(dict(entry, text=text))
+        return True
+
+    # Write everything queued so far and stop the writer thread
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    # Writer loop: wait for entries, collect a batch, append it
+    def _loop(self):
+        while True:
+            entry = self._queue.get()
+            if entry is _STOP:
+                return
+            batch = [entry]
+            stop = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    entry = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if entry is _STOP:
+                    stop = True
+                    break
+                batch.append(entry)
+            try:
+                with metrics.stage("feedback_write"):
+                    self._write(batch)
+            except OSError as error:
+                logger.error("Could not write %d feedback entries to %s: %s",
+                             len(batch), self.path, error)
+            if stop:
+                return
+
+    # Append a batch with one write() under an exclusive lock, then rotate
+    # the file if it grew past max_bytes
+    def _write(self, batch):
+        data = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in batch)
+        with open(self.path, "a", encoding="utf-8") as file:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            try:
+                # Another process may have rotated the file while we waited
+                if not os.path.exists(self.path) or \
+                        os.fstat(file.fileno()).st_ino != os.stat(self.path).st_ino:
+                    return self._write(batch)
+                file.write(data)
+                file.flush()
+                if self.fsync != "never":
+                    os.fsync(file.fileno())
+                self.written += len(batch)
+                if file.tell() >= self.max_bytes:
+                    self._rotate()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+    # Rename the full log to a timestamped file; rotated files are immutable
+    def _rotate(self):
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        root, extension = os.path.splitext(self.path)
+        os.rename(self.path, f"{root}.{stamp}-{os.getpid()}{extension}")
+
+
+_store = None
+_store_lock = threading.Lock()
+metrics.gauge("waste_queue_depth", lambda: _store._queue.qsize() if _store is not None else 0,
+              {"queue": "feedback"})
+
+
+# Process-wide feedback store
+def get_feedback_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = FeedbackStore()
+    return _store
+
+
+# Aggregates feedback per predicted class across the live log and its rotated
+# files. Per-file results are cached in a sidecar JSON index with the byte offset
+# already read, so only new data is parsed on the next call.
+class FeedbackIndex:
+    def __init__(self, path=FEEDBACK_PATH, index_path=None):
+        self.path = path
+        self.index_path = index_path or f"{path}.index.json"
+
+    # Live log plus rotated logs, oldest first
+    def files(self):
+        root, extension = os.path.splitext(self.path)
+        rotated = sorted(glob.glob(f"{glob.escape(root)}.*{extension}"))
+        rotated = [name for name in rotated if name != self.index_path]
+        live = [self.path] if os.path.exists(self.path) else []
+        return rotated + live
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    # Parse a file from `offset`, updating `summary`; returns the new offset.
+    # A trailing line without a newline is left for the next call.
+    @staticmethod
+    def _scan(path, offset, summary):
+        reports = Counter(summary["reports"])
+        corrections = Counter(summary["corrections"])
+        with open(path, "rb") as file:
+            file.seek(offset)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                predicted = entry.get("predicted_class") or "unknown"
+                reports[predicted] += 1
+                corrected = entry.get("corrected_label")
+                if corrected and corrected != predicted:
+                    corrections[f"{predicted}->{corrected}"] += 1
+        summary["reports"] = dict(reports)
+        summary["corrections"] = dict(corrections)
+        return offset
+
+    # Misclassification report counts per predicted class and the most common
+    # predicted -> corrected label pairs
+    def summary(self):
+        index = self._load_index()
+        files = self.files()
+        updated = {}
+        for path in files:
+            stat = os.stat(path)
+            cached = index.get(path)
+            # Reuse a cached entry when the file is the same inode and has not
+            # shrunk (a rotated-away live log gets a new inode)
+            if cached and cached["inode"] == stat.st_ino and cached["offset"] <= stat.st_size:
+                entry = cached
+            else:
+                entry = {"inode": stat.st_ino, "offset": 0,
+                         "summary": {"reports": {}, "corrections": {}}}
+            if entry["offset"] < stat.st_size:
+                entry["offset"] = self._scan(path, entry["offset"], entry["summary"])
+            updated[path] = entry
+
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(updated, file)
+        os.replace(temp_path, self.index_path)
+
+        reports = Counter()
+        corrections = Counter()
+        for entry in updated.values():
+            reports.update(entry["summary"]["reports"])
+            corrections.update(entry["summary"]["corrections"])
+        return {
+            "files": len(files),
+            "entries": sum(reports.values()),
+            "reports_per_class": dict(reports.most_common()),
+            "corrections": dict(corrections.most_common()),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize stored user feedback.")
+    parser.add_argument("command", choices=["summary"])
+    parser.add_argument("path", nargs="?", default=FEEDBACK_PATH)
+    args = parser.parse_args(argv)
+    print(json.dumps(FeedbackIndex(args.path).summary(), indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 17 2026
+# This file implements the image-ingest stage shared by both frontends.
+# Uploads are checked against a byte and pixel budget from their headers before any
+# pixels are decoded. JPEGs are then decoded in draft mode (DCT scaling by 1/2, 1/4
+# or 1/8) straight to a size close to what is actually needed, and other formats are
+# shrunk right after decoding with reduce(). The result is a model-sized image plus
+# a separate bounded display thumbnail, so full-resolution phone photos are never
+# held in memory for the rest of the request.
+
+from PIL import Image, ImageOps
+import metrics
+import io
+import numpy as np
+import os
+import time
+
+# Upload limits; larger images are rejected with a clear message
+MAX_PIXELS = int(os.environ.get("WASTE_MAX_PIXELS", str(50_000_000)))
+MAX_UPLOAD_MB = float(os.environ.get("WASTE_MAX_UPLOAD_MB", "25"))
+# Pillow's own decompression-bomb limit follows the same budget: it warns above
+# MAX_PIXELS and refuses to open images over twice that
+Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+# Longest side of the thumbnail shown in the UI and used for annotation
+DISPLAY_SIZE = int(os.environ.get("WASTE_DISPLAY_SIZE", "768"))
+# Shortest side kept for the model; the ViT input is 224 x 224
+MODEL_SIZE = 224
+
+
+# Raised when an upload exceeds the byte or pixel budget or cannot be decoded
+class ImageRejectedError(ValueError):
+    pass
+
+
+# Result of ingesting one upload
+class IngestedImage:
+    def __init__(self, model_image, display_image, original_size, byte_size,
+                 decode_seconds):
+        self.model_image = model_image  # RGB, shortest side about MODEL_SIZE
+        self.display_image = display_image  # RGB, longest side <= DISPLAY_SIZE
+        self.original_size = original_size  # (width, height) stored in the file
+        self.byte_size = byte_size  # Encoded size, or None if unknown
+        self.decode_seconds = decode_seconds
+
+
+# Size in bytes of an upload without reading it into memory
+def _byte_size(source):
+    if isinstance(source, (bytes, bytearray)):
+        return len(source)
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.getsize(source)
+    if isinstance(source, Image.Image):
+        filename = getattr(source, "filename", None)
+        return os.path.getsize(filename) if filename else None
+    if hasattr(source, "seek") and hasattr(source, "tell"):
+        position = source.tell()
+        source.seek(0, os.SEEK_END)
+        size = source.tell()
+        source.seek(position)
+        return size
+    return None
+
+
+# Scale factor that keeps the longest side >= display_size and the shortest
+# side >= model_size (never upscales)
+def _needed_scale(size, display_size, model_size):
+    width, height = size
+    return min(1.0, max(display_size / max(width, height), model_size / min(width, height)))
+
+
+# Reject images over the pixel budget (checked on the header, before decoding)
+def check_pixels(image, max_pixels=MAX_PIXELS):
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ImageRejectedError(
+            f"The image is {width} x {height} ({width * height / 1e6:.0f} MP); "
+            f"the limit is {max_pixels / 1e6:.0f} MP. Please upload a smaller image."
+        )
+
+
+# Open an encoded image (bytes, path or file object) without decoding it, or
+# raise ImageRejectedError if it is unreadable or over the pixel budget
+def open_image(source, max_pixels=MAX_PIXELS):
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    try:
+        image = Image.open(source)  # Reads the header only
+    except Image.DecompressionBombError:
+        raise ImageRejectedError(
+            f"The image is over twice the {max_pixels / 1e6:.0f} MP limit. "
+            f"Please upload a smaller image."
+        )
+    except (OSError, ValueError) as error:
+        raise ImageRejectedError(f"The upload is not a readable image ({error}).")
+    check_pixels(image, max_pixels)
+    return image
+
+
+# Decode an upload (bytes, path, file object, PIL image or uint8 array) at a
+# reduced resolution and return an IngestedImage
+def ingest_image(source, max_pixels=MAX_PIXELS, max_upload_mb=MAX_UPLOAD_MB,
+                 display_size=DISPLAY_SIZE, model_size=MODEL_SIZE):
+    start = time.perf_counter()
+    byte_size = _byte_size(source) if not isinstance(source, np.ndarray) else None
+    if byte_size is not None and byte_size > max_upload_mb * 1024 * 1024:
+        raise ImageRejectedError(
+            f"The uploaded file is {byte_size / (1024 * 1024):.1f} MB; "
+            f"the limit is {max_upload_mb:g} MB. Please upload a smaller image."
+        )
+
+    if isinstance(source, np.ndarray):
+        image = Image.fromarray(source)
+    elif isinstance(source, Image.Image):
+        image = source
+    else:
+        image = open_image(source, max_pixels)
+    check_pixels(image, max_pixels)
+
+    original_size = image.size
+    width, height = original_size
+
+    scale = _needed_scale(original_size, display_size, model_size)
+    try:
+        # JPEG: let the decoder skip DCT detail (no effect on other formats or
+        # on images that are already decoded)
+        if image.format == "JPEG" and scale < 1.0:
+            image.draft("RGB", (int(width * scale) + 1, int(height * scale) + 1))
+        image = ImageOps.exif_transpose(image)  # Decodes; respects phone orientation
+    except (OSError, ValueError, SyntaxError) as error:
+        raise ImageRejectedError(f"The image could not be decoded ({error}).")
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    # Formats without draft support: cheap integer box reduction right after decoding
+    factor = int(_needed_scale(image.size, display_size, model_size) ** -1)
+    if factor >= 2:
+        image = image.reduce(factor)
+
+    display_image = image.copy()
+    display_image.thumbnail((display_size, display_size), Image.BILINEAR)
+    model_scale = model_size / min(image.size)
+    if model_scale < 1.0:
+        model_image = image.resize(
+            (max(1, round(image.width * model_scale)), max(1, round(image.height * model_scale))),
+            Image.BILINEAR, reducing_gap=2.0,
+        )
+    else:
+        model_image = image
+    decode_seconds = time.perf_counter() - start
+    metrics.record_stage("decode", decode_seconds)
+    return IngestedImage(model_image, display_image, original_size, byte_size,
+                         decode_seconds)
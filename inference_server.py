@@ -0,0 +1,440 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 17 2026
+# This file implements a standalone local HTTP inference service and its client.
+# The server owns a pool of worker processes that each hold the model, batches
+# concurrent requests with the micro-batching scheduler and rejects work it cannot
+# queue (HTTP 503) instead of letting latency grow without bound.
+# Both frontends switch to it by setting WASTE_INFERENCE_URL; the client resizes
+# images to the model input size locally, so only small uint8 arrays cross the wire.
+#
+# Endpoints:
+#   GET  /healthz         process is alive
+#   GET  /readyz          workers have loaded the model (503 until then)
+#   GET  /info            model name, input size, resample filter and labels
+#   GET  /metrics         Prometheus metrics (also /profiles, see metrics.py)
+#   POST /classify        one encoded image (JPEG/PNG bytes) -> result JSON
+#   POST /classify_batch  .npy uint8 array [N, H, W, 3] -> logits for every image
+# Both POST routes enforce image_ingest's budgets (MAX_UPLOAD_MB per upload and
+# MAX_PIXELS per image and per batch) and answer HTTP 413 over them.
+#
+# Example (offline, with a tiny stand-in model):
+#   python inference_server.py --tiny-model /tmp/tiny-vit --port 8600
+#   WASTE_INFERENCE_URL=http://127.0.0.1:8600 streamlit run app_streamlit.py
+
+from batch_scheduler import MicroBatchScheduler, SchedulerOverloadedError
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+from image_ingest import MAX_PIXELS, MAX_UPLOAD_MB, ImageRejectedError, open_image
+from worker_pool import WorkerCrashedError, WorkerPool
+from calibration import calibration_path
+import metrics
+import model_inference
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import numpy as np
+import os
+import threading
+import time
+import torch
+import urllib.error
+import urllib.parse
+import urllib.request
+
+_worker_engine = None  # Engine of the current worker process
+logger = logging.getLogger("waste_sorting.server")
+
+
+# Runs once in every worker process: load and warm up the model
+def _init_worker(model_name, backend, threads):
+    global _worker_engine
+    torch.set_num_threads(threads)
+    _worker_engine = model_inference.InferenceEngine(model_name, backend=backend).warm_up()
+
+
+# Model input description of a loaded engine
+def _engine_info(engine):
+    extractor = engine.feature_extractor
+    return {
+        "model": engine.model_name,
+        "backend": engine.backend,
+        "size": [extractor.size["height"], extractor.size["width"]],
+        "resample": int(extractor.resample),
+        "labels": model_inference.trash_classes,
+        "load_seconds": engine.load_seconds,
+    }
+
+
+# Raised for a request over the byte or pixel budget (answered with HTTP 413)
+class RequestTooLargeError(ValueError):
+    pass
+
+
+# Room for the header of an .npy body on top of its pixel bytes
+NPY_HEADER_BYTES = 65536
+
+
+# Parse a /classify_batch body (.npy uint8 [N, H, W, 3]). The header is checked
+# before np.load allocates the array: the whole batch gets the pixel budget of
+# one upload (image_ingest.MAX_PIXELS).
+def load_pixel_batch(data, max_pixels=MAX_PIXELS):
+    buffer = io.BytesIO(data)
+    version = np.lib.format.read_magic(buffer)
+    if version == (1, 0):
+        shape, _, dtype = np.lib.format.read_array_header_1_0(buffer)
+    else:
+        shape, _, dtype = np.lib.format.read_array_header_2_0(buffer)
+    if dtype != np.uint8 or len(shape) != 4 or shape[-1] != 3:
+        raise ValueError("expected a uint8 array of shape [N, H, W, 3]")
+    count, height, width, _ = shape
+    if count * height * width > max_pixels:
+        raise RequestTooLargeError(
+            f"the batch has {count} images of {width} x {height} "
+            f"({count * height * width / 1e6:.1f} MP); the limit is {max_pixels / 1e6:.0f} MP"
+        )
+    buffer.seek(0)
+    return np.load(buffer, allow_pickle=False)
+
+
+# Model input description, computed in a worker so the server process never
+# loads the weights itself
+def _worker_info():
+    return _engine_info(_worker_engine)
+
+
+# Logits for a uint8 batch [N, H, W, 3]
+def _worker_logits(pixels):
+    return _worker_engine.predict_logits(list(pixels)).numpy()
+
+
+# Process pool plus one micro-batching scheduler per worker, so up to
+# `workers` merged batches are in flight at the same time. With
+# `shared_weights` the server loads the model once and forks a WorkerPool
+# whose workers share the weights and are pinned to their own cores
+# (threads_per_worker is then the size of each worker's core subset). Its
+# zygote is forked before the schedulers start their threads.
+class InferenceService:
+    def __init__(self, model_name, workers=2, backend="eager", threads_per_worker=1,
+                 max_batch_size=8, window_ms=10, max_queue_size=32, shared_weights=False):
+        self.model_name = model_name
+        self.workers = workers
+        self.info = None
+        self.ready = threading.Event()
+        self.started = time.time()
+        if shared_weights:
+            self.pool = WorkerPool(model_name, workers, backend=backend).fork_zygote()
+        else:
+            self.pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(model_name, backend, threads_per_worker),
+            )
+        self.schedulers = [
+            MicroBatchScheduler(self._run_batch, max_batch_size, window_ms,
+                                max_queue_size, name=f"server-batcher-{index}")
+            for index in range(workers)
+        ]
+        for index, scheduler in enumerate(self.schedulers):
+            metrics.gauge("waste_queue_depth", lambda scheduler=scheduler: scheduler.queue_depth,
+                          {"queue": f"server-{index}"})
+        metrics.gauge("waste_model_load_seconds",
+                      lambda: self.info["load_seconds"] if self.info else None)
+        threading.Thread(target=self._warm_up, daemon=True).start()
+
+    # Start every worker (each loads the model) and record the model input info
+    def _warm_up(self):
+        if isinstance(self.pool, WorkerPool):
+            self.info = _engine_info(self.pool.start().engine)
+            self.ready.set()
+            return
+        futures = [self.pool.submit(_worker_info) for _ in range(self.workers)]
+        self.info = futures[0].result()
+        for future in futures[1:]:
+            future.result()
+        self.ready.set()
+
+    # Merge several requests' arrays into one worker call and split the logits
+    def _run_batch(self, arrays):
+        if isinstance(self.pool, WorkerPool):
+            logits = self.pool.submit(np.concatenate(arrays)).result()
+        else:
+            logits = self.pool.submit(_worker_logits, np.concatenate(arrays)).result()
+        splits = np.cumsum([len(array) for array in arrays])[:-1]
+        return np.split(logits, splits)
+
+    # Logits for a uint8 batch; raises SchedulerOverloadedError when every
+    # scheduler queue is full (admission control)
+    def predict(self, pixels, timeout=None):
+        scheduler = min(self.schedulers, key=lambda item: item.queue_depth)
+        return scheduler.submit(pixels).result(timeout=timeout)
+
+    # Requests waiting in all scheduler queues
+    @property
+    def queue_depth(self):
+        return sum(scheduler.queue_depth for scheduler in self.schedulers)
+
+    # Resize an encoded image to the model input size, as the client does.
+    # The header is checked against the upload pixel budget before decoding.
+    def decode(self, data):
+        height, width = self.info["size"]
+        with open_image(data) as image:
+            if image.format == "JPEG":
+                image.draft("RGB", (width, height))  # Decode at a reduced scale
+            try:
+                image = image.convert("RGB").resize((width, height), self.info["resample"])
+            except (OSError, SyntaxError) as error:
+                raise ImageRejectedError(f"The image could not be decoded ({error}).")
+        return np.asarray(image)[None]
+
+    def close(self):
+        for scheduler in self.schedulers:
+            scheduler.close()
+        if isinstance(self.pool, WorkerPool):
+            self.pool.close()
+        else:
+            self.pool.shutdown(cancel_futures=True)
+
+
+# HTTP request handler; `service` is set on the subclass created by make_server()
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    service = None
+    request_timeout = 30.0
+
+    def log_message(self, format, *args):
+        pass  # Keep the console quiet; errors are reported in responses
+
+    def _send_json(self, status, payload, headers=None):
+        self._send(status, "application/json", json.dumps(payload).encode(), headers)
+
+    def _send(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Request body, refused unread when it declares more than `max_bytes`
+    def _read_body(self, max_bytes):
+        length = int(self.headers.get("Content-Length", 0))
+        if length > max_bytes:
+            raise RequestTooLargeError(
+                f"request body is {length / (1024 * 1024):.1f} MB; "
+                f"the limit is {max_bytes / (1024 * 1024):.1f} MB"
+            )
+        return self.rfile.read(length)
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        if path == "/healthz":
+            self._send_json(200, {"status": "ok", "uptime_s": time.time() - self.service.started})
+        elif path == "/readyz":
+            if self.service.ready.is_set():
+                self._send_json(200, {"status": "ready", "queue_depth": self.service.queue_depth})
+            else:
+                self._send_json(503, {"status": "loading"}, {"Retry-After": "1"})
+        elif path == "/info":
+            if not self.service.ready.is_set():
+                self._send_json(503, {"status": "loading"}, {"Retry-After": "1"})
+            else:
+                self._send_json(200, self.service.info)
+        else:
+            response = metrics.handle_metrics_path(path)
+            if response is not None:
+                self._send(*response)
+            else:
+                self._send_json(404, {"error": f"unknown path {path}"})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if not self.service.ready.is_set():
+            self._send_json(503, {"error": "model is still loading"}, {"Retry-After": "1"})
+            return
+        try:
+            with metrics.request(url.path.strip("/") or "root"):
+                self._handle_post(url)
+        except SchedulerOverloadedError as error:
+            self._send_json(503, {"error": str(error)}, {"Retry-After": "1"})
+        except (BrokenProcessPool, WorkerCrashedError) as error:
+            logger.error("Inference worker failed: %s", error)
+            self._send_json(503, {"error": f"inference worker failed ({error})"},
+                            {"Retry-After": "1"})
+        except RequestTooLargeError as error:  # Before ValueError, its base class
+            self._send_json(413, {"error": str(error)})
+        except TimeoutError:  # Before OSError, its base class
+            self._send_json(504, {"error": "inference timed out"})
+        except (OSError, ValueError) as error:
+            self._send_json(400, {"error": str(error)})
+        except Exception as error:
+            logger.exception("Unhandled error in %s", url.path)
+            self._send_json(500, {"error": f"{type(error).__name__}: {error}"})
+
+    def _handle_post(self, url):
+        if url.path == "/classify":
+            with metrics.stage("decode"):
+                pixels = self.service.decode(self._read_body(MAX_UPLOAD_MB * 1024 * 1024))
+            threshold = float(urllib.parse.parse_qs(url.query).get("threshold", [0.7])[0])
+            with metrics.stage("forward"):
+                logits = self.service.predict(pixels, self.request_timeout)[0]
+            with metrics.stage("postprocess"):
+                result = model_inference.ClassificationResult(None, logits)
+                class_name, confidence = result.decide(threshold)
+            metrics.record_prediction(class_name, result.is_fallback(threshold))
+            self._send_json(200, {
+                "class": class_name,
+                "confidence": confidence,
+                "probabilities": dict(zip(self.service.info["labels"],
+                                          result.probabilities.tolist())),
+                "logits": logits.tolist(),
+            })
+        elif url.path == "/classify_batch":
+            pixels = load_pixel_batch(self._read_body(MAX_PIXELS * 3 + NPY_HEADER_BYTES))
+            with metrics.stage("forward"):
+                logits = self.service.predict(pixels, self.request_timeout)
+            self._send_json(200, {"logits": logits.tolist()})
+        else:
+            self._send_json(404, {"error": f"unknown path {url.path}"})
+
+
+# Build an HTTP server bound to host:port around an InferenceService
+def make_server(service, host="127.0.0.1", port=8600):
+    handler = type("Handler", (InferenceRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+# Client used by model_inference when WASTE_INFERENCE_URL is set
+class InferenceClient:
+    def __init__(self, url, timeout=30.0):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._info = None
+
+    # Model input size, resample filter and labels, fetched once
+    @property
+    def info(self):
+        if self._info is None:
+            try:
+                self._info = self._get("/info")
+            except (urllib.error.URLError, ConnectionError, TimeoutError) as error:
+                raise self._unreachable(error) from None
+        return self._info
+
+    # Server down or not answering: reported like an overloaded server, which
+    # the frontends show as "busy, try again"
+    def _unreachable(self, error):
+        reason = getattr(error, "reason", error)
+        return SchedulerOverloadedError(
+            f"The inference server at {self.url} is unreachable ({reason}). "
+            f"Please try again shortly."
+        )
+
+    def _get(self, path):
+        with urllib.request.urlopen(self.url + path, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    # Block until the server reports ready (or raise after `timeout` seconds)
+    def wait_ready(self, timeout=120.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self._get("/readyz")
+                return self
+            except (urllib.error.URLError, ConnectionError):
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Inference server at {self.url} is not ready")
+                time.sleep(0.5)
+
+    # Logits tensor [N, num_classes] for a list of PIL images or arrays
+    def predict_logits(self, images):
+        height, width = self.info["size"]
+        pixels = np.empty((len(images), height, width, 3), dtype=np.uint8)
+        for index, image in enumerate(images):
+            if not isinstance(image, Image.Image):
+                image = Image.fromarray(np.asarray(image))
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            if image.size != (width, height):
+                image = image.resize((width, height), self.info["resample"])
+            pixels[index] = np.asarray(image)
+        body = io.BytesIO()
+        np.save(body, pixels, allow_pickle=False)
+        request = urllib.request.Request(
+            self.url + "/classify_batch", data=body.getvalue(),
+            headers={"Content-Type": "application/x-npy"}, method="POST",
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return torch.tensor(json.loads(response.read())["logits"])
+        except urllib.error.HTTPError as error:
+            message = json.loads(error.read() or b"{}").get("error", error.reason)
+            if error.code == 503:
+                raise SchedulerOverloadedError(message) from None
+            raise RuntimeError(f"Inference server error {error.code}: {message}") from None
+        except (urllib.error.URLError, ConnectionError, TimeoutError) as error:
+            raise self._unreachable(error) from None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the local inference service.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--model", default=model_inference.MODEL_NAME)
+    parser.add_argument("--tiny-model", metavar="DIR",
+                        help="Create (if needed) and serve a tiny random ViT from DIR")
+    parser.add_argument("--backend", default=model_inference.BACKEND)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads-per-worker", type=int,
+                        help="PyTorch threads per worker (default: half the cores); "
+                             "not used with --shared-weights")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--window-ms", type=float, default=10)
+    parser.add_argument("--max-queue-size", type=int, default=32,
+                        help="Pending requests per worker before returning 503")
+    parser.add_argument("--shared-weights", action="store_true",
+                        help="Load the model once and fork workers that share the weights, "
+                             "each pinned to its own cores (Linux/macOS)")
+    args = parser.parse_args(argv)
+    if args.shared_weights and args.threads_per_worker is not None:
+        parser.error("--threads-per-worker does not apply with --shared-weights: each worker "
+                     "runs one thread per core of its own core subset")
+    threads_per_worker = args.threads_per_worker or max(1, (os.cpu_count() or 2) // 2)
+
+    model_name = args.model
+    if args.tiny_model:
+        if not os.path.exists(os.path.join(args.tiny_model, "config.json")):
+            model_inference.save_tiny_model(args.tiny_model)
+        model_name = args.tiny_model
+
+    if model_inference.CALIBRATION:
+        model_inference.enable_calibration(calibration_path(
+            model_name, args.backend, token_merging=model_inference.TOKEN_MERGING
+        ))
+    service = InferenceService(
+        model_name, args.workers, args.backend, threads_per_worker,
+        args.max_batch_size, args.window_ms, args.max_queue_size, args.shared_weights,
+    )
+    metrics.enable_metrics(port=0)  # Request logs and profiler, if configured
+    server = make_server(service, args.host, args.port)
+    print(f"Serving {model_name} on http://{args.host}:{args.port} "
+          f"with {args.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 17 2026
+# This file implements a load generator that simulates concurrent users of one app
+# replica, to find out how many users it can take before a rollout.
+# Users arrive at a configurable rate (Poisson arrivals, open loop), and each one runs
+# a session: upload and classify one image from test_picture/ (re-encoded at a mix of
+# sizes), switch the language, download the annotated image and send feedback.
+# For Gradio it awaits the real async handlers of app.py, with the routes' concurrency
+# limits. For Streamlit it reruns app_streamlit.py through Streamlit's AppTest (page
+# load and language switch) and runs the upload, classify and download steps with the
+# same functions the script calls, one thread per session as Streamlit does (AppTest
+# cannot upload files). The report gives throughput, latency percentiles and errors
+# for each step, plus resident memory sampled over the run, so growth from
+# per-rerun model reloads or leaked image copies shows up.
+#
+# Examples (offline, with a tiny stand-in model):
+#   python load_test.py gradio --tiny-model /tmp/tiny-vit --rate 4 --duration 60
+#   python load_test.py streamlit --tiny-model /tmp/tiny-vit --rate 1 --sizes 0 640 3000
+
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import argparse
+import asyncio
+import collections
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_picture")
+STEPS = ("page_load", "classify", "language", "download", "feedback")
+
+# The repo modules read their settings (model name, feedback path) from the
+# environment when they are imported, so they are imported in main() after
+# the command line has been applied to the environment
+
+
+# Re-encode every image at each size (longest side in pixels; 0 keeps the
+# original file) so the mix covers small phone uploads and large photos
+def image_mix(image_dir, sizes):
+    from benchmark import load_image_bytes
+
+    mix = []
+    for name, data in load_image_bytes(image_dir):
+        for size in sizes:
+            if size == 0:
+                mix.append((f"{name}@original", data))
+                continue
+            with Image.open(io.BytesIO(data)) as image:
+                image = image.convert("RGB")
+                scale = size / max(image.size)
+                image = image.resize((max(1, round(image.width * scale)),
+                                      max(1, round(image.height * scale))))
+            output = io.BytesIO()
+            image.save(output, format="JPEG", quality=90)
+            mix.append((f"{name}@{size}", output.getvalue()))
+    return mix
+
+
+# Current resident memory of this process in MB (peak RSS where /proc is missing)
+def current_rss_mb():
+    from benchmark import peak_rss_mb
+    from worker_pool import process_memory
+
+    memory = process_memory(os.getpid())
+    return memory["rss_mb"] if memory else peak_rss_mb()
+
+
+# Latencies, errors and memory samples of one run
+class LoadStats:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.defaultdict(collections.Counter)
+        self.memory = []
+        self.sessions = collections.Counter()
+        self._lock = threading.Lock()
+        self.start = None
+        self.duration = None
+
+    def record(self, step, seconds, error=None):
+        with self._lock:
+            if error is None:
+                self.latencies[step].append(seconds)
+            else:
+                self.errors[step][error] += 1
+
+    # Sample resident memory every `interval` seconds until `stop` is set
+    def sample_memory(self, stop, interval):
+        while True:
+            self.memory.append((round(time.perf_counter() - self.start, 1), current_rss_mb()))
+            if stop.wait(interval):
+                return
+
+    def report(self):
+        from benchmark import summarize
+
+        duration = self.duration
+        steps = {}
+        for step in STEPS:
+            successes = len(self.latencies[step])
+            failures = sum(self.errors[step].values())
+            if successes + failures == 0:
+                continue
+            steps[step] = dict(
+                summarize(self.latencies[step]),
+                requests=successes + failures,
+                per_s=round(successes / duration, 2),
+                error_rate=round(failures / (successes + failures), 4),
+                errors=dict(self.errors[step]),
+            )
+        requests = sum(step["requests"] for step in steps.values())
+        failures = sum(sum(step["errors"].values()) for step in steps.values())
+        # Growth is measured from the first sample, taken after the model loaded
+        settled = self.memory[0][1]
+        return {
+            "duration_s": round(duration, 2),
+            "sessions": dict(self.sessions),
+            "requests_per_s": round((requests - failures) / duration, 2),
+            "error_rate": round(failures / requests, 4) if requests else 0.0,
+            "steps": steps,
+            "memory": {
+                "start_mb": settled,
+                "end_mb": self.memory[-1][1],
+                "growth_mb": round(self.memory[-1][1] - settled, 1),
+                "peak_mb": max(value for _, value in self.memory),
+                "samples": self.memory,
+            },
+        }
+
+
+# Time one step of a session; gr.Error and other exceptions count as errors
+# under their class name, and the session stops at the first failed step
+async def timed(stats, step, awaitable):
+    start = time.perf_counter()
+    try:
+        value = await awaitable
+    except Exception as error:
+        stats.record(step, time.perf_counter() - start, type(error).__name__)
+        raise
+    stats.record(step, time.perf_counter() - start)
+    return value
+
+
+# One Gradio user: classify, switch the language, download, send feedback.
+# Each route goes through a semaphore with that route's concurrency_limit, as
+# Gradio's queue would.
+async def gradio_session(app, limits, stats, data, options, rng):
+    # Gradio saves the upload and passes its path (the image input is type="filepath")
+    descriptor, path = tempfile.mkstemp(prefix="waste_load_upload_")
+    with os.fdopen(descriptor, "wb") as file:
+        file.write(data)
+    threshold = options.threshold
+    try:
+        async with limits["classify"]:
+            outputs = await timed(stats, "classify",
+                                  app.waste_sorting(path, "English", threshold))
+    finally:
+        os.remove(path)
+    result, display_image, class_html, guidance, confidence = outputs[:5]
+    if rng.random() < options.language_fraction:
+        await timed(stats, "language", _completed(app.render_result, result, "Chinese",
+                                                   threshold))
+    if rng.random() < options.download_fraction:
+        async with limits["download"]:
+            path = await timed(stats, "download", app.download_result(
+                display_image, class_html, confidence, guidance, "JPEG"))
+        os.remove(path)
+    if rng.random() < options.feedback_fraction:
+        async with limits["feedback"]:
+            await timed(stats, "feedback", app.submit_feedback(
+                f"load test {rng.random():.6f}", "", result, threshold))
+
+
+# Awaitable for a synchronous handler (language changes call render_result
+# directly, outside Gradio's queue)
+async def _completed(function, *args):
+    return function(*args)
+
+
+# One Streamlit user, run on its own thread like a Streamlit session: load the
+# page, then the upload rerun's classification, a language-switch rerun, the
+# download and the feedback
+def streamlit_session(app_test_class, stats, data, options, rng):
+    from model_inference import classify_image, record_decision
+    from image_ingest import ingest_image
+    from annotation import annotate_image
+    from feedback_store import feedback_entry, get_feedback_store
+    import metrics
+
+    def step(name, function, *args):
+        start = time.perf_counter()
+        try:
+            value = function(*args)
+        except Exception as error:
+            stats.record(name, time.perf_counter() - start, type(error).__name__)
+            raise
+        stats.record(name, time.perf_counter() - start)
+        return value
+
+    def rerun(page):
+        page.run(timeout=options.timeout)
+        if page.exception:
+            raise RuntimeError(page.exception[0].message)
+        return page
+
+    def classify():
+        with metrics.request("classify"):
+            ingested = ingest_image(io.BytesIO(data))
+            result = classify_image(ingested.model_image)
+            record_decision(result, options.threshold)
+        return ingested, result
+
+    page = step("page_load", rerun, app_test_class.from_file(options.script))
+    ingested, result = step("classify", classify)
+    class_name, confidence = result.decide(options.threshold)
+    if rng.random() < options.language_fraction:
+        page.radio[0].set_value("Chinese")
+        step("language", rerun, page)
+    if rng.random() < options.download_fraction:
+        with metrics.request("download"):
+            step("download", annotate_image, ingested.display_image, class_name, confidence,
+                 f"Suggestion: Place {class_name} in the appropriate recycling bin.", "JPEG")
+    if rng.random() < options.feedback_fraction:
+        entry = feedback_entry(f"load test {rng.random():.6f}", result, options.threshold,
+                               source="streamlit")
+        with metrics.request("feedback"):
+            step("feedback", get_feedback_store().submit, entry)
+
+
+# Start sessions with exponential inter-arrival times for `duration` seconds,
+# then wait for the ones still running; memory is sampled throughout
+async def drive(start_session, stats, options):
+    rng = random.Random(options.seed)
+    tasks, active = [], set()
+    stats.start = time.perf_counter()
+    stop = threading.Event()
+    sampler = threading.Thread(target=stats.sample_memory, args=(stop, options.memory_interval),
+                               daemon=True)
+    sampler.start()
+    deadline = time.perf_counter() + options.duration
+    while time.perf_counter() < deadline:
+        if len(active) >= options.max_sessions:
+            stats.sessions["rejected"] += 1  # The client side is saturated
+        else:
+            task = asyncio.ensure_future(start_session(random.Random(rng.random())))
+            tasks.append(task)
+            active.add(task)
+            task.add_done_callback(active.discard)
+            stats.sessions["started"] += 1
+        await asyncio.sleep(rng.expovariate(options.rate))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    stats.sessions["failed"] += sum(isinstance(result, BaseException) for result in results)
+    stats.duration = time.perf_counter() - stats.start
+    stop.set()
+    sampler.join()
+
+
+def run_gradio(images, stats, options):
+    from model_inference import enable_batching, enable_corrections, enable_result_cache
+    from model_inference import get_client, warm_up
+    import app
+    import torch
+
+    # The same set-up as app.py's __main__, without launching the web server
+    torch.set_num_threads(app.TORCH_THREADS)
+    warm_up()
+    if get_client() is None:
+        enable_batching(app.MAX_BATCH_SIZE, app.BATCH_WINDOW_MS, app.MAX_QUEUE_SIZE)
+    enable_result_cache()
+    enable_corrections()
+
+    async def main():
+        limits = {"classify": asyncio.Semaphore(app.MAX_BATCH_SIZE),
+                  "download": asyncio.Semaphore(app.DOWNLOAD_CONCURRENCY),
+                  "feedback": asyncio.Semaphore(app.CPU_WORKERS)}
+
+        async def session(rng):
+            _, data = rng.choice(images)
+            await gradio_session(app, limits, stats, data, options, rng)
+
+        await drive(session, stats, options)
+
+    asyncio.run(main())
+
+
+def run_streamlit(images, stats, options):
+    from streamlit.testing.v1 import AppTest
+
+    # The first page load loads the model into Streamlit's resource cache
+    AppTest.from_file(options.script).run(timeout=max(options.timeout, 300))
+    executor = ThreadPoolExecutor(options.max_sessions, thread_name_prefix="streamlit-session")
+
+    async def main():
+        loop = asyncio.get_running_loop()
+
+        async def session(rng):
+            _, data = rng.choice(images)
+            await loop.run_in_executor(executor, streamlit_session, AppTest, stats, data,
+                                       options, rng)
+
+        await drive(session, stats, options)
+
+    try:
+        asyncio.run(main())
+    finally:
+        executor.shutdown()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate concurrent users of one app replica.")
+    parser.add_argument("app", choices=["gradio", "streamlit"])
+    parser.add_argument("--rate", type=float, default=2.0, help="New sessions per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to start sessions")
+    parser.add_argument("--max-sessions", type=int, default=64,
+                        help="Concurrent sessions before new arrivals are dropped")
+    parser.add_argument("--images", default=IMAGE_DIR, help="Folder of upload images")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[0, 640, 2048],
+                        help="Longest side of the re-encoded uploads (0 = original file)")
+    parser.add_argument("--model", help="Model name or path (default: WASTE_MODEL_NAME)")
+    parser.add_argument("--tiny-model", metavar="DIR",
+                        help="Create (if needed) and use a tiny random ViT from DIR")
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--language-fraction", type=float, default=0.5)
+    parser.add_argument("--download-fraction", type=float, default=0.3)
+    parser.add_argument("--feedback-fraction", type=float, default=0.1)
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="Seconds allowed for one Streamlit rerun")
+    parser.add_argument("--memory-interval", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the report to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    options.script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  "app_streamlit.py")
+    # The apps read their settings from the environment at import time
+    if options.tiny_model:
+        options.model = options.tiny_model
+    if options.model:
+        os.environ["WASTE_MODEL_NAME"] = options.model
+    # Keep load-test feedback out of the real feedback log and corrections
+    scratch = tempfile.TemporaryDirectory(prefix="waste_load_test_")
+    os.environ.setdefault("WASTE_FEEDBACK_PATH", os.path.join(scratch.name, "feedback.jsonl"))
+    os.environ.setdefault("WASTE_CORRECTIONS_DIR", os.path.join(scratch.name, "corrections"))
+    if options.tiny_model and not os.path.exists(os.path.join(options.tiny_model, "config.json")):
+        import model_inference
+        model_inference.save_tiny_model(options.tiny_model)
+
+    images = image_mix(options.images, options.sizes)
+    stats = LoadStats()
+    if options.app == "gradio":
+        run_gradio(images, stats, options)
+    else:
+        run_streamlit(images, stats, options)
+    import feedback_store
+    if feedback_store._store is not None:
+        feedback_store._store.close()  # Flush queued feedback before the scratch files go
+    scratch.cleanup()
+
+    report = dict({"app": options.app, "rate": options.rate, "images": len(images),
+                   "model": os.environ.get("WASTE_MODEL_NAME")}, **stats.report())
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
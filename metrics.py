@@ -0,0 +1,490 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 17 2026
+# This file implements the instrumentation layer shared by both frontends and the
+# inference server. Processing stages (decode, preprocess, forward, postprocess,
+# annotate, feedback_write) are timed into latency histograms, requests are counted
+# per route and outcome, predictions per class and low-confidence "trash" fallbacks
+# are counted, and queue depths and the model load time are exported as gauges.
+# Everything is kept in memory and rendered in the Prometheus text format by a small
+# HTTP endpoint. Recording is a perf_counter call and a short locked update, so it
+# is always on; the endpoint, one JSON log line per request and a sampling profiler
+# that keeps flame-graph-ready stacks of the slowest requests are opt-in.
+#
+# Example:
+#   WASTE_METRICS_PORT=9100 WASTE_PROFILE_SLOWEST=5 python app.py
+#   curl http://127.0.0.1:9100/metrics
+#   curl http://127.0.0.1:9100/profiles/0 > slowest.folded  # flamegraph.pl / speedscope
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+import bisect
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+import warnings
+
+# Port of the metrics endpoint (0 disables it) and the interface it binds to
+METRICS_PORT = int(os.environ.get("WASTE_METRICS_PORT", "0"))
+METRICS_HOST = os.environ.get("WASTE_METRICS_HOST", "127.0.0.1")
+# Set WASTE_STRUCTURED_LOGS=1 to log one JSON line per request to stderr
+STRUCTURED_LOGS = os.environ.get("WASTE_STRUCTURED_LOGS", "") not in ("", "0")
+# Keep sampled stacks of the N slowest requests (0 disables the profiler)
+PROFILE_SLOWEST = int(os.environ.get("WASTE_PROFILE_SLOWEST", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("WASTE_PROFILE_INTERVAL_MS", "5"))
+
+# Histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+# Type and help text of every exported metric
+METRICS = {
+    "waste_stage_seconds": ("histogram", "Time spent in each processing stage"),
+    "waste_request_seconds": ("histogram", "End-to-end request latency per route"),
+    "waste_requests_total": ("counter", "Requests per route and outcome"),
+    "waste_predictions_total": ("counter", "Classifications per predicted class"),
+    "waste_trash_fallbacks_total": (
+        "counter", "Predictions below the confidence threshold reported as trash"
+    ),
+    "waste_queue_depth": ("gauge", "Requests waiting in each queue"),
+    "waste_model_load_seconds": ("gauge", "Time taken to load the model"),
+}
+
+request_logger = logging.getLogger("waste_sorting.requests")
+
+
+# Cumulative-bucket histogram; updated under the registry lock
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# In-memory store of counters, histograms and gauges. Labels are passed as a
+# dict; gauges are functions evaluated when the metrics are rendered.
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # name -> {label tuple: value}
+        self._histograms = {}  # name -> {label tuple: Histogram}
+        self._gauges = {}  # name -> {label tuple: function}
+
+    def increment(self, name, labels=None, amount=1):
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            values = self._counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, value, labels=None):
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram()
+            histogram.observe(value)
+
+    # Register (or replace) a gauge; `function` returns a number or None
+    def gauge(self, name, function, labels=None):
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            self._gauges.setdefault(name, {})[key] = function
+
+    # Prometheus text exposition format (version 0.0.4)
+    def render(self):
+        with self._lock:
+            counters = {name: dict(values) for name, values in self._counters.items()}
+            histograms = {
+                name: {key: (list(item.counts), item.sum, item.count, item.buckets)
+                       for key, item in values.items()}
+                for name, values in self._histograms.items()
+            }
+            gauges = {name: dict(values) for name, values in self._gauges.items()}
+        lines = []
+        for name in sorted(set(counters) | set(histograms) | set(gauges)):
+            kind, description = METRICS.get(
+                name, ("histogram" if name in histograms else
+                       "counter" if name in counters else "gauge", name)
+            )
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(counters.get(name, {}).items()):
+                lines.append(f"{name}{_labels(key)} {_number(value)}")
+            for key, (counts, total, count, buckets) in sorted(histograms.get(name, {}).items()):
+                cumulative = 0
+                for bound, bucket_count in zip(buckets + (math.inf,), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    lines.append(f"{name}_bucket{_labels(key + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(key)} {_number(total)}")
+                lines.append(f"{name}_count{_labels(key)} {count}")
+            for key, function in sorted(gauges.get(name, {}).items()):
+                value = _call_gauge(function)
+                if value is not None:
+                    lines.append(f"{name}{_labels(key)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# A gauge function's value, or None when it is unavailable or fails
+def _call_gauge(function):
+    try:
+        return function()
+    except Exception:
+        return None
+
+
+def _labels(key):
+    if not key:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for _, value in key)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Process-wide registry used by every module
+REGISTRY = MetricsRegistry()
+
+
+# Per-request record of stage times, annotations and (when profiled) stack samples
+class RequestTrace:
+    def __init__(self, route):
+        self.route = route
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.stages = {}  # Stage name -> seconds spent in this request
+        self.fields = {}  # Extra values for the request log (class, confidence, ...)
+        self.samples = Counter()  # Collapsed stack -> sample count
+        self.threads = set()  # Threads currently working for this request
+
+    def annotate(self, **fields):
+        self.fields.update(fields)
+
+
+# A context variable rather than a thread-local, so that async handlers
+# sharing one event-loop thread each see their own request
+_current = contextvars.ContextVar("waste_request_trace", default=None)
+
+
+# Trace of the request running in this thread or task, or None
+def current_trace():
+    return _current.get()
+
+
+# Run fn(*args) as part of `trace`; used for work handed to executor threads,
+# which do not inherit the caller's context
+def run_traced(trace, fn, *args):
+    if trace is None:
+        return fn(*args)
+    token = _current.set(trace)
+    thread_id = threading.get_ident()
+    trace.threads.add(thread_id)
+    try:
+        return fn(*args)
+    finally:
+        trace.threads.discard(thread_id)
+        _current.reset(token)
+
+
+# Add a stage duration measured elsewhere
+def record_stage(name, seconds):
+    REGISTRY.observe("waste_stage_seconds", seconds, {"stage": name})
+    trace = current_trace()
+    if trace is not None:
+        trace.stages[name] = trace.stages.get(name, 0.0) + seconds
+
+
+# Time a processing stage:  with metrics.stage("preprocess"): ...
+class stage:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        record_stage(self.name, time.perf_counter() - self.start)
+        return False
+
+
+# Count one prediction per class, and whether it was a low-confidence fallback
+def record_prediction(class_name, fallback=False):
+    REGISTRY.increment("waste_predictions_total", {"class": class_name})
+    if fallback:
+        REGISTRY.increment("waste_trash_fallbacks_total")
+    trace = current_trace()
+    if trace is not None:
+        trace.annotate(predicted_class=class_name, fallback=fallback)
+
+
+# Register a gauge on the shared registry
+def gauge(name, function, labels=None):
+    REGISTRY.gauge(name, function, labels)
+
+
+# Time one user request:  with metrics.request("classify") as trace: ...
+# Stages timed in this thread or task are attributed to the request. On exit
+# the latency and outcome are recorded, a JSON line is logged when structured
+# logs are on, and the request is offered to the slow-request profiler. Async
+# handlers pass sample_thread=False so the profiler samples only the executor
+# threads doing the work (see run_traced), not the shared event loop.
+class request:
+    def __init__(self, route, sample_thread=True):
+        self.route = route
+        self.sample_thread = sample_thread
+
+    def __enter__(self):
+        self.trace = RequestTrace(self.route)
+        if self.sample_thread:
+            self.trace.threads.add(threading.get_ident())
+        self.token = _current.set(self.trace)
+        if _profiler is not None:
+            _profiler.track(self.trace)
+        return self.trace
+
+    def __exit__(self, exc_type, exc, traceback):
+        trace = self.trace
+        trace.seconds = time.perf_counter() - trace.start
+        _current.reset(self.token)
+        if exc_type is None:
+            status = "ok"
+        elif issubclass(exc_type, asyncio.CancelledError):
+            status = "cancelled"
+        else:
+            status = "error"
+        REGISTRY.observe("waste_request_seconds", trace.seconds, {"route": trace.route})
+        REGISTRY.increment("waste_requests_total", {"route": trace.route, "status": status})
+        if _profiler is not None:
+            _profiler.finish(trace)
+        # Only when structured logs were turned on: the logger level alone is not
+        # enough, since an app's root logging config can put it at INFO
+        if _structured_logs and request_logger.isEnabledFor(logging.INFO):
+            record = {
+                "ts": time.time(),
+                "route": trace.route,
+                "status": status,
+                "ms": round(trace.seconds * 1000, 3),
+                "stages_ms": {name: round(seconds * 1000, 3)
+                              for name, seconds in trace.stages.items()},
+            }
+            record.update(trace.fields)
+            if exc_type is not None:
+                record["error"] = exc_type.__name__
+            request_logger.info(json.dumps(record, default=str))
+        return False
+
+
+# One line of a collapsed ("folded") stack: root;...;leaf
+def _collapse(frame, max_depth=64):
+    names = []
+    while frame is not None and len(names) < max_depth:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+# Sampling profiler for the slowest requests. A background thread samples the
+# stack of every thread working for a request every `interval_ms`; when a
+# request ends its samples are kept if it is among the `slowest` seen so far.
+# Work done for a request on another thread (the micro-batcher) shows up as
+# the request thread waiting for its result.
+class SlowRequestProfiler:
+    def __init__(self, slowest=5, interval_ms=PROFILE_INTERVAL_MS):
+        self.slowest = slowest
+        self.interval = interval_ms / 1000.0
+        self._active = set()  # Traces of the requests in progress
+        self._kept = []  # Min-heap of (seconds, sequence, trace)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="request-profiler",
+                                        daemon=True)
+        self._thread.start()
+
+    def track(self, trace):
+        with self._lock:
+            self._active.add(trace)
+
+    def finish(self, trace):
+        with self._lock:
+            self._active.discard(trace)
+            if not trace.samples:
+                return  # Shorter than the sampling interval
+            entry = (trace.seconds, next(self._sequence), trace)
+            if len(self._kept) < self.slowest:
+                heapq.heappush(self._kept, entry)
+            elif entry[0] > self._kept[0][0]:
+                heapq.heapreplace(self._kept, entry)
+
+    # Kept profiles, slowest first
+    def profiles(self):
+        with self._lock:
+            kept = sorted(self._kept, key=lambda item: item[0], reverse=True)
+        return [trace for _, _, trace in kept]
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                for trace in self._active:
+                    for thread_id in list(trace.threads):
+                        frame = frames.get(thread_id)
+                        if frame is not None:
+                            trace.samples[_collapse(frame)] += 1
+            del frames
+
+
+# Collapsed-stack text of a profile, the input format of flamegraph.pl,
+# speedscope and similar tools
+def folded_profile(trace):
+    return "".join(f"{stack} {count}\n" for stack, count in trace.samples.most_common())
+
+
+_profiler = None
+
+
+# Start keeping sampled stacks of the `slowest` slowest requests
+def enable_profiler(slowest=5, interval_ms=PROFILE_INTERVAL_MS):
+    global _profiler
+    disable_profiler()
+    _profiler = SlowRequestProfiler(slowest, interval_ms)
+    return _profiler
+
+
+def disable_profiler():
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None:
+        profiler.close()
+
+
+# Summaries of the kept slow-request profiles, slowest first
+def profile_summaries():
+    if _profiler is None:
+        return []
+    return [
+        {"index": index, "route": trace.route, "ms": round(trace.seconds * 1000, 3),
+         "samples": sum(trace.samples.values()),
+         "stages_ms": {name: round(seconds * 1000, 3) for name, seconds in trace.stages.items()},
+         **trace.fields}
+        for index, trace in enumerate(_profiler.profiles())
+    ]
+
+
+# Write every kept profile as a .folded file; returns the paths
+def write_profiles(directory):
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for index, trace in enumerate(_profiler.profiles() if _profiler is not None else []):
+        path = os.path.join(directory, f"{index:02d}-{trace.route}-{trace.seconds * 1000:.0f}ms.folded")
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(folded_profile(trace))
+        paths.append(path)
+    return paths
+
+
+_structured_logs = False
+
+
+# Log one JSON line per request to `stream` (stderr by default)
+def enable_structured_logs(stream=None):
+    global _structured_logs
+    _structured_logs = True
+    if not any(getattr(handler, "_waste_metrics", False) for handler in request_logger.handlers):
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        handler._waste_metrics = True
+        request_logger.addHandler(handler)
+    request_logger.setLevel(logging.INFO)
+    request_logger.propagate = False
+
+
+def disable_structured_logs():
+    global _structured_logs
+    _structured_logs = False
+
+
+# Response (status, content type, body) for a metrics path, or None for other
+# paths; shared by the metrics server and the inference server
+def handle_metrics_path(path):
+    if path == "/metrics":
+        return 200, "text/plain; version=0.0.4; charset=utf-8", REGISTRY.render().encode()
+    if path == "/profiles":
+        return 200, "application/json", json.dumps(profile_summaries()).encode()
+    if path.startswith("/profiles/"):
+        profiles = _profiler.profiles() if _profiler is not None else []
+        index = path.rsplit("/", 1)[-1]
+        if not index.isdigit() or int(index) >= len(profiles):
+            return 404, "application/json", json.dumps({"error": "no such profile"}).encode()
+        return 200, "text/plain; charset=utf-8", folded_profile(profiles[int(index)]).encode()
+    return None
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        response = handle_metrics_path(self.path.split("?", 1)[0])
+        status, content_type, body = response or (
+            404, "application/json", json.dumps({"error": "not found"}).encode()
+        )
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Serve /metrics, /profiles and /profiles/<n> from a daemon thread
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+_server = None
+
+
+# Turn on the opt-in parts from the environment (or arguments): the metrics
+# endpoint, structured request logs and the slow-request profiler. Safe to call
+# more than once; a port that is already in use only produces a warning.
+def enable_metrics(port=METRICS_PORT, structured_logs=STRUCTURED_LOGS,
+                   profile_slowest=PROFILE_SLOWEST):
+    global _server
+    if port and _server is None:
+        try:
+            _server = start_metrics_server(port)
+        except OSError as error:
+            warnings.warn(f"Could not serve metrics on port {port}: {error}")
+    if structured_logs:
+        enable_structured_logs()
+    if profile_slowest and _profiler is None:
+        enable_profiler(profile_slowest)
+    return _server
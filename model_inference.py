@@ -7,21 +7,348 @@
 # into categories such as biodegradable, cardboard, glass, metal, paper, plastic, and trash.
 # The file includes functions for image preprocessing, model inference, 
 # and applying a confidence threshold to assign low-confidence predictions as "trash."
+# The model is owned by a single, lazily-loaded inference engine shared by both frontends.
 # Additionally, it defines waste category descriptions in both English and Chinese 
 # to provide users with recycling guidance.
 
-from transformers import AutoFeatureExtractor, AutoModelForImageClassification
+from transformers import AutoFeatureExtractor
+from transformers import ViTConfig, ViTForImageClassification, ViTImageProcessor
 from PIL import Image
+from batch_scheduler import MicroBatchScheduler
+import backends
+import metrics
+import token_merging
+from correction_index import CORRECTIONS_DIR, MIN_SIMILARITY, CorrectionIndex
+from result_cache import ResultCache, image_key
+import asyncio
+import numpy as np
+import os
+import threading
+import time
 import torch
+import warnings
 
-# Load the feature extractor and model
-feature_extractor = AutoFeatureExtractor.from_pretrained(
-    "edwinpalegre/ee8225-group4-vit-trashnet-enhanced"
-)
-model = AutoModelForImageClassification.from_pretrained(
-    "edwinpalegre/ee8225-group4-vit-trashnet-enhanced"
+# Hugging Face model id (or local directory) used by every frontend
+MODEL_NAME = os.environ.get(
+    "WASTE_MODEL_NAME", "edwinpalegre/ee8225-group4-vit-trashnet-enhanced"
 )
 
+# Execution backend: eager, int8, bf16, compile or onnx (see backends.py)
+BACKEND = os.environ.get("WASTE_BACKEND", "eager")
+
+# Result cache sizing; set WASTE_CACHE_DIR to also keep results on disk
+CACHE_MAX_ENTRIES = int(os.environ.get("WASTE_CACHE_ENTRIES", "1024"))
+CACHE_MAX_MB = float(os.environ.get("WASTE_CACHE_MB", "64"))
+CACHE_DIR = os.environ.get("WASTE_CACHE_DIR") or None
+
+# Fraction of patch tokens merged after each encoder layer in the token-merging
+# fast mode (see token_merging.py); 0 disables it
+TOKEN_MERGING = float(os.environ.get("WASTE_TOKEN_MERGING", "0"))
+
+# Set WASTE_CASCADE=1 to answer confident images after the first encoder layers
+# with the calibrated cascade (see cascade.py)
+CASCADE = os.environ.get("WASTE_CASCADE", "") not in ("", "0")
+
+# Set WASTE_CALIBRATION=1 to apply the temperature and per-class thresholds
+# fitted by `python calibration.py calibrate` to every decision
+CALIBRATION = os.environ.get("WASTE_CALIBRATION", "") not in ("", "0")
+
+# URL of a shared inference server (see inference_server.py); when set, the
+# frontends send images there instead of loading the model in-process
+INFERENCE_URL = os.environ.get("WASTE_INFERENCE_URL") or None
+
+
+# Process-wide inference engine that owns the feature extractor and model.
+# Weights are loaded lazily on first use and shared by every caller, so
+# Streamlit reruns and Gradio requests never reload or duplicate them.
+class InferenceEngine:
+    def __init__(self, model_name=MODEL_NAME, fast_preprocessing=True, backend=BACKEND,
+                 artifact_dir=backends.ARTIFACT_DIR, token_merging=TOKEN_MERGING):
+        if backend not in backends.BACKENDS:
+            raise ValueError(
+                f"Unknown backend {backend!r}; choose one of {', '.join(backends.BACKENDS)}"
+            )
+        self.model_name = model_name
+        self.fast_preprocessing = fast_preprocessing
+        self.backend = backend
+        self.artifact_dir = artifact_dir
+        self.token_merging = token_merging
+        self.load_seconds = None
+        self.load_report = None
+        self._feature_extractor = None
+        self._model = None
+        self._forward = None
+        self._captured = threading.local()  # Embeddings of this thread's last forward
+        self.cascade = None  # Two-stage CascadeModel, when enabled
+        self.cascade_source = None  # "<path>@<mtime>" of the loaded cascade file
+        self._weights_fingerprint = None
+        self._lock = threading.Lock()
+
+    # Load the feature extractor and model once, guarded against concurrent callers
+    def load(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    start = time.perf_counter()
+                    feature_extractor = AutoFeatureExtractor.from_pretrained(
+                        self.model_name
+                    )
+                    processor_seconds = time.perf_counter() - start
+                    model, forward, report = backends.load_backend(
+                        self.model_name, self.backend, self.artifact_dir
+                    )
+                    if self.token_merging:
+                        if self.backend == "onnx":
+                            warnings.warn("Token merging does not apply to the onnx backend")
+                        else:
+                            token_merging.apply_token_merging(model, self.token_merging)
+                    classifier = getattr(model, "classifier", None)
+                    if classifier is not None:
+                        classifier.register_forward_pre_hook(self._capture_embeddings)
+                    self._feature_extractor = feature_extractor
+                    self._forward = forward
+                    self._model = model
+                    self.load_seconds = time.perf_counter() - start
+                    report["processor_s"] = round(processor_seconds, 4)
+                    report["total_s"] = round(self.load_seconds, 4)
+                    self.load_report = report
+        return self
+
+    @property
+    def is_loaded(self):
+        return self._model is not None
+
+    # Everything that changes this engine's outputs for the same pixels: the
+    # weights, backend, token-merging ratio and cascade. Result cache keys are
+    # salted with it, so a cached result (also on disk, across restarts) is
+    # never served under a different configuration.
+    @property
+    def cache_salt(self):
+        if self._weights_fingerprint is None:
+            try:
+                self._weights_fingerprint = backends.weights_fingerprint(
+                    self.model_name, self.artifact_dir
+                )[:16]
+            except OSError:
+                self._weights_fingerprint = "unknown"
+        if self.cascade is None:
+            cascade = "off"
+        else:
+            cascade = self.cascade_source or f"unsaved-{id(self.cascade)}"
+        return (f"{self.model_name}|weights={self._weights_fingerprint}|backend={self.backend}"
+                f"|token_merging={self.token_merging:g}|cascade={cascade}")
+
+    @property
+    def feature_extractor(self):
+        return self.load()._feature_extractor
+
+    @property
+    def model(self):
+        return self.load()._model
+
+    # Convert a list of images into a batched pixel tensor
+    def preprocess(self, images):
+        if self.fast_preprocessing:
+            return fast_preprocess(images, self.feature_extractor)
+        return reference_preprocess(images, self.feature_extractor)
+
+    # Forward pre-hook on the classification head: its input is the pooled
+    # [CLS] embedding, kept for the thread running the forward pass
+    def _capture_embeddings(self, module, inputs):
+        self._captured.embeddings = inputs[0].detach()
+
+    # Run the full model on an already-preprocessed batch and return raw logits.
+    # This always skips the cascade (it is the cascade's reference); use
+    # forward_outputs for what the apps serve.
+    def forward_logits(self, pixel_values):
+        return self.load()._forward(pixel_values)
+
+    # Run the model once and return (logits, embeddings). The embeddings come from
+    # the same forward pass; they are None for the onnx backend, which does not
+    # run the PyTorch module, and in cascade mode, where early answers have none.
+    def forward_features(self, pixel_values):
+        self.load()
+        if self.cascade is not None:
+            return self.cascade(pixel_values), None
+        self._captured.embeddings = None
+        logits = self._forward(pixel_values)
+        embeddings = self._captured.embeddings
+        self._captured.embeddings = None
+        return logits, None if embeddings is None else embeddings.float()
+
+    # Logits followed by the embedding in every row ([N, classes + hidden]),
+    # the form that is batched and cached by the module-level helpers
+    def forward_outputs(self, pixel_values):
+        logits, embeddings = self.forward_features(pixel_values)
+        if embeddings is None:
+            return logits
+        return torch.cat([logits, embeddings], dim=1)
+
+    # Compute raw full-model logits for a list of images in a single forward
+    # pass (like forward_logits, never through the cascade)
+    def predict_logits(self, images):
+        return self.forward_logits(self.preprocess(images))
+
+    # Logits and embeddings for a list of images (see forward_outputs); goes
+    # through the cascade when it is enabled
+    def predict_outputs(self, images):
+        return self.forward_outputs(self.preprocess(images))
+
+    # Load the weights and run a dummy forward pass so the first real
+    # request doesn't pay for lazy initialisation inside PyTorch.
+    # The fast preprocessing path is also checked against the feature
+    # extractor here and disabled if the two disagree.
+    def warm_up(self):
+        if self.fast_preprocessing:
+            difference = preprocessing_max_abs_diff(
+                [_gradient_image(320, 240)], self.feature_extractor
+            )
+            if difference > PREPROCESSING_TOLERANCE:
+                warnings.warn(
+                    f"Fast preprocessing differs from the feature extractor by "
+                    f"{difference:.2e}; falling back to the feature extractor."
+                )
+                self.fast_preprocessing = False
+        self.predict_logits([Image.new("RGB", (224, 224))])
+        return self
+
+    # Compare this engine's backend with float32 eager (without token merging,
+    # whatever WASTE_TOKEN_MERGING says) on a folder of images: label agreement,
+    # max probability drift and per-image latency
+    def agreement_report(self, folder, threshold=0.7):
+        reference = InferenceEngine(self.model_name, backend="eager", token_merging=0)
+        images = backends.load_folder_images(folder)
+        return backends.agreement_report(self, reference, images, threshold)
+
+
+# Largest per-pixel difference allowed between the fast preprocessing path and
+# the Hugging Face feature extractor
+PREPROCESSING_TOLERANCE = 1e-4
+
+
+# Convert an image (PIL image or HxW[xC] uint8 array) to an RGB PIL image
+def _as_rgb_image(image):
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(np.asarray(image))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image
+
+
+# Preprocess images with the Hugging Face feature extractor (reference path)
+def reference_preprocess(images, feature_extractor):
+    images = [_as_rgb_image(image) for image in images]
+    return feature_extractor(images=images, return_tensors="pt")["pixel_values"]
+
+
+# Rescale and normalisation of the feature extractor folded into one multiply
+# and one add: (x * rescale - mean) / std  ==  x * (rescale / std) - mean / std.
+# Returns (multiplier, offset), each shaped [1, 3, 1, 1].
+def normalization_constants(feature_extractor):
+    scale = feature_extractor.rescale_factor if feature_extractor.do_rescale else 1.0
+    mean = np.zeros(3)
+    std = np.ones(3)
+    if feature_extractor.do_normalize:
+        mean = np.asarray(feature_extractor.image_mean, dtype=np.float64)
+        std = np.asarray(feature_extractor.image_std, dtype=np.float64)
+    multiplier = torch.tensor(scale / std, dtype=torch.float32).view(1, 3, 1, 1)
+    offset = torch.tensor(-mean / std, dtype=torch.float32).view(1, 3, 1, 1)
+    return multiplier, offset
+
+
+# Vectorized equivalent of the feature extractor: each image is resized once
+# with PIL straight into a preallocated uint8 batch, then the whole batch is
+# rescaled and normalised in a single fused in-place pass
+def fast_preprocess(images, feature_extractor):
+    size = feature_extractor.size
+    height, width = size["height"], size["width"]
+    batch = np.empty((len(images), height, width, 3), dtype=np.uint8)
+    for index, image in enumerate(images):
+        image = _as_rgb_image(image)
+        if feature_extractor.do_resize and image.size != (width, height):
+            image = image.resize((width, height), feature_extractor.resample)
+        batch[index] = np.asarray(image)
+
+    multiplier, offset = normalization_constants(feature_extractor)
+    pixel_values = torch.empty((len(images), 3, height, width), dtype=torch.float32)
+    pixel_values.copy_(torch.from_numpy(batch).permute(0, 3, 1, 2))
+    return pixel_values.mul_(multiplier).add_(offset)
+
+
+# Largest absolute difference between the fast path and the feature extractor
+def preprocessing_max_abs_diff(images, feature_extractor):
+    fast = fast_preprocess(images, feature_extractor)
+    reference = reference_preprocess(images, feature_extractor)
+    return (fast - reference).abs().max().item()
+
+
+# Deterministic test image with smooth gradients and sharp edges, used to
+# compare the two preprocessing paths including the resize step
+def _gradient_image(width, height):
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    red = np.broadcast_to(x, (height, width))
+    green = np.broadcast_to(y, (height, width))
+    blue = ((np.arange(width) // 16 + np.arange(height)[:, None] // 16) % 2) * 255.0
+    pixels = np.stack([red, green, blue], axis=-1).astype(np.uint8)
+    return Image.fromarray(pixels)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+metrics.gauge("waste_model_load_seconds",
+              lambda: _engine.load_seconds if _engine is not None else None)
+
+
+# Return the shared engine, creating it (but not loading weights) on first call
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = InferenceEngine()
+    return _engine
+
+
+# Replace the shared engine, e.g. with one pointing at a local model directory
+def set_engine(engine):
+    global _engine
+    with _engine_lock:
+        _engine = engine
+    return engine
+
+
+# Save a tiny randomly-initialised ViT with the same labels and preprocessing
+# as the real model. Benchmarks, the inference server and load tests use it to
+# run offline; its predictions are meaningless.
+def save_tiny_model(output_dir, hidden_size=32, num_layers=2, seed=0):
+    torch.manual_seed(seed)
+    config = ViTConfig(
+        hidden_size=hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=2,
+        intermediate_size=hidden_size * 2,
+        image_size=224,
+        patch_size=16,
+        id2label=dict(enumerate(trash_classes)),
+        label2id={name: index for index, name in enumerate(trash_classes)},
+    )
+    ViTForImageClassification(config).save_pretrained(output_dir)
+    ViTImageProcessor(
+        size={"height": 224, "width": 224},
+        image_mean=[0.5, 0.5, 0.5],
+        image_std=[0.5, 0.5, 0.5],
+    ).save_pretrained(output_dir)
+    return output_dir
+
+
+# Keep `model_inference.model` / `.feature_extractor` working for existing
+# callers without loading the weights at import time
+def __getattr__(name):
+    if name in ("model", "feature_extractor"):
+        return getattr(get_engine(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 # Waste classification labels and descriptions
 trash_classes = [
     "biodegradable", "cardboard", "glass", "metal", "paper", "plastic", "trash"
@@ -79,26 +406,454 @@ class_descriptions = {
 
 # Image preprocessing function
 def preprocess_image(image):
-    inputs = feature_extractor(images=image, return_tensors="pt")
+    inputs = {"pixel_values": get_engine().preprocess([image])}
     return inputs
 
 
-# Classification function with confidence threshold for trash
-def classify_image_with_trash_threshold(image, threshold=0.7):
-    inputs = preprocess_image(image)  # Preprocess the image
-    with torch.no_grad():  # Disable gradient calculations for inference
-        outputs = model(**inputs)  # Perform model inference
-        logits = outputs.logits
-        probabilities = torch.softmax(logits, dim=1)[0]  # Compute probabilities
-        predicted_class = probabilities.argmax().item()  # Get the most probable class
-        confidence = probabilities[predicted_class].item()  # Confidence of the prediction
-
-    # Apply threshold to classify low-confidence predictions as "trash"
-    if confidence < threshold:
-        class_name = "trash"
-        confidence = threshold  # Set a default confidence for trash classification
+_scheduler = None
+metrics.gauge("waste_queue_depth",
+              lambda: _scheduler.queue_depth if _scheduler is not None else 0,
+              {"queue": "inference"})
+
+
+# Route single-image inference through a shared micro-batching scheduler.
+# Callers still preprocess in their own threads; only the forward pass is batched.
+def enable_batching(max_batch_size=8, window_ms=10, max_queue_size=64):
+    global _scheduler
+    disable_batching()
+    _scheduler = MicroBatchScheduler(
+        lambda batch: get_engine().forward_outputs(torch.cat(batch)),
+        max_batch_size=max_batch_size,
+        window_ms=window_ms,
+        max_queue_size=max_queue_size,
+        name="inference-batcher",
+    )
+    return _scheduler
+
+
+# Go back to running one forward pass per call
+def disable_batching():
+    global _scheduler
+    scheduler, _scheduler = _scheduler, None
+    if scheduler is not None:
+        scheduler.close()
+
+
+_result_cache = None
+
+
+# Put a content-addressed logits cache in front of the model
+def enable_result_cache(max_entries=CACHE_MAX_ENTRIES, max_mb=CACHE_MAX_MB,
+                        disk_dir=CACHE_DIR):
+    global _result_cache
+    _result_cache = ResultCache(max_entries, int(max_mb * 1024 * 1024), disk_dir)
+    return _result_cache
+
+
+def disable_result_cache():
+    global _result_cache
+    _result_cache = None
+
+
+# Hit/miss counters of the result cache, or None when caching is off
+def result_cache_stats():
+    return _result_cache.stats() if _result_cache is not None else None
+
+
+# Cache key of an image for the current engine configuration (see cache_salt)
+def _cache_key(image):
+    return image_key(image, salt=INFERENCE_URL or get_engine().cache_salt)
+
+
+_client = None
+
+
+# Client for the inference server, or None when inference runs in-process
+def get_client():
+    global _client
+    if INFERENCE_URL and _client is None:
+        from inference_server import InferenceClient
+        _client = InferenceClient(INFERENCE_URL)
+    return _client
+
+
+# Prepare whichever backend serves requests: wait for the inference server,
+# or load and warm up the in-process engine
+def warm_up():
+    client = get_client()
+    if client is not None:
+        client.wait_ready()
+    elif CASCADE and get_engine().cascade is None:
+        enable_cascade()
+    if CALIBRATION and _calibration is None:
+        enable_calibration()  # After the cascade: it is part of the calibration's key
+    return client or get_engine().warm_up()
+
+
+# Route in-process inference through the calibrated two-stage cascade saved by
+# `python cascade.py calibrate` (or the file at `path`)
+def enable_cascade(path=None):
+    from cascade import cascade_path, load_cascade
+    engine = get_engine()
+    path = path or cascade_path(engine.model_name, engine.artifact_dir)
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"No calibrated cascade at {path}; run: python cascade.py calibrate FOLDER"
+        )
+    if engine.backend not in ("eager", "int8"):
+        warnings.warn(
+            f"The cascade runs the PyTorch encoder layers directly, so the "
+            f"{engine.backend} backend's optimizations are not used in cascade mode"
+        )
+    engine.cascade = load_cascade(engine.model, path)
+    engine.cascade_source = f"{path}@{os.stat(path).st_mtime_ns}"
+    _warn_cascade_corrections()
+    return engine.cascade
+
+
+def disable_cascade():
+    get_engine().cascade = None
+    get_engine().cascade_source = None
+
+
+# Early cascade answers have no final-layer embedding, so user corrections can
+# neither be looked up nor recorded for them
+def _warn_cascade_corrections():
+    if _correction_index is not None and _engine is not None and _engine.cascade is not None:
+        warnings.warn("User corrections are not applied while the cascade is enabled; "
+                      "disable WASTE_CASCADE to use them")
+
+
+_calibration = None
+
+
+# Apply the temperature and per-class thresholds saved by
+# `python calibration.py calibrate` (or the file at `path`) to every decision.
+# Calibration only changes post-processing, so it also applies to logits from
+# the inference server. The default file is the one calibrated for the current
+# model, backend, token-merging ratio and cascade (the server's, with a client).
+def enable_calibration(path=None):
+    global _calibration
+    from calibration import calibration_path, engine_calibration_path, load_calibration
+    client = get_client()
+    if path is None and client is not None:
+        path = calibration_path(client.info["model"], client.info["backend"],
+                                token_merging=TOKEN_MERGING)
+    path = path or engine_calibration_path(get_engine())
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"No calibration at {path}; run: python calibration.py calibrate FOLDER"
+        )
+    _calibration = load_calibration(path)
+    return _calibration
+
+
+def disable_calibration():
+    global _calibration
+    _calibration = None
+
+
+# Per-stage routing statistics of the cascade, or None when it is off
+def cascade_stats():
+    cascade = get_engine().cascade
+    return cascade.stats(trash_classes) if cascade is not None else None
+
+
+# Run the model for one image, batched with concurrent callers when enabled.
+# Returns the logits followed by the embedding (logits only from the server).
+# The "forward" stage includes the wait for a batch or the server round trip.
+def _compute_image_outputs(image):
+    client = get_client()
+    if client is not None:
+        with metrics.stage("forward"):
+            return client.predict_logits([image])[0]  # The server batches requests
+    with metrics.stage("preprocess"):
+        pixel_values = preprocess_image(image)["pixel_values"]
+    with metrics.stage("forward"):
+        if _scheduler is not None:
+            return _scheduler(pixel_values)
+        return get_engine().forward_outputs(pixel_values)[0]
+
+
+# Logits and embedding of one image, served from the result cache when possible
+def predict_image_outputs(image, key=None):
+    if _result_cache is None:
+        return _compute_image_outputs(image)
+    outputs = _result_cache.get_or_compute(
+        key or _cache_key(image), lambda: _compute_image_outputs(image).numpy()
+    )
+    return torch.from_numpy(outputs)
+
+
+# Raw logits for one image
+def predict_image_logits(image, key=None):
+    return predict_image_outputs(image, key)[:len(trash_classes)]
+
+
+_correction_index = None
+
+
+# Let user-corrected labels override the model for very similar images
+def enable_corrections(directory=CORRECTIONS_DIR, min_similarity=MIN_SIMILARITY):
+    global _correction_index
+    _correction_index = CorrectionIndex(directory, trash_classes, min_similarity)
+    _warn_cascade_corrections()
+    return _correction_index
+
+
+def disable_corrections():
+    global _correction_index
+    _correction_index = None
+
+
+# Record a user's corrected label for a classification result, so that the
+# same or very similar images get that label from now on
+def submit_correction(result, label):
+    if _correction_index is None:
+        raise RuntimeError("Corrections are not enabled")
+    if result.embedding is None:
+        raise ValueError(
+            "No embedding is available for this result (onnx backend or inference server)"
+        )
+    _correction_index.add(result.embedding, label, result.image_key)
+    result.correction = (label, 1.0)
+
+
+# Probabilities of a batch of logits: one softmax, temperature-scaled when
+# calibration is enabled
+def calibrated_probabilities(logits):
+    logits = torch.as_tensor(logits)
+    if _calibration is not None:
+        return _calibration.probabilities(logits)
+    return torch.softmax(logits.float(), dim=-1)
+
+
+# Confidence threshold of every class: the calibrated per-class thresholds,
+# with `threshold` for classes that have none (or when calibration is off)
+def class_thresholds(threshold=0.7):
+    if _calibration is not None:
+        return _calibration.class_thresholds(threshold, len(trash_classes))
+    return torch.full((len(trash_classes),), float(threshold))
+
+
+# Post-processing of a batch: calibrated probabilities, the most probable
+# class and its confidence, whether it falls back to "trash" and the top-k
+# classes of every row, all from one softmax without per-row Python work
+class BatchDecisions:
+    def __init__(self, probabilities, threshold=0.7, k=3):
+        self.probabilities = probabilities  # [N, classes]
+        self.confidences, self.predicted = probabilities.max(dim=-1)
+        self.fallback = self.confidences < class_thresholds(threshold)[self.predicted]
+        self.top_probabilities, self.top_indices = probabilities.topk(
+            min(k, probabilities.shape[-1]), dim=-1
+        )
+
+    # (class_name, confidence) of every row. A "trash" fallback keeps the
+    # confidence of the most probable class rather than the threshold.
+    def decisions(self):
+        return [
+            ("trash" if fallback else trash_classes[index], confidence)
+            for index, confidence, fallback in zip(
+                self.predicted.tolist(), self.confidences.tolist(), self.fallback.tolist()
+            )
+        ]
+
+    # The top-k (class_name, probability) pairs of every row
+    def top_k(self):
+        return [[(trash_classes[index], probability) for index, probability in zip(*row)]
+                for row in zip(self.top_indices.tolist(), self.top_probabilities.tolist())]
+
+
+def postprocess_logits(logits, threshold=0.7, k=3):
+    return BatchDecisions(calibrated_probabilities(logits), threshold, k)
+
+
+# Turn a batch of logits into (class_name, confidence) pairs, assigning
+# "trash" to predictions whose confidence is below their class threshold
+def apply_trash_threshold_batch(logits, threshold=0.7):
+    return _threshold_decisions(logits, threshold)[0]
+
+
+# Decisions plus, for every row, whether it fell back to "trash"
+def _threshold_decisions(logits, threshold=0.7):
+    batch = postprocess_logits(logits, threshold)
+    return batch.decisions(), batch.fallback.tolist()
+
+
+# Turn one row of logits into (class_name, confidence)
+def apply_trash_threshold(logits, threshold=0.7):
+    return apply_trash_threshold_batch(logits.unsqueeze(0), threshold)[0]
+
+
+# Model output for one image, kept so that the result can be re-rendered
+# (another threshold, language or top-k view) without calling the model again
+class ClassificationResult:
+    def __init__(self, image_key, logits, embedding=None, correction=None):
+        self.image_key = image_key  # Identity of the classified pixels
+        self.logits = np.asarray(logits, dtype=np.float32)
+        self.probabilities = calibrated_probabilities(torch.from_numpy(self.logits)).numpy()
+        self.embedding = embedding  # Pooled ViT embedding, or None
+        self.correction = correction  # (label, similarity) from the correction index
+
+    # Split a row of logits followed by an (optional) embedding
+    @classmethod
+    def from_outputs(cls, image_key, outputs):
+        outputs = np.asarray(outputs, dtype=np.float32)
+        embedding = outputs[len(trash_classes):]
+        return cls(image_key, outputs[:len(trash_classes)],
+                   embedding if len(embedding) else None)
+
+    # (class_name, confidence) for a given trash threshold. A matching user
+    # correction wins; its confidence is the similarity to the corrected image.
+    def decide(self, threshold=0.7):
+        if self.correction is not None:
+            return self.correction
+        index = int(self.probabilities.argmax())
+        confidence = float(self.probabilities[index])
+        if confidence < float(class_thresholds(threshold)[index]):
+            return "trash", confidence
+        return trash_classes[index], confidence
+
+    # True when the answer is the low-confidence "trash" fallback
+    def is_fallback(self, threshold=0.7):
+        index = int(self.probabilities.argmax())
+        return (self.correction is None
+                and float(self.probabilities[index]) < float(class_thresholds(threshold)[index]))
+
+    # The k most probable classes as (class_name, probability) pairs
+    def top_k(self, k=3):
+        order = np.argsort(self.probabilities)[::-1][:k]
+        return [(trash_classes[index], float(self.probabilities[index])) for index in order]
+
+
+# Run the model once and keep the full output for later rendering
+def classify_image(image):
+    key = _cache_key(image)
+    outputs = predict_image_outputs(image, key)  # Preprocess and run the model
+    return _finish_classification(key, outputs)
+
+
+# Build the result from model outputs and apply any matching user correction
+def _finish_classification(key, outputs):
+    with metrics.stage("postprocess"):
+        result = ClassificationResult.from_outputs(key, outputs)
+        if _correction_index is not None and result.embedding is not None:
+            result.correction = _correction_index.lookup(result.embedding)[0]
+    return result
+
+
+# Model input of one image, timed as the "preprocess" stage
+def _preprocess_pixels(image):
+    with metrics.stage("preprocess"):
+        return preprocess_image(image)["pixel_values"]
+
+
+# classify_image for asyncio frontends. Preprocessing and postprocessing run in
+# `executor`; with micro-batching on, the forward pass is awaited on the batcher
+# without holding a thread, and cancelling the call drops the request if it is
+# still waiting for a batch. A cache miss goes through the result cache's
+# single-flight, so identical concurrent uploads share one forward pass.
+# Without the batcher the whole call runs in `executor`.
+async def classify_image_async(image, executor=None):
+    loop = asyncio.get_running_loop()
+    trace = metrics.current_trace()
+    if _scheduler is None or get_client() is not None:
+        return await loop.run_in_executor(executor, metrics.run_traced, trace,
+                                          classify_image, image)
+    key = await loop.run_in_executor(executor, metrics.run_traced, trace, _cache_key, image)
+
+    async def compute():
+        pixel_values = await loop.run_in_executor(executor, metrics.run_traced, trace,
+                                                  _preprocess_pixels, image)
+        start = time.perf_counter()
+        outputs = await asyncio.wrap_future(_scheduler.submit(pixel_values))
+        metrics.record_stage("forward", time.perf_counter() - start)
+        return outputs.numpy()
+
+    if _result_cache is None:
+        outputs = await compute()
     else:
-        class_name = trash_classes[predicted_class]
+        outputs = await _result_cache.get_or_compute_async(key, compute, executor)
+    return await loop.run_in_executor(executor, metrics.run_traced, trace,
+                                      _finish_classification, key, outputs)
 
+
+# Count a result's decision at `threshold` in the per-class and fallback
+# metrics; frontends call it once per classified upload
+def record_decision(result, threshold=0.7):
+    class_name, confidence = result.decide(threshold)
+    metrics.record_prediction(class_name, result.is_fallback(threshold))
     return class_name, confidence
 
+
+# Classification function with confidence threshold for trash
+def classify_image_with_trash_threshold(image, threshold=0.7):
+    return record_decision(classify_image(image), threshold)
+
+
+# Post-process a batch of predict_outputs rows: the BatchDecisions of the logits,
+# then the decisions and fallbacks with user corrections applied to rows whose
+# embedding matches a corrected image
+def decide_outputs(outputs, threshold=0.7):
+    batch = postprocess_logits(outputs[:, :len(trash_classes)], threshold)
+    decisions, fallbacks = batch.decisions(), batch.fallback.tolist()
+    if _correction_index is not None and outputs.shape[1] > len(trash_classes):
+        corrections = _correction_index.lookup(outputs[:, len(trash_classes):].numpy())
+        decisions = [correction or decision
+                     for correction, decision in zip(corrections, decisions)]
+        fallbacks = [fallback and correction is None
+                     for correction, fallback in zip(corrections, fallbacks)]
+    return batch, decisions, fallbacks
+
+
+# Batch classification API: preprocess and classify many images with one
+# forward pass per chunk of `batch_size` images
+def classify_images(images, threshold=0.7, batch_size=32):
+    outputs = predict_outputs(images, batch_size)
+    with metrics.stage("postprocess"):
+        _, decisions, fallbacks = decide_outputs(outputs, threshold)
+    for (class_name, _), fallback in zip(decisions, fallbacks):
+        metrics.record_prediction(class_name, fallback)
+    return decisions
+
+
+# Raw logits for many images
+def predict_logits(images, batch_size=32):
+    return predict_outputs(images, batch_size)[:, :len(trash_classes)]
+
+
+# Engine outputs for a list of images, timed per stage
+def _predict_engine_outputs(images):
+    engine = get_engine()
+    with metrics.stage("preprocess"):
+        pixel_values = engine.preprocess(images)
+    with metrics.stage("forward"):
+        return engine.forward_outputs(pixel_values)
+
+
+# Logits (and embeddings, when available) for many images; cached images are
+# skipped and the rest are run through the model in chunks of `batch_size`
+def predict_outputs(images, batch_size=32):
+    images = list(images)
+    client = get_client()
+    run = client.predict_logits if client is not None else _predict_engine_outputs
+    if _result_cache is None:
+        keys = [None] * len(images)
+        rows = [None] * len(images)
+    else:
+        keys = [_cache_key(image) for image in images]
+        rows = [_result_cache.get(key) for key in keys]
+    missing = [index for index, row in enumerate(rows) if row is None]
+    for start in range(0, len(missing), batch_size):
+        chunk = missing[start:start + batch_size]
+        outputs = run([images[index] for index in chunk]).numpy()
+        for index, row in zip(chunk, outputs):
+            rows[index] = row
+            if _result_cache is not None:
+                _result_cache.put(keys[index], row)
+    if not rows:
+        return torch.empty((0, len(trash_classes)))
+    if len({len(row) for row in rows}) > 1:
+        # Some cached rows lack an embedding: fall back to logits only
+        rows = [row[:len(trash_classes)] for row in rows]
+    return torch.from_numpy(np.stack(rows))
@@ -0,0 +1,140 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 17 2026
+# This file implements offline model snapshots for fast cold starts.
+# `export` downloads the processor config and weights once and writes them to a local
+# directory as config files plus a single safetensors file. Loading a snapshot does
+# no hub lookups: the model skeleton is created without allocating weights and every
+# parameter is a view into a private memory map of the safetensors file, so the
+# weights are paged in lazily from the OS page cache and shared by all worker
+# processes on the node instead of being copied into each process.
+#
+# Examples:
+#   python model_snapshot.py export ./model_snapshot
+#   WASTE_MODEL_NAME=./model_snapshot python app.py
+#   python model_snapshot.py report ./model_snapshot
+
+from transformers import AutoConfig, AutoFeatureExtractor, AutoModelForImageClassification
+import argparse
+import datetime
+import json
+import mmap
+import os
+import struct
+import time
+import torch
+
+SNAPSHOT_MANIFEST = "snapshot.json"
+WEIGHTS_FILE = "model.safetensors"
+
+# safetensors dtype names -> torch dtypes
+_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16,
+    "BF16": torch.bfloat16, "I64": torch.int64, "I32": torch.int32,
+    "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+
+# True if `path` is a directory written by export_snapshot()
+def is_snapshot(path):
+    return os.path.isfile(os.path.join(path, SNAPSHOT_MANIFEST))
+
+
+# Download (or read from the local HF cache) the processor and model once and
+# write them as an offline snapshot directory
+def export_snapshot(model_name, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    AutoFeatureExtractor.from_pretrained(model_name).save_pretrained(output_dir)
+    model = AutoModelForImageClassification.from_pretrained(model_name)
+    model.save_pretrained(output_dir, safe_serialization=True)
+    manifest = {
+        "source": model_name,
+        "weights": WEIGHTS_FILE,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    with open(os.path.join(output_dir, SNAPSHOT_MANIFEST), "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2)
+    return output_dir
+
+
+# Map a safetensors file and return {name: tensor} where every tensor is a
+# zero-copy view into the mapping. MAP_PRIVATE (ACCESS_COPY) keeps the pages
+# shared with other processes until someone writes to them, which inference
+# never does.
+def mmap_safetensors(path):
+    with open(path, "rb") as file:
+        header_size = struct.unpack("<Q", file.read(8))[0]
+        header = json.loads(file.read(header_size))
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = _DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        count = (end - start) // torch.empty((), dtype=dtype).element_size()
+        if count == 0:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensor = torch.frombuffer(mapping, dtype=dtype, count=count,
+                                  offset=data_start + start)
+        tensors[name] = tensor.reshape(info["shape"])
+    return tensors
+
+
+# Build the model from a snapshot directory with memory-mapped weights.
+# Returns (model, report) where report describes where the time went.
+def load_snapshot_model(snapshot_dir):
+    start = time.perf_counter()
+    config = AutoConfig.from_pretrained(snapshot_dir, local_files_only=True)
+    # Create the module structure on the meta device: no weight memory is
+    # allocated and no random initialisation runs
+    with torch.device("meta"):
+        model = AutoModelForImageClassification.from_config(config)
+    built = time.perf_counter()
+
+    weights_path = os.path.join(snapshot_dir, WEIGHTS_FILE)
+    state_dict = mmap_safetensors(weights_path)
+    model.load_state_dict(state_dict, strict=True, assign=True)
+    model.eval()  # Inference only: disable dropout
+    loaded = time.perf_counter()
+
+    leftover = [name for name, tensor in
+                list(model.named_parameters()) + list(model.named_buffers())
+                if tensor.is_meta]
+    if leftover:
+        raise ValueError(f"Snapshot {snapshot_dir} is missing tensors: {leftover}")
+    report = {
+        "snapshot": os.path.abspath(snapshot_dir),
+        "mmap": True,
+        "weights_bytes": os.path.getsize(weights_path),
+        "build_s": round(built - start, 4),
+        "map_weights_s": round(loaded - built, 4),
+    }
+    return model, report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export or inspect an offline model snapshot.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="Write a snapshot directory")
+    export.add_argument("output_dir")
+    export.add_argument("--model", help="Model id to export (default: the app's model)")
+    report = commands.add_parser("report", help="Load a snapshot and print load timings")
+    report.add_argument("snapshot_dir")
+    args = parser.parse_args(argv)
+
+    import model_inference
+    if args.command == "export":
+        model_name = args.model or model_inference.MODEL_NAME
+        export_snapshot(model_name, args.output_dir)
+        print(f"Snapshot of {model_name} written to {args.output_dir}")
+    else:
+        engine = model_inference.InferenceEngine(args.snapshot_dir).load()
+        print(json.dumps(engine.load_report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 17 2026
+# This file implements multi-region classification for images that contain several
+# items. The decoded image is cut into an overlapping grid of square crops at a few
+# scales; every crop is a strided view over the same uint8 array, so no pixels are
+# copied until the crops are converted to float. All crops are resized with one
+# batched interpolate, normalised in one fused pass and classified in a single
+# forward pass. Neighbouring crops with the same label are then merged into regions
+# with a class, confidence and bounding box that annotation.draw_regions can draw.
+#
+# Example:
+#   python multi_region.py test_picture/plastic-bag-full-of-trash.jpg --output regions.png
+
+from numpy.lib.stride_tricks import sliding_window_view
+from PIL import Image
+from image_ingest import DISPLAY_SIZE
+import metrics
+import model_inference
+import argparse
+import numpy as np
+import torch
+
+# Crop side as a fraction of the image's shortest side, and overlap between crops
+SCALES = (1.0, 0.5)
+OVERLAP = 0.5
+# Longest side the image is shrunk to before cropping
+MAX_SIZE = DISPLAY_SIZE
+
+
+# One detected item: label, confidence and box (left, top, right, bottom) in
+# pixel coordinates of the classified image
+class Region:
+    def __init__(self, class_name, confidence, box, crops):
+        self.class_name = class_name
+        self.confidence = confidence
+        self.box = box
+        self.crops = crops  # Number of crops merged into this region
+
+    def __repr__(self):
+        return (f"Region({self.class_name!r}, {self.confidence:.2f}, box={self.box}, "
+                f"crops={self.crops})")
+
+
+# Stride and number of crops of `size` along an axis of `length` pixels. The
+# stride is the same for every step so the crops are a plain strided slice; at
+# most a few pixels at the far edge are not covered.
+def _grid(length, size, overlap):
+    if size >= length:
+        return 1, 1
+    count = int(np.ceil((length - size) / (size * (1 - overlap)))) + 1
+    return (length - size) // (count - 1), count
+
+
+# Crops of one scale as a zero-copy view [rows, cols, size, size, 3] over the
+# uint8 image, plus the top and left pixel offsets of the grid rows and columns
+def crop_views(pixels, scale, overlap=OVERLAP):
+    height, width, _ = pixels.shape
+    size = max(1, int(min(height, width) * scale))
+    row_stride, rows = _grid(height, size, overlap)
+    col_stride, cols = _grid(width, size, overlap)
+    # Every possible window [H - size + 1, W - size + 1, size, size, 3], as a view
+    windows = sliding_window_view(pixels, (size, size, 3), writeable=True)[:, :, 0]
+    view = windows[::row_stride, ::col_stride][:rows, :cols]
+    return view, np.arange(rows) * row_stride, np.arange(cols) * col_stride, size
+
+
+# Turn a crop view [rows, cols, size, size, 3] into normalised model input
+# [rows * cols, 3, height, width] with one interpolate call
+def crops_to_pixel_values(view, feature_extractor):
+    rows, cols, size = view.shape[:3]
+    height, width = feature_extractor.size["height"], feature_extractor.size["width"]
+    # The only copy of the crop pixels: uint8 view -> float NCHW batch
+    batch = torch.empty((rows * cols, 3, size, size), dtype=torch.float32)
+    batch.view(rows, cols, 3, size, size).copy_(torch.from_numpy(view).permute(0, 1, 4, 2, 3))
+    if (size, size) != (height, width):
+        batch = torch.nn.functional.interpolate(
+            batch, size=(height, width), mode="bilinear", align_corners=False,
+            antialias=size > height,
+        )
+    multiplier, offset = model_inference.normalization_constants(feature_extractor)
+    return batch.mul_(multiplier).add_(offset)
+
+
+# Logits for every crop of every scale, from one forward pass.
+# Returns (logits [N, classes], crops) with crops = [(scale_index, row, col, box)]
+# and boxes in pixel coordinates of `image`. Large images are first shrunk so
+# their longest side is at most `max_size`.
+def classify_crops(image, scales=SCALES, overlap=OVERLAP, max_size=MAX_SIZE):
+    image = model_inference._as_rgb_image(image)
+    factor = max(image.size) / max_size
+    if factor > 1:
+        image = image.copy()
+        image.thumbnail((max_size, max_size), Image.BILINEAR)
+    factor = max(factor, 1.0)
+    pixels = np.array(image)  # Decoded once; every crop is a view of this array
+    views = []
+    crops = []
+    for scale_index, scale in enumerate(scales):
+        view, tops, lefts, size = crop_views(pixels, scale, overlap)
+        views.append(view)
+        for row, top in enumerate(tops):
+            for col, left in enumerate(lefts):
+                box = np.array([left, top, left + size, top + size]) * factor
+                crops.append((scale_index, row, col, tuple(int(value) for value in box)))
+
+    client = model_inference.get_client()
+    if client is not None:
+        # The server resizes and normalises; send each crop as a uint8 array
+        arrays = [crop for view in views for crop in view.reshape(-1, *view.shape[2:])]
+        with metrics.stage("forward"):
+            return client.predict_logits(arrays), crops
+    engine = model_inference.get_engine()
+    with metrics.stage("preprocess"):
+        pixel_values = torch.cat([
+            crops_to_pixel_values(view, engine.feature_extractor) for view in views
+        ])
+    with metrics.stage("forward"):
+        return engine.forward_logits(pixel_values), crops
+
+
+# Merge 4-connected grid cells with the same label into regions (per scale),
+# then drop regions that mostly repeat a more confident region of the same label
+def merge_regions(decisions, crops, containment=0.7):
+    labels = {}
+    for (class_name, confidence), (scale_index, row, col, box) in zip(decisions, crops):
+        labels[scale_index, row, col] = (class_name, confidence, box)
+
+    regions = []
+    seen = set()
+    for cell, (class_name, _, _) in labels.items():
+        if cell in seen:
+            continue
+        seen.add(cell)
+        stack = [cell]
+        members = []
+        while stack:
+            current = stack.pop()
+            members.append(labels[current])
+            scale_index, row, col = current
+            for neighbour in ((scale_index, row - 1, col), (scale_index, row + 1, col),
+                              (scale_index, row, col - 1), (scale_index, row, col + 1)):
+                if neighbour not in seen and labels.get(neighbour, ("",))[0] == class_name:
+                    seen.add(neighbour)
+                    stack.append(neighbour)
+        boxes = np.array([box for _, _, box in members])
+        box = (int(boxes[:, 0].min()), int(boxes[:, 1].min()),
+               int(boxes[:, 2].max()), int(boxes[:, 3].max()))
+        confidence = float(np.mean([confidence for _, confidence, _ in members]))
+        regions.append(Region(class_name, confidence, box, len(members)))
+
+    kept = []
+    for region in sorted(regions, key=lambda item: item.confidence, reverse=True):
+        if not any(other.class_name == region.class_name
+                   and _contained(region.box, other.box) >= containment for other in kept):
+            kept.append(region)
+    return kept
+
+
+# Fraction of box `a` that lies inside box `b`
+def _contained(a, b):
+    width = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    height = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    area = max(1, (a[2] - a[0]) * (a[3] - a[1]))
+    return width * height / area
+
+
+# Classify the items in an image: a list of Regions, most confident first.
+# Crops below the threshold (the "trash" fallback) are left out unless
+# `keep_uncertain` is set; an empty list means no crop was confident.
+def classify_regions(image, threshold=0.7, scales=SCALES, overlap=OVERLAP,
+                     keep_uncertain=False):
+    logits, crops = classify_crops(image, scales, overlap)
+    with metrics.stage("postprocess"):
+        batch = model_inference.postprocess_logits(logits, threshold)
+        decisions = batch.decisions()
+        if not keep_uncertain:
+            confident = (~batch.fallback).tolist()
+            decisions = [decision for decision, keep in zip(decisions, confident) if keep]
+            crops = [crop for crop, keep in zip(crops, confident) if keep]
+        return merge_regions(decisions, crops)
+
+
+def main(argv=None):
+    from annotation import draw_regions
+
+    parser = argparse.ArgumentParser(description="Classify every item in an image.")
+    parser.add_argument("image")
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--scales", type=float, nargs="+", default=list(SCALES))
+    parser.add_argument("--overlap", type=float, default=OVERLAP)
+    parser.add_argument("--output", help="Write the image with region boxes here")
+    parser.add_argument("--model", default=model_inference.MODEL_NAME)
+    args = parser.parse_args(argv)
+
+    model_inference.set_engine(model_inference.InferenceEngine(args.model))
+    if model_inference.CALIBRATION:
+        model_inference.enable_calibration()
+
+    with Image.open(args.image) as image:
+        image = image.convert("RGB")
+    regions = classify_regions(image, args.threshold, args.scales, args.overlap)
+    for region in regions:
+        print(region)
+    if args.output:
+        draw_regions(image, regions).save(args.output)
+
+
+if __name__ == "__main__":
+    main()
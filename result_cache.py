@@ -0,0 +1,235 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 16 2026
+# This file implements a content-addressed cache for model outputs.
+# Entries are keyed by a hash of the decoded pixels and store the raw logits,
+# so any confidence threshold can be applied to a cached result without re-running
+# the model. The in-memory tier is bounded by entry count and bytes with LRU
+# eviction, an optional on-disk tier survives restarts, and concurrent requests for
+# the same key are collapsed into a single computation (single-flight).
+
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future
+from PIL import Image
+import asyncio
+import hashlib
+import numpy as np
+import os
+import tempfile
+import threading
+
+
+# Hash the decoded pixels of an image (PIL image or uint8 array).
+# `salt` separates keys of different models sharing one cache.
+def image_key(image, salt=""):
+    if isinstance(image, Image.Image):
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        pixels = np.asarray(image)
+    else:
+        pixels = np.ascontiguousarray(image)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{salt}|{pixels.dtype}|{pixels.shape}|".encode())
+    digest.update(memoryview(pixels).cast("B"))
+    return digest.hexdigest()
+
+
+# LRU cache of logits arrays with an optional persistent disk tier
+class ResultCache:
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, disk_dir=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0  # Requests that waited on an identical in-flight computation
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Look up a key in memory, then on disk; returns None on a miss
+    def get(self, key):
+        with self._lock:
+            value = self._get_memory(key)
+        if value is None:
+            value = self._get_disk(key)
+            with self._lock:
+                if value is None:
+                    self.misses += 1
+                else:
+                    self._put_memory(key, value)
+        return value
+
+    # Store a result in memory and, if configured, on disk
+    def put(self, key, value):
+        value = np.ascontiguousarray(value, dtype=np.float32)
+        with self._lock:
+            self._put_memory(key, value)
+        self._put_disk(key, value)
+
+    # Memory hit, or claim `key`: (value, None, False) on a hit, otherwise
+    # (None, future, owner) where the owner computes and the others wait
+    def _claim(self, key):
+        with self._lock:
+            value = self._get_memory(key)
+            if value is not None:
+                return value, None, False
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+        return None, future, owner
+
+    # Return the cached value for `key`, computing it with `compute()` on a miss.
+    # If another thread is already computing the same key, wait for its result.
+    def get_or_compute(self, key, compute):
+        value, future, owner = self._claim(key)
+        if value is not None:
+            return value
+        if not owner:
+            try:
+                return future.result()
+            except CancelledError:  # An asyncio owner was cancelled; compute it here
+                return self.get_or_compute(key, compute)
+
+        try:
+            value = self._get_disk(key)
+            if value is None:
+                with self._lock:
+                    self.misses += 1
+                value = np.ascontiguousarray(compute(), dtype=np.float32)
+                self._put_disk(key, value)
+            with self._lock:
+                self._put_memory(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    # get_or_compute for asyncio callers: `compute` is a coroutine function, the
+    # disk tier is read and written in `executor`, and waiting for another
+    # caller's computation holds no thread. If the owner is cancelled, its
+    # waiters take over instead of failing with it.
+    async def get_or_compute_async(self, key, compute, executor=None):
+        loop = asyncio.get_running_loop()
+        while True:
+            value, future, owner = self._claim(key)
+            if value is not None:
+                return value
+            if owner:
+                break
+            try:
+                # Shielded, so a cancelled waiter does not cancel the shared future
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except asyncio.CancelledError:
+                if not future.cancelled() or asyncio.current_task().cancelling():
+                    raise
+
+        try:
+            value = await loop.run_in_executor(executor, self._get_disk, key)
+            if value is None:
+                with self._lock:
+                    self.misses += 1
+                value = np.ascontiguousarray(await compute(), dtype=np.float32)
+                await loop.run_in_executor(executor, self._put_disk, key, value)
+            with self._lock:
+                self._put_memory(key, value)
+                del self._inflight[key]
+        except BaseException as error:
+            # Unregister first, so woken waiters claim the key afresh
+            with self._lock:
+                self._inflight.pop(key, None)
+            if isinstance(error, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(error)
+            raise
+        future.set_result(value)
+        return value
+
+    # Drop every in-memory entry (the disk tier is left untouched)
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    # Counters for sizing the cache
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "coalesced": self.coalesced,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+    # Memory lookup; caller must hold the lock
+    def _get_memory(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return value
+
+    # Memory insert with LRU eviction; caller must hold the lock
+    def _put_memory(self, key, value):
+        if value.nbytes > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= previous.nbytes
+        self._entries[key] = value
+        self._bytes += value.nbytes
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.npy")
+
+    def _get_disk(self, key):
+        if not self.disk_dir:
+            return None
+        try:
+            value = np.load(self._disk_path(key))
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        return value
+
+    # Write atomically so concurrent readers never see a partial file
+    def _put_disk(self, key, value):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as file:
+                np.save(file, value)
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
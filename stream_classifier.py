@@ -0,0 +1,311 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 17 2026
+# This file implements continuous classification of a camera feed or video file for
+# bin-side kiosks. A reader thread keeps only the newest frame, so when the model
+# falls behind stale frames are dropped instead of queued. Frames that barely differ
+# from the last classified frame (mean difference of a small subsampled grayscale
+# copy) reuse the previous probabilities instead of running the model, and the
+# displayed label is the average over a sliding window of recent probabilities, so
+# it does not flicker. Achieved FPS and the inference duty cycle are reported.
+#
+# Sources: a camera index ("0"), a video file (both need OpenCV), an animated
+# GIF or a folder of frames (PIL only), or "synthetic" for a generated test clip.
+#
+# Example:
+#   python stream_classifier.py --source synthetic --fps 30 --max-frames 300
+#   python stream_classifier.py --make-synthetic clip.gif
+#   python stream_classifier.py --source clip.gif --fps 15
+
+from collections import deque
+from PIL import Image, ImageDraw, ImageSequence
+import model_inference
+import argparse
+import json
+import numpy as np
+import os
+import threading
+import time
+
+try:
+    import cv2  # Optional: cameras and video files
+except ImportError:
+    cv2 = None
+
+# Side of the grayscale grid used to decide whether a frame changed
+SIGNATURE_SIZE = 32
+
+
+# Frames of a camera or video file as RGB uint8 arrays
+def _opencv_frames(source):
+    if cv2 is None:
+        raise ImportError(
+            "Cameras and video files need OpenCV: pip install opencv-python "
+            "(animated GIFs and folders of images work without it)"
+        )
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video source {source!r}")
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                return
+            yield np.ascontiguousarray(frame[:, :, ::-1])  # BGR -> RGB
+    finally:
+        capture.release()
+
+
+# Frames of an animated image or a folder of images, without OpenCV
+def _pil_frames(source):
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.lower().endswith((".jpg", ".jpeg", ".png", ".bmp", ".webp")):
+                with Image.open(os.path.join(source, name)) as image:
+                    yield np.asarray(image.convert("RGB"))
+        return
+    with Image.open(source) as image:
+        for frame in ImageSequence.Iterator(image):
+            yield np.asarray(frame.convert("RGB"))
+
+
+# Generated test clip: an object that holds still for a while, then moves and
+# changes colour, on a slightly noisy background (like a real camera)
+def synthetic_frames(count=300, size=(320, 240), noise=2, seed=0):
+    generator = np.random.default_rng(seed)
+    width, height = size
+    colors = [(200, 40, 40), (40, 160, 60), (40, 80, 200), (220, 200, 60)]
+    for index in range(count):
+        phase = index // 60  # Still for 40 frames, moving for 20, per phase
+        moving = index % 60 >= 40
+        offset = (index % 60 - 40) * 4 if moving else 0
+        image = Image.new("RGB", size, (128, 128, 128))
+        left = (phase * 70 + offset) % (width - 80)
+        ImageDraw.Draw(image).rectangle(
+            (left, height // 3, left + 80, height // 3 + 80), fill=colors[phase % len(colors)]
+        )
+        frame = np.asarray(image)
+        if noise:
+            frame = frame + generator.integers(-noise, noise + 1, frame.shape, dtype=np.int16)
+            frame = np.clip(frame, 0, 255).astype(np.uint8)
+        yield frame
+
+
+# Frame iterator for a source description (see the header)
+def open_frames(source):
+    if source == "synthetic":
+        return synthetic_frames()
+    if isinstance(source, int) or str(source).isdigit():
+        return _opencv_frames(int(source))
+    if os.path.isdir(source) or source.lower().endswith((".gif", ".webp", ".png", ".tif", ".tiff")):
+        return _pil_frames(source)
+    return _opencv_frames(source)
+
+
+# Save generated frames as an animated GIF, a test clip that needs no OpenCV
+# (without noise, which GIF compresses badly)
+def save_synthetic_clip(path, count=300, fps=15):
+    frames = [Image.fromarray(frame) for frame in synthetic_frames(count, noise=0)]
+    frames[0].save(path, save_all=True, append_images=frames[1:],
+                   duration=int(1000 / fps), loop=0)
+
+
+# Single-slot buffer between the reader and the classifier: a new frame
+# replaces one that has not been taken yet (which is counted as dropped)
+class LatestFrameSlot:
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._item = None
+        self._closed = False
+        self.dropped = 0
+        self.error = None  # Exception raised by the frame source, if any
+
+    def put(self, item):
+        with self._condition:
+            if self._item is not None:
+                self.dropped += 1
+            self._item = item
+            self._condition.notify()
+
+    # Newest item, waiting for one if needed; None once closed and empty
+    def get(self):
+        with self._condition:
+            while self._item is None and not self._closed:
+                self._condition.wait()
+            item, self._item = self._item, None
+            return item
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+
+# Small grayscale copy of a frame by strided subsampling (no filtering)
+def frame_signature(frame, size=SIGNATURE_SIZE):
+    height, width = frame.shape[:2]
+    step_y = max(1, height // size)
+    step_x = max(1, width // size)
+    return frame[::step_y, ::step_x].mean(axis=2, dtype=np.float32)
+
+
+# One displayed result
+class StreamUpdate:
+    def __init__(self, frame_index, class_name, confidence, inferred, frame):
+        self.frame_index = frame_index
+        self.class_name = class_name  # Smoothed label
+        self.confidence = confidence  # Smoothed probability of that label
+        self.inferred = inferred  # False when the previous result was reused
+        self.frame = frame
+
+
+class StreamClassifier:
+    def __init__(self, threshold=0.7, diff_threshold=3.0, window=8, max_reuse=30):
+        self.threshold = threshold
+        self.diff_threshold = diff_threshold  # Mean grayscale change (0-255)
+        self.window = window  # Frames averaged for the displayed label
+        self.max_reuse = max_reuse  # Re-run the model at least this often
+        self.stats = {}
+
+    # Calibrated probabilities of one frame from the shared engine (or
+    # inference server)
+    def _infer(self, frame):
+        logits = model_inference.predict_logits([frame])[0]
+        return model_inference.calibrated_probabilities(logits).numpy()
+
+    # Classify frames and yield a StreamUpdate per processed frame. With
+    # `fps`, the frames are delivered at that rate by a reader thread (as a
+    # camera would) and frames the classifier has no time for are dropped;
+    # without it every frame is processed (offline analysis).
+    def run(self, frames, fps=None, max_frames=None):
+        slot = None
+        if fps is not None:
+            slot = LatestFrameSlot()
+            stop = threading.Event()
+            threading.Thread(target=self._read, args=(frames, slot, fps, stop, max_frames),
+                             daemon=True).start()
+            items = iter(slot.get, None)
+        else:
+            items = enumerate(frames if max_frames is None else
+                              (frame for frame, _ in zip(frames, range(max_frames))))
+
+        thresholds = model_inference.class_thresholds(self.threshold).numpy()
+        history = deque(maxlen=self.window)
+        last_signature = None
+        probabilities = None
+        reused = 0
+        processed = inferred = 0
+        inference_seconds = 0.0
+        start = time.perf_counter()
+        try:
+            for frame_index, frame in items:
+                signature = frame_signature(frame)
+                changed = (
+                    last_signature is None or reused >= self.max_reuse
+                    or signature.shape != last_signature.shape
+                    or float(np.abs(signature - last_signature).mean()) > self.diff_threshold
+                )
+                if changed:
+                    inference_start = time.perf_counter()
+                    probabilities = self._infer(frame)
+                    inference_seconds += time.perf_counter() - inference_start
+                    last_signature = signature
+                    inferred += 1
+                    reused = 0
+                else:
+                    reused += 1
+                processed += 1
+                history.append(probabilities)
+
+                smoothed = np.mean(history, axis=0)
+                index = int(smoothed.argmax())
+                confidence = float(smoothed[index])
+                class_name = (model_inference.trash_classes[index]
+                              if confidence >= thresholds[index] else "trash")
+                yield StreamUpdate(frame_index, class_name, confidence, changed, frame)
+            if slot is not None and slot.error is not None:
+                raise slot.error
+        finally:
+            if slot is not None:
+                stop.set()
+                slot.close()
+            elapsed = time.perf_counter() - start
+            self.stats = {
+                "frames_processed": processed,
+                "frames_dropped": slot.dropped if slot is not None else 0,
+                "inferences": inferred,
+                "reused": processed - inferred,
+                "achieved_fps": round(processed / elapsed, 2) if elapsed else 0.0,
+                "inference_duty_cycle": round(inference_seconds / elapsed, 3) if elapsed else 0.0,
+                "mean_inference_ms": round(inference_seconds / inferred * 1000, 2)
+                if inferred else None,
+            }
+
+    # Reader thread: deliver frames at `fps` into the latest-frame slot
+    @staticmethod
+    def _read(frames, slot, fps, stop, max_frames):
+        interval = 1.0 / fps
+        next_time = time.perf_counter()
+        try:
+            for frame_index, frame in enumerate(frames):
+                if stop.is_set() or (max_frames is not None and frame_index >= max_frames):
+                    break
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_time += interval
+                slot.put((frame_index, frame))
+        except Exception as error:  # Re-raised in the classifier thread
+            slot.error = error
+        finally:
+            slot.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Classify a camera or video stream.")
+    parser.add_argument("--source", default="synthetic",
+                        help='Camera index, video file, GIF, folder of frames or "synthetic"')
+    parser.add_argument("--fps", type=float,
+                        help="Deliver frames at this rate and drop the ones the model "
+                             "cannot keep up with (default: process every frame; "
+                             "cameras always run live)")
+    parser.add_argument("--max-frames", type=int)
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--diff-threshold", type=float, default=3.0)
+    parser.add_argument("--window", type=int, default=8)
+    parser.add_argument("--model", default=model_inference.MODEL_NAME)
+    parser.add_argument("--show", action="store_true", help="Show frames (needs OpenCV)")
+    parser.add_argument("--make-synthetic", metavar="GIF",
+                        help="Write the synthetic test clip to GIF and exit")
+    args = parser.parse_args(argv)
+
+    if args.make_synthetic:
+        save_synthetic_clip(args.make_synthetic)
+        return
+    fps = args.fps
+    if fps is None and str(args.source).isdigit():
+        fps = 30.0  # Cameras produce frames in real time
+    model_inference.set_engine(model_inference.InferenceEngine(args.model))
+    model_inference.warm_up()
+
+    classifier = StreamClassifier(args.threshold, args.diff_threshold, args.window)
+    label = None
+    for update in classifier.run(open_frames(args.source), fps, args.max_frames):
+        if update.class_name != label:
+            label = update.class_name
+            print(f"frame {update.frame_index}: {label} ({update.confidence:.2f})")
+        if args.show:
+            if cv2 is None:
+                raise ImportError("--show needs OpenCV: pip install opencv-python")
+            frame = np.ascontiguousarray(update.frame[:, :, ::-1])
+            cv2.putText(frame, f"{label} {update.confidence:.2f}", (10, 30),
+                        cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 0, 255), 2)
+            cv2.imshow("Waste classification", frame)
+            if cv2.waitKey(1) & 0xFF == ord("q"):
+                break
+    print(json.dumps(classifier.stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 17 2026
+# This file implements the token-merging fast mode (ToMe-style) for the ViT.
+# After every encoder layer but the last, the patch tokens are split into two
+# alternating sets and the most similar cross-set pairs are merged (bipartite soft
+# matching) by a size-weighted average, so each later layer processes fewer tokens.
+# The [CLS] token, which the classifier reads, is never merged. The wrappers are
+# applied to a loaded model without retraining, and `ratio` sets the fraction of
+# the remaining patch tokens merged after each layer.
+# Unlike the paper, attention is not rescaled by token size (proportional
+# attention), which keeps the stock attention modules untouched.
+#
+# Example (speedup versus label agreement on a validation folder):
+#   python token_merging.py test_picture --ratios 0.05 0.1 0.2 0.3
+#   WASTE_TOKEN_MERGING=0.1 streamlit run app_streamlit.py
+
+import argparse
+import json
+import threading
+import time
+import torch
+
+
+# Merge `r` patch tokens of x [B, N, C] (token 0 is [CLS] and is kept) into their
+# most similar partner. `size` [B, N, 1] counts how many original patches each
+# token stands for and weights the averages.
+def bipartite_merge(x, size, r):
+    cls, tokens = x[:, :1], x[:, 1:]
+    cls_size, token_sizes = size[:, :1], size[:, 1:]
+    r = min(r, (tokens.shape[1] + 1) // 2, tokens.shape[1] // 2)
+    if r <= 0:
+        return x, size
+    channels = x.shape[-1]
+    metric = tokens / tokens.norm(dim=-1, keepdim=True)
+    scores = metric[:, ::2] @ metric[:, 1::2].transpose(1, 2)  # Set A x set B
+    best_score, best_match = scores.max(dim=-1)  # Best B partner of every A token
+    order = best_score.argsort(dim=-1, descending=True)[..., None]
+    kept_a = order[:, r:]  # A tokens that stay
+    merged_a = order[:, :r]  # A tokens merged into their B partner
+    destination = best_match[..., None].gather(1, merged_a)
+
+    weighted = tokens * token_sizes
+    a, b = weighted[:, ::2], weighted[:, 1::2]
+    a_size, b_size = token_sizes[:, ::2], token_sizes[:, 1::2]
+    b = b.scatter_add(1, destination.expand(-1, -1, channels),
+                      a.gather(1, merged_a.expand(-1, -1, channels)))
+    b_size = b_size.scatter_add(1, destination, a_size.gather(1, merged_a))
+    new_sizes = torch.cat([a_size.gather(1, kept_a), b_size], dim=1)
+    new_tokens = torch.cat([a.gather(1, kept_a.expand(-1, -1, channels)), b], dim=1)
+    return (torch.cat([cls, new_tokens / new_sizes], dim=1),
+            torch.cat([cls_size, new_sizes], dim=1))
+
+
+# Encoder layer wrapper that merges tokens after the wrapped layer runs.
+# Token sizes live in thread-local state shared by the wrappers of one model.
+class TokenMergingLayer(torch.nn.Module):
+    def __init__(self, layer, ratio, state, first, merge):
+        super().__init__()
+        self.layer = layer
+        self.ratio = ratio
+        self.state = state
+        self.first = first
+        self.merge = merge
+
+    def forward(self, hidden_states, *args, **kwargs):
+        if self.first:
+            self.state.size = None
+        output = self.layer(hidden_states, *args, **kwargs)
+        is_tuple = isinstance(output, tuple)  # Older transformers return tuples
+        hidden_states = output[0] if is_tuple else output
+        if self.merge:
+            size = getattr(self.state, "size", None)
+            if size is None or size.shape[:2] != hidden_states.shape[:2]:
+                size = hidden_states.new_ones(hidden_states.shape[0], hidden_states.shape[1], 1)
+            r = int(self.ratio * (hidden_states.shape[1] - 1))
+            hidden_states, self.state.size = bipartite_merge(hidden_states, size, r)
+        return (hidden_states,) + tuple(output[1:]) if is_tuple else hidden_states
+
+
+# Wrap every encoder layer of a ViT classification model (in place)
+def apply_token_merging(model, ratio):
+    if not 0 <= ratio < 0.5:
+        raise ValueError("The token merging ratio must be in [0, 0.5)")
+    remove_token_merging(model)
+    layers = model.vit.encoder.layer
+    state = threading.local()
+    for index, layer in enumerate(layers):
+        layers[index] = TokenMergingLayer(layer, ratio, state, first=index == 0,
+                                          merge=index < len(layers) - 1)
+    return model
+
+
+# Restore the original encoder layers
+def remove_token_merging(model):
+    layers = model.vit.encoder.layer
+    for index, layer in enumerate(layers):
+        if isinstance(layer, TokenMergingLayer):
+            layers[index] = layer.layer
+    return model
+
+
+# Speed and label agreement of several merging ratios against ratio 0
+def merging_report(engine, images, ratios, threshold=0.7, batch_size=1):
+    import model_inference
+
+    pixel_values = engine.preprocess(images)
+    results = []
+    reference = None
+    for ratio in [0.0] + [ratio for ratio in ratios if ratio > 0]:
+        apply_token_merging(engine.model, ratio)
+        engine.forward_logits(pixel_values[:batch_size])  # Warm up
+        start = time.perf_counter()
+        logits = torch.cat([engine.forward_logits(pixel_values[index:index + batch_size])
+                            for index in range(0, len(images), batch_size)])
+        seconds = time.perf_counter() - start
+        labels = [name for name, _ in
+                  model_inference.apply_trash_threshold_batch(logits, threshold)]
+        probabilities = torch.softmax(logits.float(), dim=-1)
+        if reference is None:
+            reference = (labels, probabilities, seconds)
+        agreement = sum(a == b for a, b in zip(labels, reference[0])) / len(labels)
+        top1 = (probabilities.argmax(dim=-1) == reference[1].argmax(dim=-1)).float().mean()
+        results.append({
+            "ratio": ratio,
+            "ms_per_image": round(seconds / len(images) * 1000, 3),
+            "speedup": round(reference[2] / seconds, 3),
+            "label_agreement": round(agreement, 4),  # After the trash threshold
+            "top1_agreement": round(top1.item(), 4),  # Most probable class
+            "max_probability_drift": round(
+                (probabilities - reference[1]).abs().max().item(), 4
+            ),
+        })
+    remove_token_merging(engine.model)
+    return results
+
+
+def main(argv=None):
+    from cascade import load_images
+    import model_inference
+
+    parser = argparse.ArgumentParser(
+        description="Measure speedup versus label agreement of token merging."
+    )
+    parser.add_argument("folder", help="Validation images (searched recursively)")
+    parser.add_argument("--ratios", type=float, nargs="+", default=[0.05, 0.1, 0.2, 0.3])
+    parser.add_argument("--model", default=model_inference.MODEL_NAME)
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--batch-size", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    # Unmerged baseline; merging_report applies each ratio itself
+    engine = model_inference.InferenceEngine(args.model, backend="eager",
+                                             token_merging=0).warm_up()
+    images = load_images(args.folder)
+    for row in merging_report(engine, images, args.ratios, args.threshold, args.batch_size):
+        print(json.dumps(row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+# CS 5330 Final Project
+# Automated Waste Classification and Recycling Guidance Assistant
+# Jiaqi Liu/ Pingqi An/ Zhao Liu
+# Oct 17 2026
+# This file implements a multi-process worker pool that shares one copy of the model
+# weights. The parent loads the model once and forks the workers, so every worker
+# maps the same weight pages copy-on-write (nothing writes to them during inference,
+# so they are never copied); gc.freeze() before forking keeps the garbage collector
+# from touching, and thereby copying, the parent's Python objects. Each worker is
+# pinned to its own subset of cores with a matching number of PyTorch threads.
+# Batches are split across the workers, and a worker that crashes is forked again
+# and its unfinished jobs are retried once.
+# Workers are not forked by the (multithreaded) parent but by a zygote: a process
+# forked once by start() before the pool starts any thread, which forks a worker
+# whenever the parent asks and passes it the worker's end of a pipe. A child of
+# a multithreaded process can inherit locks held by other threads (the pool's,
+# malloc's, logging's) and deadlock; the zygote never runs a second thread.
+# The parent never runs a forward pass itself: OpenMP thread pools do not survive
+# fork(), so only the workers start them.
+#
+# Example (throughput and memory per worker count on a folder of images):
+#   python worker_pool.py report test_picture --workers 1 2 4 8
+#   python inference_server.py --workers 8 --shared-weights
+
+from concurrent.futures import Future
+from multiprocessing import reduction
+from multiprocessing.connection import Connection, wait
+import model_inference
+import argparse
+import gc
+import itertools
+import json
+import multiprocessing
+import numpy as np
+import os
+import signal
+import threading
+import time
+import torch
+import traceback
+
+_pool_engine = None  # Engine loaded by the parent, inherited by forked workers
+
+
+# Raised for the jobs of a worker that crashed twice while running them
+class WorkerCrashedError(RuntimeError):
+    pass
+
+
+# Cores this process may run on
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+# Split the cores into one contiguous subset per worker (workers share cores
+# round-robin when there are more workers than cores)
+def assign_cores(workers, cores=None):
+    cores = cores or available_cores()
+    if workers >= len(cores):
+        return [[cores[index % len(cores)]] for index in range(workers)]
+    size = len(cores) // workers
+    return [cores[index * size:(index + 1) * size] for index in range(workers)]
+
+
+# Memory of a process from /proc/<pid>/smaps_rollup, in MB: resident (RSS),
+# proportional (PSS: shared pages divided among their users) and private (USS).
+# None where the file does not exist (non-Linux systems).
+def process_memory(pid):
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", encoding="ascii") as file:
+            fields = dict(line.split(":", 1) for line in file if ":" in line)
+    except OSError:
+        return None
+
+    def megabytes(name):
+        return int(fields.get(name, "0 kB").split()[0]) / 1024
+
+    return {
+        "rss_mb": round(megabytes("Rss"), 1),
+        "pss_mb": round(megabytes("Pss"), 1),
+        "private_mb": round(megabytes("Private_Clean") + megabytes("Private_Dirty"), 1),
+    }
+
+
+# Worker process: pin to its cores, warm up the inherited engine, then answer
+# (job_id, images) messages with (job_id, ok, logits or error message)
+def _worker_main(connection, cores):
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    _pool_engine.warm_up()
+    connection.send(("ready", os.getpid()))
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            return  # The parent went away
+        if message is None:
+            return
+        job_id, images = message
+        try:
+            connection.send((job_id, True, _pool_engine.predict_logits(list(images)).numpy()))
+        except Exception as error:
+            connection.send((job_id, False, f"{type(error).__name__}: {error}"))
+
+
+# Zygote process: for every (index, cores) request, fork a worker and send back
+# its pid and the parent's end of its pipe. Exits when the parent goes away.
+def _zygote_main(connection):
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # Exited workers are reaped automatically
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        parent_end, child_end = multiprocessing.Pipe()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            connection.close()
+            parent_end.close()
+            code = 0
+            try:
+                _worker_main(child_end, message[1])
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        child_end.close()
+        connection.send(pid)
+        reduction.send_handle(connection, parent_end.fileno(), None)
+        parent_end.close()
+
+
+# One forked worker as seen from the parent. Workers are children of the zygote,
+# so the parent notices a crash by its pipe closing rather than by waiting on it.
+class _Worker:
+    def __init__(self, index, cores):
+        self.index = index
+        self.cores = cores
+        self.jobs = {}  # job_id -> (images, future, attempts) in flight
+        self.batches = 0
+        self.restarts = -1  # The first start is not a restart
+        self.send_lock = threading.Lock()  # Held while sending, and while restarting
+        self.connection = None
+        self.pid = None
+        self.ready = False
+
+    # Wait up to `deadline` for the worker to exit (its pipe to close)
+    def wait_exit(self, deadline):
+        try:
+            while self.connection.poll(max(0.0, deadline - time.monotonic())):
+                self.connection.recv()
+        except (EOFError, OSError):
+            return True
+        return False
+
+
+class WorkerPool:
+    def __init__(self, model_name=model_inference.MODEL_NAME, workers=2,
+                 backend=model_inference.BACKEND, cores=None, engine=None):
+        if not hasattr(os, "fork"):
+            raise RuntimeError("The worker pool needs fork() (Linux or macOS)")
+        self.engine = engine or model_inference.InferenceEngine(model_name, backend=backend)
+        self.workers = workers
+        self.core_sets = assign_cores(workers, cores)
+        self._context = multiprocessing.get_context("fork")
+        self._pool = []
+        self._job_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._collector = None
+        self._zygote = None  # Connection to the zygote process
+        self._zygote_process = None
+        self._zygote_lock = threading.Lock()
+
+    # Load the weights in this process and fork the zygote. Call it before this
+    # process starts any thread (start() calls it if that has not happened).
+    def fork_zygote(self):
+        global _pool_engine
+        if self._zygote is not None:
+            return self
+        self.engine.load()
+        _pool_engine = self.engine
+        gc.collect()
+        gc.freeze()  # Objects that exist now are never scanned (or copied) by workers' GC
+        self._zygote, child = self._context.Pipe()
+        self._zygote_process = self._context.Process(target=_zygote_main, args=(child,),
+                                                     name="pool-zygote", daemon=True)
+        self._zygote_process.start()
+        child.close()
+        return self
+
+    # Fork the workers (through the zygote) and wait until every worker has
+    # warmed up
+    def start(self, timeout=300.0):
+        self.fork_zygote()
+        self._pool = [_Worker(index, cores) for index, cores in enumerate(self.core_sets)]
+        for worker in self._pool:
+            self._spawn(worker)
+        deadline = time.monotonic() + timeout
+        for worker in self._pool:
+            self._wait_ready(worker, deadline)
+        self._collector = threading.Thread(target=self._collect, name="pool-collector",
+                                           daemon=True)
+        self._collector.start()
+        return self
+
+    # Have the zygote fork a (new) process for `worker`; the caller holds its send_lock
+    # or no other thread uses it yet
+    def _spawn(self, worker):
+        with self._zygote_lock:
+            self._zygote.send((worker.index, worker.cores))
+            pid = self._zygote.recv()
+            worker.connection = Connection(reduction.recv_handle(self._zygote))
+        worker.pid = pid
+        worker.ready = False
+        worker.restarts += 1
+
+    def _wait_ready(self, worker, deadline):
+        while not worker.connection.poll(0.1):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Worker {worker.index} did not start in time")
+        try:
+            worker.connection.recv()
+        except EOFError:
+            raise RuntimeError(f"Worker {worker.index} exited while starting") from None
+        worker.ready = True
+
+    # Logits (numpy [N, classes]) of a list of images as a Future, run by the
+    # worker with the fewest jobs in flight
+    def submit(self, images, attempts=0, future=None):
+        future = future or Future()
+        with self._lock:
+            if self._closed.is_set():
+                raise RuntimeError("The worker pool is closed")
+            workers = [item for item in self._pool if not item.connection.closed]
+            if not workers:
+                raise WorkerCrashedError("Every worker has exited and none can be restarted")
+            worker = min(workers, key=lambda item: (not item.ready, len(item.jobs)))
+            job_id = next(self._job_ids)
+            worker.jobs[job_id] = (images, future, attempts)
+        with worker.send_lock:
+            with self._lock:
+                # A restart that ran in between has already resubmitted the job
+                if job_id not in worker.jobs:
+                    return future
+            try:
+                worker.connection.send((job_id, images))
+            except (OSError, ValueError):
+                pass  # The worker died; the collector restarts it and retries the job
+        return future
+
+    # Logits tensor for many images, split into one chunk per worker (or into
+    # chunks of `batch_size`) that run in parallel
+    def predict_logits(self, images, batch_size=None):
+        images = [np.asarray(image) for image in images]
+        if not images:
+            return torch.empty((0, len(model_inference.trash_classes)))
+        size = batch_size or -(-len(images) // self.workers)
+        futures = [self.submit(images[start:start + size])
+                   for start in range(0, len(images), size)]
+        return torch.from_numpy(np.concatenate([future.result() for future in futures]))
+
+    # Collector thread: route results to their futures and restart workers that
+    # died (their unfinished jobs are retried once on the pool)
+    def _collect(self):
+        while not self._closed.is_set():
+            with self._lock:
+                workers = {worker.connection: worker for worker in self._pool
+                           if not worker.connection.closed}
+            if not workers:
+                return
+            for ready in wait(list(workers), timeout=0.5):
+                worker = workers[ready]
+                try:
+                    message = ready.recv()
+                except (EOFError, OSError):
+                    self._restart(worker)
+                    continue
+                self._deliver(worker, message)
+
+    def _deliver(self, worker, message):
+        if message[0] == "ready":
+            worker.ready = True
+            return
+        job_id, ok, value = message
+        with self._lock:
+            job = worker.jobs.pop(job_id, None)
+        if job is None:
+            return
+        worker.batches += 1
+        future = job[1]
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(RuntimeError(value))
+
+    # Fork a replacement for a worker whose pipe closed (not under the pool
+    # lock: the fork happens in the zygote, and only this worker's sends wait)
+    def _restart(self, worker):
+        error = None
+        with worker.send_lock:
+            with self._lock:
+                jobs, worker.jobs = worker.jobs, {}
+            worker.connection.close()
+            if not self._closed.is_set():
+                try:
+                    self._spawn(worker)  # Forked from the zygote, so it shares the weights
+                except (EOFError, OSError) as spawn_error:
+                    error = WorkerCrashedError(f"Worker {worker.index} could not be "
+                                               f"restarted ({spawn_error})")
+        for images, future, attempts in jobs.values():
+            if self._closed.is_set():
+                future.set_exception(RuntimeError("The worker pool was closed"))
+            elif error is not None or attempts >= 1:
+                future.set_exception(error or WorkerCrashedError(
+                    f"Worker {worker.index} crashed twice while running this batch"
+                ))
+            else:
+                try:
+                    self.submit(images, attempts + 1, future)
+                except (RuntimeError, WorkerCrashedError) as submit_error:
+                    future.set_exception(submit_error)
+
+    # Per-worker pid, cores, threads, batches, restarts and memory
+    def stats(self):
+        with self._lock:
+            workers = list(self._pool)
+        return [
+            dict({"worker": worker.index, "pid": worker.pid, "cores": worker.cores,
+                  "threads": len(worker.cores), "batches": worker.batches,
+                  "restarts": worker.restarts, "in_flight": len(worker.jobs)},
+                 **(process_memory(worker.pid) or {}))
+            for worker in workers
+        ]
+
+    def close(self):
+        self._closed.set()
+        if self._collector is not None:
+            self._collector.join(timeout=2)
+        with self._lock:
+            workers = list(self._pool)
+        for worker in workers:
+            try:
+                with worker.send_lock:
+                    worker.connection.send(None)
+            except (OSError, ValueError):
+                pass
+        deadline = time.monotonic() + 5
+        for worker in workers:
+            if not worker.connection.closed and not worker.wait_exit(deadline):
+                try:
+                    os.kill(worker.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            worker.connection.close()
+            with self._lock:
+                jobs, worker.jobs = worker.jobs, {}
+            for _, future, _ in jobs.values():
+                future.set_exception(RuntimeError("The worker pool was closed"))
+        if self._zygote is not None:
+            try:
+                self._zygote.send(None)
+            except (OSError, ValueError):
+                pass
+            self._zygote_process.join(timeout=5)
+            if self._zygote_process.is_alive():
+                self._zygote_process.terminate()
+            self._zygote.close()
+        gc.unfreeze()
+
+
+# Throughput and memory of the pool for several worker counts, on `images`
+# resized to the model input (as the apps and the inference server send them).
+# The weights are loaded once and shared by every pool size.
+def scaling_report(model_name, images, worker_counts, batch_size=8, rounds=3,
+                   backend=model_inference.BACKEND):
+    engine = model_inference.InferenceEngine(model_name, backend=backend).load()
+    extractor = engine.feature_extractor
+    size = (extractor.size["width"], extractor.size["height"])
+    images = [np.asarray(model_inference._as_rgb_image(image).resize(size, extractor.resample))
+              for image in images]
+    # Enough batches to keep the largest pool busy
+    batches = max(len(images) // batch_size, max(worker_counts) * 2)
+    work = [[images[(start + offset) % len(images)] for offset in range(batch_size)]
+            for start in range(0, batches * batch_size, batch_size)]
+    rows = []
+    for workers in worker_counts:
+        pool = WorkerPool(model_name, workers, backend=backend, engine=engine).start()
+        try:
+            for batch in work[:workers]:
+                pool.submit(batch).result()  # Warm every worker up
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for future in [pool.submit(batch) for batch in work]:
+                    future.result()
+            seconds = time.perf_counter() - start
+            stats = pool.stats()
+            parent = process_memory(os.getpid()) or {}
+            zygote = process_memory(pool._zygote_process.pid) or {}
+            rows.append({
+                "workers": workers,
+                "cores_per_worker": len(stats[0]["cores"]),
+                "images_per_s": round(rounds * len(work) * batch_size / seconds, 1),
+                "worker_rss_mb": [row.get("rss_mb") for row in stats],
+                "worker_pss_mb": [row.get("pss_mb") for row in stats],
+                "worker_private_mb": [row.get("private_mb") for row in stats],
+                "parent_rss_mb": parent.get("rss_mb"),
+                "total_pss_mb": round(sum(row.get("pss_mb") or 0 for row in stats)
+                                      + (parent.get("pss_mb") or 0)
+                                      + (zygote.get("pss_mb") or 0), 1),
+            })
+        finally:
+            pool.close()
+    base = rows[0]["images_per_s"] / rows[0]["workers"]
+    for row in rows:
+        row["scaling_efficiency"] = round(row["images_per_s"] / (base * row["workers"]), 3)
+    return rows
+
+
+def main(argv=None):
+    from cascade import load_images
+
+    parser = argparse.ArgumentParser(
+        description="Measure throughput and memory of the shared-weight worker pool."
+    )
+    parser.add_argument("command", choices=["report"])
+    parser.add_argument("folder", help="Images to classify (searched recursively)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--model", default=model_inference.MODEL_NAME)
+    parser.add_argument("--backend", default=model_inference.BACKEND)
+    args = parser.parse_args(argv)
+
+    images = load_images(args.folder)
+    for row in scaling_report(args.model, images, args.workers, args.batch_size,
+                              args.rounds, args.backend):
+        print(json.dumps(row))
+
+
+if __name__ == "__main__":
+    main()